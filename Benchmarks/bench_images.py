@@ -0,0 +1,95 @@
+""" Built-in modules """
+import argparse
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+# External Modules #
+import cv2
+import numpy as np
+# Custom Modules #
+from Modules.codec import prepare_chunks
+from Modules.ingest import read_payload
+from Modules.migrate import create_db
+from Modules.storage import insert_file, split_payload
+
+
+def make_images(out_path: Path, count: int, size: int) -> list:
+    """
+    Writes synthetic gradient + noise images in each supported image format.
+
+    :param out_path:  The directory where the images are written.
+    :param count:  The number of images to generate.
+    :param size:  The width and height of each image in pixels.
+    :return:  List of (path, ext) tuples for the generated images.
+    """
+    images = []
+    rng = np.random.default_rng(1337)
+    # Build a gradient so the images compress like photos rather than pure noise #
+    gradient = np.linspace(0, 255, size, dtype=np.uint8)
+    base = np.dstack([np.tile(gradient, (size, 1))] * 3)
+
+    for index in range(count):
+        file_ext = ('jpg', 'png', 'jpeg')[index % 3]
+        noise = rng.integers(0, 32, base.shape, dtype=np.uint8)
+        image_path = out_path / f'img{index}.{file_ext}'
+        cv2.imwrite(str(image_path), cv2.add(base, noise))
+        images.append((image_path, file_ext))
+
+    return images
+
+
+def run_mode(images: list, reencode: bool) -> float:
+    """
+    Stores every image into an in-memory database and returns the throughput.
+
+    :param images:  List of (path, ext) tuples to be stored.
+    :param reencode:  If set to True, images are re-encoded through OpenCV before storage.
+    :return:  The number of images stored per second.
+    """
+    connection = sqlite3.connect(':memory:')
+    create_db(connection)
+
+    start = time.perf_counter()
+    # Iterate through the images and store them like store_file does #
+    for image_path, file_ext in images:
+        file_bytes = read_payload(image_path, file_ext, 'IMAGE', reencode)
+        with connection:
+            insert_file(connection, image_path.name, str(image_path.parent), 'IMAGE',
+                        prepare_chunks(split_payload(file_bytes), 'IMAGE'))
+    elapsed = time.perf_counter() - start
+
+    connection.close()
+    return len(images) / elapsed
+
+
+def main():
+    """
+    Benchmarks byte-exact image passthrough against OpenCV decode/re-encode.
+
+    :return:  Nothing
+    """
+    parser = argparse.ArgumentParser(description='Image ingest passthrough vs re-encode benchmark')
+    parser.add_argument('--count', type=int, default=150, help='Number of images to generate')
+    parser.add_argument('--size', type=int, default=1024, help='Image width/height in pixels')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        images = make_images(Path(tmp_dir), args.count, args.size)
+        passthrough = run_mode(images, False)
+        reencode = run_mode(images, True)
+
+    print(f'Images: {args.count} @ {args.size}x{args.size}')
+    print(f'passthrough: {passthrough:10.1f} images/sec')
+    print(f're-encode:   {reencode:10.1f} images/sec')
+    print(f'speedup:     {passthrough / reencode:10.1f}x')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+
+    # If Ctrl + C is detected #
+    except KeyboardInterrupt:
+        sys.exit(0)
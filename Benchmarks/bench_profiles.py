@@ -0,0 +1,161 @@
+""" Built-in modules """
+import argparse
+import io
+import json
+import math
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import redirect_stdout
+from pathlib import Path
+# Custom Modules #
+from Modules.catalog import iter_files
+from Modules.ingest import ingest_files
+from Modules.migrate import create_db, migrate_db
+from Modules.storage import iter_content
+from Modules.utils import PROFILES, DbConnectionHandler
+
+
+def make_corpus(out_path: Path, count: int, size: int) -> list:
+    """
+    Writes compressible text files to be ingested, unique per run so they never clash with names
+    already stored in the copied database.
+
+    :param out_path:  The directory where the files are written.
+    :param count:  The number of files to generate.
+    :param size:  The size of each file in bytes.
+    :return:  List of ingest jobs for the generated files.
+    """
+    rng = random.Random(1337)
+    words = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 9)))
+             for _ in range(2000)]
+    prefix, jobs = uuid.uuid4().hex[:8], []
+
+    for index in range(count):
+        text = ' '.join(rng.choices(words, k=size // 5)).encode()[:size]
+        file_path = out_path / f'bench{prefix}_{index}.txt'
+        file_path.write_bytes(text)
+        jobs.append((file_path.name, 'txt', 'TEXT', file_path))
+
+    return jobs
+
+
+def copy_db(db_file: Path, dest_file: Path):
+    """
+    Copies the user's database with the SQLite backup API, the copy being created empty on
+    connect if there is no database.
+
+    :param db_file:  The path to the user's storage database.
+    :param dest_file:  The path of the copy.
+    :return:  Nothing
+    """
+    # If there is no database to copy #
+    if not db_file.exists():
+        return
+
+    source = sqlite3.connect(f'{db_file.absolute().as_uri()}?mode=ro', uri=True)
+    dest = sqlite3.connect(dest_file)
+    source.backup(dest)
+    dest.close()
+    source.close()
+
+
+def run_profile(profile: str, db_file: Path, jobs: list, reads: int, tmp_path: Path) -> dict:
+    """
+    Times ingest, extraction and listing on a copy of the database opened with a profile.
+
+    :param profile:  The name of the performance profile.
+    :param db_file:  The path to the user's storage database.
+    :param jobs:  List of ingest jobs for the generated corpus.
+    :param reads:  The number of stored files extracted.
+    :param tmp_path:  The directory the copy is made in.
+    :return:  Dict of throughput results.
+    """
+    copy_file = tmp_path / f'{profile}.db'
+    copy_db(db_file, copy_file)
+    corpus_bytes = sum(job[3].stat().st_size for job in jobs)
+
+    with DbConnectionHandler(copy_file, profile) as connection:
+        # Keep migration and per-file progress out of the report #
+        with redirect_stdout(io.StringIO()):
+            # If the copy is empty #
+            if not db_file.exists():
+                create_db(connection)
+            # If the copy holds the user's data #
+            else:
+                migrate_db(connection)
+
+            start = time.perf_counter()
+            ingest_files(connection, jobs)
+            ingest_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows = list(iter_files(connection))
+        list_time = time.perf_counter() - start
+
+        sample = random.Random(7).choices(rows, k=reads)
+        start = time.perf_counter()
+        read_bytes = sum(len(chunk) for row in sample for chunk in iter_content(connection, row[0]))
+        read_time = time.perf_counter() - start
+
+    return {'ingest_files_per_sec': round(len(jobs) / ingest_time, 1),
+            'ingest_mb_per_sec': round(corpus_bytes / ingest_time / 1024 ** 2, 2),
+            'extract_mb_per_sec': round(read_bytes / read_time / 1024 ** 2, 2),
+            'list_rows_per_sec': round(len(rows) / list_time, 1)}
+
+
+def recommend(results: dict) -> dict:
+    """
+    Picks the durable profile with the best geometric mean throughput, and flags bulk-ingest for
+    one-off imports when it ingests markedly faster.
+
+    :param results:  Dict of throughput results per profile.
+    :return:  Dict of the recommendation.
+    """
+    def score(profile):
+        return math.prod(results[profile].values()) ** (1 / len(results[profile]))
+
+    best = max(('safe', 'balanced'), key=score)
+    speedup = results['bulk-ingest']['ingest_files_per_sec'] / \
+              results[best]['ingest_files_per_sec']
+
+    return {'profile': best, 'bulk_ingest_speedup': round(speedup, 2),
+            'use_bulk_ingest_for_imports': speedup >= 1.5}
+
+
+def main():
+    """
+    Benchmarks the SQLite performance profiles against a copy of the user's database and
+    recommends one.
+
+    :return:  Nothing
+    """
+    parser = argparse.ArgumentParser(description='SQLite performance profile benchmark')
+    parser.add_argument('--db', type=Path, default=Path('Dbs') / 'storage.db',
+                        help='Storage database to copy, an empty one is used if missing')
+    parser.add_argument('--count', type=int, default=200, help='Number of files ingested')
+    parser.add_argument('--size', type=int, default=256 * 1024, help='Size of each file in bytes')
+    parser.add_argument('--reads', type=int, default=200, help='Number of files extracted')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        corpus_path = tmp_path / 'corpus'
+        corpus_path.mkdir()
+        jobs = make_corpus(corpus_path, args.count, args.size)
+        results = {profile: run_profile(profile, args.db, jobs, args.reads, tmp_path)
+                   for profile in PROFILES}
+
+    print(json.dumps({'profiles': results, 'recommendation': recommend(results)}, indent=2))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+
+    # If Ctrl + C is detected #
+    except KeyboardInterrupt:
+        sys.exit(0)
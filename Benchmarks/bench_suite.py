@@ -0,0 +1,332 @@
+""" Built-in modules """
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+# External Modules #
+import cv2
+import numpy as np
+# Custom Modules #
+from Modules.catalog import PAGE_SIZE, list_files, resolve_id
+from Modules.extract import stream_extract
+from Modules.ingest import ingest_files
+from Modules.migrate import create_db
+from Modules.storage import delete_file_row
+from Modules.utils import PROFILES, DbConnectionHandler, query_handler, query_item_locate
+
+try:
+    import resource
+# If the platform has no resource module (Windows), RSS growth is not reported #
+except ImportError:
+    resource = None
+
+# Approximate JPEG bytes per pixel of the gradient + noise images, to size them from a file size #
+JPEG_BYTES_PER_PIXEL = 0.5
+
+
+def proc_status(field: str) -> int:
+    """
+    Reads a memory field of the process status on Linux.
+
+    :param field:  The status field name (VmRSS, VmHWM).
+    :return:  The field value in bytes.
+    """
+    # Iterate through the status lines until the field is found #
+    for line in Path('/proc/self/status').read_text().splitlines():
+        # If the line holds the field #
+        if line.startswith(f'{field}:'):
+            return int(line.split()[1]) * 1024
+
+    raise OSError(f'No {field} in the process status')
+
+
+def peak_rss() -> int:
+    """
+    Gets the peak resident set size of the process, since the last reset where the platform
+    allows resetting it.
+
+    :return:  The peak RSS in bytes, None if unavailable on the platform.
+    """
+    try:
+        return proc_status('VmHWM')
+
+    # If the platform has no process status #
+    except OSError:
+        # If the platform has no resource module #
+        if resource is None:
+            return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB while macOS reports bytes #
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def rss_baseline() -> int:
+    """
+    Starts measuring the memory growth of a phase. On Linux the peak RSS is reset to the current
+    RSS, so the growth is the peak of the phase alone, elsewhere it is the rise of the process
+    peak, which misses phases peaking below an earlier one.
+
+    :return:  The RSS the growth is measured from in bytes, None if unavailable.
+    """
+    try:
+        Path('/proc/self/clear_refs').write_text('5')
+        return proc_status('VmRSS')
+
+    # If the peak RSS cannot be reset #
+    except OSError:
+        return peak_rss()
+
+
+def rss_growth(baseline: int) -> int:
+    """
+    Gets the memory growth of a phase.
+
+    :param baseline:  The RSS the growth is measured from (see rss_baseline).
+    :return:  The growth of the peak RSS in bytes, None if unavailable.
+    """
+    return None if baseline is None else max(0, peak_rss() - baseline)
+
+
+def draw_sizes(rng: random.Random, count: int, median: int, sigma: float) -> list:
+    """
+    Draws file sizes from a log-normal distribution around a median.
+
+    :param rng:  The seeded random generator.
+    :param count:  The number of sizes drawn.
+    :param median:  The median size in bytes.
+    :param sigma:  The spread of the distribution, 0 for fixed sizes.
+    :return:  List of sizes in bytes.
+    """
+    return [max(1, int(rng.lognormvariate(0, sigma) * median)) for _ in range(count)]
+
+
+def make_corpus(out_path: Path, args) -> list:
+    """
+    Writes a reproducible synthetic Dock corpus of compressible text files and JPEG images
+    encoded by OpenCV, so image ingest decodes and hashes real images.
+
+    :param out_path:  The directory where the files are written.
+    :param args:  The parsed command arguments.
+    :return:  List of ingest jobs for the generated files.
+    """
+    rng = random.Random(args.seed)
+    words = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 9))).encode()
+             for _ in range(4096)]
+    jobs = []
+
+    # Iterate through the text file sizes #
+    for index, size in enumerate(draw_sizes(rng, args.text_count, args.text_size, args.sigma)):
+        file_path = out_path / f'text{index}.txt'
+        file_path.write_bytes(b' '.join(rng.choices(words, k=size // 5 + 1))[:size])
+        jobs.append((file_path.name, 'txt', 'TEXT', file_path))
+
+    pixels = np.random.default_rng(args.seed)
+    # Iterate through the image file sizes, images being stored byte-exact #
+    for index, size in enumerate(draw_sizes(rng, args.image_count, args.image_size, args.sigma)):
+        side = max(8, int((size / JPEG_BYTES_PER_PIXEL) ** 0.5))
+        # Build a gradient with noise so the images compress like photos rather than pure noise #
+        gradient = np.linspace(0, 255, side, dtype=np.uint8)
+        base = np.dstack([np.tile(gradient, (side, 1))] * 3)
+        image = cv2.add(base, pixels.integers(0, 32, base.shape, dtype=np.uint8))
+        file_path = out_path / f'image{index}.jpg'
+        file_path.write_bytes(cv2.imencode('.jpg', image)[1].tobytes())
+        jobs.append((file_path.name, 'jpg', 'IMAGE', file_path))
+
+    return jobs
+
+
+def summarize(latencies: list, elapsed: float, files: int, size: int, growth: int) -> dict:
+    """
+    Builds the result of a timed phase.
+
+    :param latencies:  List of per-operation latencies in seconds, empty if not measured.
+    :param elapsed:  The wall time of the phase in seconds.
+    :param files:  The number of files processed.
+    :param size:  The number of file bytes processed.
+    :param growth:  The memory growth of the phase in bytes (see rss_growth).
+    :return:  Dict of phase results.
+    """
+    latencies = sorted(latencies)
+
+    def pct(value):
+        return round(latencies[min(len(latencies) - 1, int(value * len(latencies)))] * 1000, 3) \
+               if latencies else None
+
+    return {'seconds': round(elapsed, 4), 'files': files,
+            'files_per_sec': round(files / elapsed, 1) if elapsed else None,
+            'mb_per_sec': round(size / elapsed / 1024 ** 2, 2) if elapsed else None,
+            'p50_ms': pct(0.5), 'p99_ms': pct(0.99), 'rss_growth': growth}
+
+
+def timed(func, items) -> tuple:
+    """
+    Times a function call per item.
+
+    :param func:  The function called with each item.
+    :param items:  The items to be processed.
+    :return:  Tuple of (list of latencies in seconds, total elapsed seconds).
+    """
+    latencies = []
+    start = time.perf_counter()
+    # Iterate through the items timing each call #
+    for item in items:
+        op_start = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - op_start)
+
+    return latencies, time.perf_counter() - start
+
+
+def run_suite(args, tmp_path: Path) -> dict:
+    """
+    Times the store, list, get_by_index, extract and delete code paths on a fresh database.
+
+    :param args:  The parsed command arguments.
+    :param tmp_path:  The directory the corpus, database and extracted files are placed in.
+    :return:  Dict of results per phase.
+    """
+    corpus_path, extract_path = tmp_path / 'Dock', tmp_path / 'Extract'
+    corpus_path.mkdir()
+    extract_path.mkdir()
+    jobs = make_corpus(corpus_path, args)
+    total = sum(job[3].stat().st_size for job in jobs)
+    phases = {}
+
+    with DbConnectionHandler(tmp_path / 'storage.db', args.profile) as connection:
+        create_db(connection)
+
+        # store_file: throughput of the pipelined ingest #
+        rss = rss_baseline()
+        start = time.perf_counter()
+        with redirect_stdout(StringIO()):
+            ingest_files(connection, jobs, workers=args.workers)
+        elapsed, growth = time.perf_counter() - start, rss_growth(rss)
+
+        # The pipelined files share their batch commit, so the per-file latency is sampled by #
+        # storing files one per batch in a database of their own #
+        sample = random.Random(args.seed).sample(jobs, min(args.store_samples, len(jobs)))
+        with DbConnectionHandler(tmp_path / 'sample.db', args.profile) as sample_conn:
+            create_db(sample_conn)
+            with redirect_stdout(StringIO()):
+                latencies, _ = timed(lambda job: ingest_files(sample_conn, [job], workers=1,
+                                                              batch_files=1), sample)
+        phases['store'] = summarize(latencies, elapsed, len(jobs), total, growth)
+
+        # list_storage: one keyset page per operation #
+        pages, after_id, rss = [], 0, rss_baseline()
+        start = op_start = time.perf_counter()
+        # Fetch pages until one comes back empty #
+        while rows := list_files(connection, after_id, PAGE_SIZE):
+            pages.append(time.perf_counter() - op_start)
+            after_id, op_start = rows[-1][0], time.perf_counter()
+        phases['list'] = summarize(pages, time.perf_counter() - start, len(jobs), 0,
+                                   rss_growth(rss))
+
+        ids = [row[0] for row in list_files(connection, 0, len(jobs))]
+        sample, rss = random.Random(args.seed).choices(ids, k=args.lookups), rss_baseline()
+        phases['get_by_index'] = summarize(*timed(lambda file_id: resolve_id(connection, file_id),
+                                                  sample), len(sample), 0, rss_growth(rss))
+
+        # extract_file: locate by name then stream to disk #
+        def extract(job):
+            row = query_handler(connection, query_item_locate(), job[0], fetch='one')
+            stream_extract(connection, row[0], extract_path / job[0])
+
+        rss = rss_baseline()
+        phases['extract'] = summarize(*timed(extract, jobs), len(jobs), total, rss_growth(rss))
+
+        # delete_file: locate by name then delete in one transaction #
+        def delete(job):
+            row = query_handler(connection, query_item_locate(), job[0], fetch='one')
+            delete_file_row(connection, row[0])
+
+        rss = rss_baseline()
+        phases['delete'] = summarize(*timed(delete, jobs), len(jobs), total, rss_growth(rss))
+
+    return {'corpus': {'files': len(jobs), 'bytes': total}, 'phases': phases}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares the throughput of each phase against a baseline run.
+
+    :param results:  The results of this run.
+    :param baseline:  The results of the baseline run.
+    :param tolerance:  The fraction of throughput a phase may lose before it is a regression.
+    :return:  List of regression descriptions.
+    """
+    regressions = []
+    # Iterate through the phases present in both runs #
+    for phase, result in results['phases'].items():
+        before = baseline['phases'].get(phase, {}).get('files_per_sec')
+        # If the phase slowed down beyond the tolerance #
+        if before and result['files_per_sec'] < before * (1 - tolerance):
+            regressions.append(f'{phase}: {before} -> {result["files_per_sec"]} files/sec')
+
+    return regressions
+
+
+def main():
+    """
+    Runs the benchmark suite and writes the results as JSON, exiting 1 if any phase regressed
+    against the baseline.
+
+    :return:  Nothing
+    """
+    parser = argparse.ArgumentParser(description='Store/list/extract/delete benchmark suite')
+    parser.add_argument('--text-count', type=int, default=500, help='Number of text files')
+    parser.add_argument('--text-size', type=int, default=32 * 1024, help='Median text size')
+    parser.add_argument('--image-count', type=int, default=100, help='Number of image files')
+    parser.add_argument('--image-size', type=int, default=512 * 1024, help='Median image size')
+    parser.add_argument('--sigma', type=float, default=1.0, help='Log-normal size spread')
+    parser.add_argument('--lookups', type=int, default=1000, help='Number of id lookups')
+    parser.add_argument('--store-samples', type=int, default=100,
+                        help='Number of files stored one per batch to sample store latency')
+    parser.add_argument('--workers', type=int, default=4, help='Ingest reader threads')
+    parser.add_argument('--profile', choices=tuple(PROFILES), default=None,
+                        help='SQLite performance profile')
+    parser.add_argument('--seed', type=int, default=1337, help='Corpus random seed')
+    parser.add_argument('--output', type=Path, default=None, help='JSON results file')
+    parser.add_argument('--baseline', type=Path, default=None, help='JSON results to compare')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed throughput loss against the baseline')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run_suite(args, Path(tmp_dir))
+
+    # Keep the config values as their JSON types so runs compare numerically, paths aside #
+    results['config'] = {key: str(value) if isinstance(value, Path) else value
+                         for key, value in vars(args).items()}
+    results['platform'] = {'python': platform.python_version(),
+                           'sqlite': sqlite3.sqlite_version, 'system': platform.platform()}
+
+    # If there is a baseline run to compare against #
+    if args.baseline:
+        results['regressions'] = compare(results, json.loads(args.baseline.read_text()),
+                                         args.tolerance)
+
+    report = json.dumps(results, indent=2)
+    # If the results are to be saved #
+    if args.output:
+        args.output.write_text(report)
+
+    print(report)
+    sys.exit(1 if results.get('regressions') else 0)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+
+    # If Ctrl + C is detected #
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,167 @@
+""" Built-in modules """
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+
+async def connect(args) -> tuple:
+    """
+    Opens a connection to the file server.
+
+    :param args:  The parsed command arguments.
+    :return:  Tuple of (stream reader, stream writer).
+    """
+    # If the server listens on a Unix socket #
+    if args.socket:
+        return await asyncio.open_unix_connection(args.socket)
+
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def request(reader, writer, method: str, target: str, body=b'') -> tuple:
+    """
+    Sends a keep-alive request and reads the whole response, decoding chunked bodies.
+
+    :param reader:  The connection stream reader.
+    :param writer:  The connection stream writer.
+    :param method:  The request method.
+    :param target:  The request target path.
+    :param body:  The request body bytes.
+    :return:  Tuple of (status code, response body length).
+    """
+    writer.write(f'{method} {target} HTTP/1.1\r\nHost: localhost\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode())
+    writer.write(body)
+    await writer.drain()
+
+    lines = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    headers = {key.strip().lower(): value.strip()
+               for key, value in (line.split(':', 1) for line in lines[1:] if line)}
+    received = 0
+
+    # If the body is sent in chunks #
+    if headers.get('transfer-encoding') == 'chunked':
+        # Read chunks until the terminating empty chunk #
+        while size := int((await reader.readline()).strip(), 16):
+            received += len(await reader.readexactly(size + 2)) - 2
+
+        await reader.readline()
+    # If the body has a fixed length #
+    else:
+        received = len(await reader.readexactly(int(headers.get('content-length', 0))))
+
+    return int(lines[0].split(' ')[1]), received
+
+
+async def worker(args, jobs: asyncio.Queue, latencies: list, errors: list):
+    """
+    Runs requests from the job queue over one keep-alive connection, recording their latency and
+    the body bytes transferred.
+
+    :param args:  The parsed command arguments.
+    :param jobs:  Queue of (method, target, body) requests.
+    :param latencies:  List the (latency in seconds, body bytes) of each request are appended to.
+    :param errors:  List the failed request status codes are appended to.
+    :return:  Nothing
+    """
+    reader, writer = await connect(args)
+    # Run requests until the queue is empty #
+    while not jobs.empty():
+        method, target, body = jobs.get_nowait()
+        start = time.perf_counter()
+        status, received = await request(reader, writer, method, target, body)
+        latencies.append((time.perf_counter() - start, len(body) + received))
+
+        # If the request failed #
+        if status >= 400:
+            errors.append(status)
+
+    writer.close()
+
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Gets the nearest-rank percentile of sorted values.
+
+    :param values:  The sorted values.
+    :param pct:  The percentile between 0 and 100.
+    :return:  The percentile value.
+    """
+    return values[min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))]
+
+
+async def run_phase(args, requests: list) -> dict:
+    """
+    Runs requests concurrently over the configured number of connections.
+
+    :param args:  The parsed command arguments.
+    :param requests:  List of (method, target, body) requests.
+    :return:  Dict of throughput and latency results.
+    """
+    jobs = asyncio.Queue()
+    # Queue every request for the workers #
+    for job in requests:
+        jobs.put_nowait(job)
+
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(args, jobs, latencies, errors)
+                           for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    transferred = sum(size for _, size in latencies)
+    latencies = sorted(latency for latency, _ in latencies)
+
+    return {'requests': len(latencies), 'errors': len(errors),
+            'requests_per_sec': round(len(latencies) / elapsed, 1),
+            'mb_per_sec': round(transferred / elapsed / 1024 ** 2, 2),
+            **{f'p{pct}_ms': round(percentile(latencies, pct) * 1000, 2)
+               for pct in (50, 90, 99)}}
+
+
+async def run(args) -> dict:
+    """
+    Loads the server with PUT, GET, LIST and DELETE phases of unique files.
+
+    :param args:  The parsed command arguments.
+    :return:  Dict of results per phase.
+    """
+    prefix = f'load{os.getpid()}'
+    names = [f'{prefix}_{index}.txt' for index in range(args.requests)]
+    results = {'put': await run_phase(args, [('PUT', f'/files/{name}', os.urandom(args.size))
+                                             for name in names])}
+    results['get'] = await run_phase(args, [('GET', f'/files/{name}', b'') for name in names])
+    results['list'] = await run_phase(args, [('GET', f'/files?name={prefix}&limit=60', b'')
+                                             for _ in names])
+    results['delete'] = await run_phase(args, [('DELETE', f'/files/{name}', b'')
+                                               for name in names])
+    return results
+
+
+def main():
+    """
+    Load-tests a running file server and reports requests/sec and latency percentiles.
+
+    :return:  Nothing
+    """
+    parser = argparse.ArgumentParser(description='File server load-test client')
+    parser.add_argument('--host', default='127.0.0.1', help='Server address')
+    parser.add_argument('--port', type=int, default=8080, help='Server TCP port')
+    parser.add_argument('--socket', default=None, help='Server Unix socket path instead of TCP')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent connections')
+    parser.add_argument('--requests', type=int, default=500, help='Requests per phase')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='File size in bytes')
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+
+    # If Ctrl + C is detected #
+    except KeyboardInterrupt:
+        sys.exit(0)
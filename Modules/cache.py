@@ -0,0 +1,120 @@
+""" Built-in modules """
+import threading
+from collections import OrderedDict
+
+
+# Default memory budget of the content cache of the server #
+CACHE_BYTES = 64 * 1024 * 1024
+# Items larger than this share of the budget are streamed without being cached #
+CACHE_ITEM_SHARE = 4
+
+
+class ContentCache:
+    """ Thread-safe LRU cache of decoded item content bounded by a byte budget. """
+    def __init__(self, max_bytes=CACHE_BYTES, max_item_bytes=None):
+        """
+        Content cache initializer.
+
+        :param max_bytes:  The max number of content bytes held.
+        :param max_item_bytes:  The max size of a cached item, None for a share of the budget so
+                                one large item cannot flush every hot item.
+        """
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_bytes // CACHE_ITEM_SHARE if max_item_bytes is None \
+            else max_item_bytes
+        # Entries by name holding the content version, chunks and size, least recent first #
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, name: str, version: str):
+        """
+        Looks up the content of an item, an entry of another version of the item being stale and
+        dropped.
+
+        :param name:  The stored file name.
+        :param version:  The content hash of the stored item.
+        :return:  Tuple of the content byte chunks, None on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+            # If the cached content is of the stored version #
+            if entry and entry[0] == version:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return entry[1]
+
+            # If the cached content is of a replaced version #
+            if entry:
+                self.drop(name)
+                self.invalidations += 1
+
+            self.misses += 1
+            return None
+
+    def put(self, name: str, version: str, chunks):
+        """
+        Caches the content of an item, evicting the least recently used items over the budget.
+
+        :param name:  The stored file name.
+        :param version:  The content hash of the stored item.
+        :param chunks:  Iterable of the content byte chunks.
+        :return:  Nothing
+        """
+        chunks = tuple(chunks)
+        size = sum(map(len, chunks))
+
+        with self.lock:
+            # If another version of the item is cached #
+            if name in self.entries:
+                self.drop(name)
+
+            # If the item is too large to be cached #
+            if size > self.max_item_bytes:
+                return
+
+            self.entries[name] = (version, chunks, size)
+            self.used_bytes += size
+            # Evict the least recently used items until the budget is met #
+            while self.used_bytes > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, name: str):
+        """
+        Drops the cached content of an item that was stored, replaced or deleted.
+
+        :param name:  The stored file name.
+        :return:  Nothing
+        """
+        with self.lock:
+            # If the item is cached #
+            if name in self.entries:
+                self.drop(name)
+                self.invalidations += 1
+
+    def drop(self, name: str):
+        """
+        Removes an entry, the caller holding the lock.
+
+        :param name:  The stored file name.
+        :return:  Nothing
+        """
+        self.used_bytes -= self.entries.pop(name)[2]
+
+    def stats(self) -> dict:
+        """
+        Gathers the cache counters for sizing the budget.
+
+        :return:  Dict of the cache counters.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'entries': len(self.entries),
+                    'used_bytes': self.used_bytes, 'max_bytes': self.max_bytes,
+                    'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0}
@@ -0,0 +1,113 @@
+""" Built-in modules """
+from pathlib import PureWindowsPath
+# Custom Modules #
+from Modules.utils import query_handler, query_item_name, query_list_page
+
+
+# Default number of items per listing page #
+PAGE_SIZE = 60
+# Keys of the listed item metadata rows #
+LIST_KEYS = ('id', 'name', 'path', 'type', 'size', 'mtime', 'hash')
+# Supported listing filter names #
+LIST_FILTERS = ('ext_type', 'path', 'name', 'size_min', 'size_max', 'mtime_min', 'mtime_max')
+
+
+def check_name(name: str, nested=True) -> str:
+    """
+    Checks that a stored name is safe to become a path under an extraction directory: a relative
+    POSIX path with no empty, . or .. parts, backslashes, NUL characters or drive.
+
+    :param name:  The stored file name.
+    :param nested:  If set to False, names with subdirectory parts are rejected as well.
+    :return:  The checked name.
+    """
+    parts = name.split('/') if isinstance(name, str) else ()
+    # If the name is empty, absolute, escapes its directory or holds unsafe characters #
+    if not parts or any(part in ('', '.', '..') for part in parts) or '\\' in name or \
+            '\0' in name or PureWindowsPath(name).drive or (not nested and len(parts) > 1):
+        raise ValueError(f'Unsafe file name: {name!r}')
+
+    return name
+
+
+def resolve_id(connection, file_id: int):
+    """
+    Resolves the name of a stored item from its stable numeric id with a single indexed lookup.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param file_id:  The id of the stored item.
+    :return:  The item name, None if no item has the id.
+    """
+    row = query_handler(connection, query_item_name(), file_id, fetch='one')
+    return row[0] if row else None
+
+
+def list_files(connection, after_id=0, limit=PAGE_SIZE, **filters) -> list:
+    """
+    Retrieves a keyset page of item metadata ordered by id. A name without glob characters is
+    matched as a prefix.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param after_id:  The id of the last item on the previous page, 0 for the first page.
+    :param limit:  The max number of items in the page.
+    :param filters:  Keyword filters (ext_type, path, name, size_min, size_max, mtime_min,
+                     mtime_max), None values are ignored.
+    :return:  List of (id, name, path, ext, size, mtime, hash) rows.
+    """
+    filters = clean_filters(filters)
+    return query_handler(connection, query_list_page(filters), after_id, *filters.values(),
+                         limit, fetch='all')
+
+
+def list_names(connection, after_name='', limit=PAGE_SIZE, **filters) -> list:
+    """
+    Retrieves a keyset page of item metadata ordered by name through the unique name index, so
+    the first names are found without sorting every item.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param after_name:  The name of the last item on the previous page, empty for the first page.
+    :param limit:  The max number of items in the page.
+    :param filters:  Keyword filters, see list_files.
+    :return:  List of (id, name, path, ext, size, mtime, hash) rows.
+    """
+    filters = clean_filters(filters)
+    return query_handler(connection, query_list_page(filters, 'name'), after_name,
+                         *filters.values(), limit, fetch='all')
+
+
+def clean_filters(filters: dict) -> dict:
+    """
+    Drops the listing filters that were not set, checks the rest are supported and turns a name
+    filter without glob characters into a prefix match.
+
+    :param filters:  Dict of keyword listing filters.
+    :return:  Dict of the filters to be applied.
+    """
+    # Drop the filters that were not set #
+    filters = {key: value for key, value in filters.items() if value is not None}
+
+    # If an unsupported filter was passed #
+    if not set(filters).issubset(LIST_FILTERS):
+        raise ValueError(f'Unsupported listing filter: {set(filters) - set(LIST_FILTERS)}')
+
+    # If the name filter has no glob characters, match it as a prefix #
+    if 'name' in filters and not any(char in filters['name'] for char in '*?['):
+        filters['name'] += '*'
+
+    return filters
+
+
+def iter_files(connection, page_size=PAGE_SIZE, after_id=0, **filters):
+    """
+    Lazily yields the metadata of every item matching the filters one keyset page at a time.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param page_size:  The number of items fetched per page.
+    :param after_id:  The id after which the items are yielded, 0 for all items.
+    :param filters:  Keyword filters, see list_files.
+    :return:  Generator of (id, name, path, ext, size, mtime, hash) rows.
+    """
+    # Fetch pages until one comes back empty #
+    while rows := list_files(connection, after_id, page_size, **filters):
+        yield from rows
+        after_id = rows[-1][0]
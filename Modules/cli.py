@@ -0,0 +1,680 @@
+""" Built-in modules """
+import argparse
+import json
+import logging
+import sqlite3
+import sys
+from contextlib import redirect_stdout
+from pathlib import Path
+# Custom Modules #
+from Modules.cache import CACHE_BYTES
+from Modules.catalog import LIST_KEYS, iter_files, list_files, resolve_id
+from Modules.extract import EXTRACT_WORKERS, extract_files, extract_tar, select_items
+from Modules.instrument import QUERY_STATS
+from Modules.ingest import EXTENSIONS, INGEST_WORKERS, ingest_files
+from Modules.migrate import create_db, migrate_db
+from Modules.phash import SIMILAR_DISTANCE, SIMILAR_KEYS, SIMILAR_LIMIT, backfill_phashes, \
+                          dhash_file, similar
+from Modules.search import SEARCH_KEYS, SEARCH_LIMIT, rebuild_index, search
+from Modules.shards import SHARD_COUNT, ShardedStore
+from Modules.startup import STARTUP_FLAG
+from Modules.sync import sync_dir
+from Modules.walker import SYMLINK_POLICIES, walk_files
+from Modules.storage import delete_file_row, get_stats
+from Modules.utils import PROFILES, DbConnectionHandler, check_env_profile, db_error_query, \
+                          query_handler, query_item_locate, query_phash_fetch
+
+
+# Exit code when one or more of the targets of a command failed #
+EXIT_PARTIAL = 5
+
+
+def build_parser(dock_path: Path) -> argparse.ArgumentParser:
+    """
+    Builds the parser for the non-interactive subcommand interface.
+
+    :param dock_path:  The default directory files are extracted to.
+    :return:  The argument parser.
+    """
+    parser = argparse.ArgumentParser(prog='file_database.py',
+                                     description='Non-interactive storage database commands, '
+                                                 'run without arguments for the menu.')
+    parser.add_argument('--profile', choices=tuple(PROFILES), default=None,
+                        help='SQLite performance profile, FILEDB_PROFILE or safe by default')
+    parser.add_argument('--instrument', action='store_true',
+                        help='Time every query and add the aggregates to the output')
+    parser.add_argument('--slow-ms', type=float, default=None,
+                        help='Log queries taking at least this many milliseconds')
+    parser.add_argument('--slow-log', default=None, help='Slow-query log file')
+    # Consumed before parsing so the imports are timed, only listed here for the help text #
+    parser.add_argument(STARTUP_FLAG, action='store_true',
+                        help='Report per-module import times and the time to the first query '
+                             'as JSON on stderr')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    store = commands.add_parser('store', help='Store files and the supported files of directories')
+    store.add_argument('targets', nargs='+', type=Path, help='Files or directories to store')
+    store.add_argument('--delete', action='store_true', help='Delete the files once stored')
+    store.add_argument('--reencode', action='store_true', help='Re-encode images through OpenCV')
+    store.add_argument('--workers', type=int, default=INGEST_WORKERS, help='Reader threads')
+    store.add_argument('--level', type=int, default=None, help='Compression level')
+    store.add_argument('-r', '--recursive', action='store_true',
+                       help='Walk directories recursively')
+    store.add_argument('--max-depth', type=int, default=None,
+                       help='Max depth walked below each directory, implies --recursive')
+    store.add_argument('--include', action='append', default=[], metavar='GLOB',
+                       help='Only store files matching the glob, by relative path or name')
+    store.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                       help='Skip files and directories matching the glob')
+    store.add_argument('--symlinks', choices=SYMLINK_POLICIES, default='skip',
+                       help='Skip links, follow links to files only, or follow all links')
+
+    syncer = commands.add_parser('sync', help='Store new and changed files of directories, '
+                                              'skipping unchanged ones without reading them')
+    syncer.add_argument('targets', nargs='+', type=Path, help='Directories to sync')
+    syncer.add_argument('--prune', action='store_true',
+                        help='Delete stored files whose source file disappeared')
+    syncer.add_argument('--workers', type=int, default=INGEST_WORKERS, help='Reader threads')
+    syncer.add_argument('--level', type=int, default=None, help='Compression level')
+
+    extract = commands.add_parser('extract', help='Extract stored files by name or id, glob, '
+                                                  'type or all at once')
+    extract.add_argument('targets', nargs='*', help='Stored file names or ids')
+    extract.add_argument('--glob', help='Extract the files whose name matches the glob')
+    extract.add_argument('--type', dest='ext_type', choices=('TEXT', 'IMAGE'),
+                         help='Extract the files of the storage type')
+    extract.add_argument('--all', action='store_true', help='Extract every stored file')
+    extract.add_argument('--dest', type=Path, default=dock_path, help='Directory to extract to')
+    extract.add_argument('--tar', type=Path, default=None,
+                         help='Stream the files into a .tar, .tar.gz or .tgz archive instead')
+    extract.add_argument('--workers', type=int, default=EXTRACT_WORKERS,
+                         help='Extraction threads')
+
+    delete = commands.add_parser('delete', help='Delete stored files by name or id')
+    delete.add_argument('targets', nargs='+', help='Stored file names or ids')
+
+    listing = commands.add_parser('list', help='List stored files')
+    listing.add_argument('--type', dest='ext_type', choices=('TEXT', 'IMAGE'))
+    listing.add_argument('--path', help='Source directory the files were stored from')
+    listing.add_argument('--name', help='Name prefix or glob')
+    listing.add_argument('--size-min', type=int)
+    listing.add_argument('--size-max', type=int)
+    listing.add_argument('--mtime-min', type=float)
+    listing.add_argument('--mtime-max', type=float)
+    listing.add_argument('--after', type=int, default=0, help='List files after this id')
+    listing.add_argument('--limit', type=int, default=None, help='Max number of files listed')
+
+    commands.add_parser('stats', help='Display storage statistics')
+
+    finder = commands.add_parser('search', help='Full-text search the stored text files')
+    finder.add_argument('query', help='FTS5 query: terms, "phrases", prefix*, AND/OR/NOT')
+    finder.add_argument('--limit', type=int, default=SEARCH_LIMIT, help='Max number of matches')
+
+    commands.add_parser('reindex', help='Rebuild the full-text index of the stored text files')
+
+    lookalike = commands.add_parser('similar', help='Find stored images similar to an image')
+    lookalike.add_argument('target', help='Stored image name or id, or an image file path')
+    lookalike.add_argument('--distance', type=int, default=SIMILAR_DISTANCE,
+                           help='Max Hamming distance of the 64-bit perceptual hashes')
+    lookalike.add_argument('--limit', type=int, default=SIMILAR_LIMIT, help='Max number of matches')
+
+    commands.add_parser('backfill', help='Compute the perceptual hash of stored images lacking one')
+
+    sharded = commands.add_parser('shard', help='Run a command against the sharded layout of '
+                                                'several database files under Dbs/')
+    sharded.add_argument('--shards', type=int, default=None,
+                         help=f'Shard count of a new layout, {SHARD_COUNT} by default')
+    actions = sharded.add_subparsers(dest='action', required=True)
+    shard_store = actions.add_parser('store', help='Store files, writing the shards in parallel')
+    shard_store.add_argument('targets', nargs='+', type=Path, help='Files or directories to store')
+    shard_store.add_argument('-r', '--recursive', action='store_true',
+                             help='Walk directories recursively')
+    shard_store.add_argument('--include', action='append', default=[], metavar='GLOB',
+                             help='Only store files matching the glob')
+    shard_store.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                             help='Skip files and directories matching the glob')
+    shard_extract = actions.add_parser('extract', help='Extract stored files by name, glob, type '
+                                                       'or all at once')
+    shard_extract.add_argument('targets', nargs='*', help='Stored file names')
+    shard_extract.add_argument('--glob', help='Extract the files whose name matches the glob')
+    shard_extract.add_argument('--type', dest='ext_type', choices=('TEXT', 'IMAGE'))
+    shard_extract.add_argument('--all', action='store_true', help='Extract every stored file')
+    shard_extract.add_argument('--dest', type=Path, default=dock_path,
+                               help='Directory to extract to')
+    shard_delete = actions.add_parser('delete', help='Delete stored files by name')
+    shard_delete.add_argument('targets', nargs='+', help='Stored file names')
+    shard_list = actions.add_parser('list', help='List stored files across the shards')
+    shard_list.add_argument('--type', dest='ext_type', choices=('TEXT', 'IMAGE'))
+    shard_list.add_argument('--name', help='Name prefix or glob')
+    shard_list.add_argument('--limit', type=int, default=None, help='Max number of files listed')
+    shard_search = actions.add_parser('search', help='Full-text search across the shards')
+    shard_search.add_argument('query', help='FTS5 query: terms, "phrases", prefix*, AND/OR/NOT')
+    shard_search.add_argument('--limit', type=int, default=SEARCH_LIMIT,
+                              help='Max number of matches')
+    actions.add_parser('stats', help='Display the combined storage statistics')
+    shard_rebalance = actions.add_parser('rebalance', help='Change the shard count, moving the '
+                                                           'files routed to another shard')
+    shard_rebalance.add_argument('count', type=int, help='New shard count')
+
+    server = commands.add_parser('serve', help='Serve the database over localhost HTTP')
+    server.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    server.add_argument('--port', type=int, default=8080, help='TCP port to listen on')
+    server.add_argument('--socket', default=None, help='Unix socket path to listen on instead')
+    server.add_argument('--readers', type=int, default=None,
+                        help='Pooled read-only connections, cores + 4 (max 32) by default')
+    server.add_argument('--max-clients', type=int, default=None,
+                        help='Max requests handled at once, 64 by default')
+    server.add_argument('--cache-mb', type=int, default=CACHE_BYTES // (1024 * 1024),
+                        help='Memory budget of the cache of hot file content, 0 to disable it')
+
+    return parser
+
+
+def locate(connection, target: str):
+    """
+    Locates a stored item by its name, or by its id if the target is numeric.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param target:  The stored file name or id.
+    :return:  Tuple of (id, path, ext, size) and the item name, None for the row if not found.
+    """
+    # If the target is a listed id #
+    if target.isdigit():
+        target = resolve_id(connection, int(target))
+        # If no item has the id #
+        if target is None:
+            return None, None
+
+    return query_handler(connection, query_item_locate(), target, fetch='one'), target
+
+
+def collect_jobs(targets: list, errors: list, walk: dict):
+    """
+    Lazily yields ingest jobs for the target files and the supported files walked from target
+    directories, so storing starts while the walk is still going. Target files are stored under
+    their own names and walked files under their path relative to the target directory.
+
+    :param targets:  List of file and directory paths.
+    :param errors:  List the error results of missing or unsupported targets are appended to.
+    :param walk:  Dict of directory walk options (see walker.walk_files).
+    :return:  Generator of (stored name, file extension, storage type, source path) jobs.
+    """
+    # Iterate through the targets #
+    for target in targets:
+        # If the target is a directory, walk its supported files #
+        if target.is_dir():
+            yield from walk_files(target, **walk)
+            continue
+
+        # If the target does not exist #
+        if not target.is_file():
+            errors.append({'target': str(target), 'ok': False,
+                           'error': 'No such file or directory'})
+            continue
+
+        file_ext = target.suffix[1:].lower()
+        # If the file extension is not supported #
+        if file_ext not in EXTENSIONS:
+            errors.append({'target': str(target), 'ok': False,
+                           'error': f'Unsupported extension: {target.suffix}'})
+            continue
+
+        yield target.name, file_ext, EXTENSIONS[file_ext], target.absolute()
+
+
+def cmd_store(connection, args) -> dict:
+    """
+    Stores the target files through the ingest pipeline.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    results = []
+    # Without --recursive or --max-depth, only the files directly in directories are stored #
+    depth = args.max_depth if args.max_depth is not None else None if args.recursive else 0
+    walk = {'include': args.include, 'exclude': args.exclude, 'max_depth': depth,
+            'symlinks': args.symlinks}
+
+    def committed(sources):
+        # Iterate through the files of the committed batch #
+        for current_file in sources:
+            # If the user wants the files deleted after storage #
+            if args.delete:
+                try:
+                    current_file.unlink()
+
+                # If the stored file could not be deleted #
+                except OSError as unlink_err:
+                    logging.error('Error occurred deleting stored file: %s', unlink_err)
+                    results.append({'target': str(current_file), 'ok': False,
+                                    'error': f'Stored but not deleted: {unlink_err.strerror}'})
+                    continue
+
+            results.append({'target': str(current_file), 'ok': True})
+
+    # Send the per-file progress to stderr so stdout only holds the JSON document #
+    with redirect_stdout(sys.stderr):
+        writer = ingest_files(connection, collect_jobs(args.targets, results, walk), args.reencode,
+                              args.workers, level=args.level, on_commit=committed)
+
+    results += [{'target': str(current_file), 'ok': False, 'error': 'Not stored'}
+                for current_file in writer.failed]
+
+    return {'command': 'store', 'results': results}
+
+
+def cmd_sync(connection, args) -> dict:
+    """
+    Syncs the target directories with the items stored from them.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    results = []
+
+    # Iterate through the target directories #
+    for target in args.targets:
+        # If the target is not a directory #
+        if not target.is_dir():
+            results.append({'target': str(target), 'ok': False, 'error': 'Not a directory'})
+            continue
+
+        # Send the per-file progress to stderr so stdout only holds the JSON document #
+        with redirect_stdout(sys.stderr):
+            synced = sync_dir(connection, target, args.prune, args.workers, args.level)
+
+        results.append({'target': str(target), 'ok': not synced['failed'] and
+                        not synced['conflicts'] and not synced['collisions'], **synced})
+
+    return {'command': 'sync', 'results': results}
+
+
+def cmd_extract(connection, args) -> dict:
+    """
+    Extracts the target items, or the items selected by glob, type or all at once, to the
+    destination directory or into a single tar archive.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    selectors = args.glob or args.ext_type or args.all
+    # If nothing or both targets and a selection were passed, as every item is only extracted #
+    # when explicitly asked for #
+    if bool(args.targets) == bool(selectors):
+        return {'command': 'extract', 'results': [
+            {'target': None, 'ok': False, 'error': 'Pass either targets or --glob, --type, --all'}]}
+
+    missing, refused = [], []
+    items = select_items(connection, args.targets or None, args.glob, args.ext_type, missing)
+
+    # If the items are to be streamed into an archive #
+    if args.tar:
+        try:
+            results = [{'target': name, 'ok': True, 'path': str(args.tar)}
+                       for name in extract_tar(connection, items, args.tar, refused)]
+            results += [{'target': name, 'ok': False, 'error': 'Unsafe file name'}
+                        for name in refused]
+
+        # If the archive could not be written #
+        except (OSError, ValueError) as tar_err:
+            logging.error('Error occurred writing archive: %s', tar_err)
+            results = [{'target': str(args.tar), 'ok': False, 'error': str(tar_err)}]
+    # If the items are to be extracted to the destination directory #
+    else:
+        results = [{'target': name, 'ok': True, 'path': str(args.dest / name)} if error is None
+                   else {'target': name, 'ok': False, 'error': error}
+                   for name, error in extract_files(connection, items, args.dest, args.workers)]
+
+    results += [{'target': target, 'ok': False, 'error': 'Not found'} for target in missing]
+
+    return {'command': 'extract', 'results': results}
+
+
+def cmd_delete(connection, args) -> dict:
+    """
+    Deletes the target items from the storage database.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    results = []
+
+    # Iterate through the target names or ids #
+    for target in args.targets:
+        row, name = locate(connection, target)
+        # If the item is not stored #
+        if not row:
+            results.append({'target': target, 'ok': False, 'error': 'Not found'})
+            continue
+
+        delete_file_row(connection, row[0])
+        results.append({'target': target, 'ok': True, 'name': name})
+
+    return {'command': 'delete', 'results': results}
+
+
+def cmd_list(connection, args) -> dict:
+    """
+    Lists the stored items matching the filters.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    filters = {'ext_type': args.ext_type, 'path': args.path, 'name': args.name,
+               'size_min': args.size_min, 'size_max': args.size_max,
+               'mtime_min': args.mtime_min, 'mtime_max': args.mtime_max}
+
+    # If the listing is limited, fetch a single keyset page #
+    if args.limit is not None:
+        rows = list_files(connection, args.after, args.limit, **filters)
+    # If every matching item is to be listed #
+    else:
+        rows = list(iter_files(connection, after_id=args.after, **filters))
+
+    return {'command': 'list', 'files': [dict(zip(LIST_KEYS, row)) for row in rows]}
+
+
+def cmd_stats(connection, args) -> dict:
+    """
+    Gathers the storage statistics.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    return {'command': args.command, **get_stats(connection)}
+
+
+def cmd_search(connection, args) -> dict:
+    """
+    Searches the stored text files, best match first.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    rows = search(connection, args.query, args.limit)
+    return {'command': 'search', 'query': args.query,
+            'matches': [dict(zip(SEARCH_KEYS, row)) for row in rows]}
+
+
+def cmd_reindex(connection, args) -> dict:
+    """
+    Rebuilds the full-text index of the stored text files.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    return {'command': args.command, 'indexed': rebuild_index(connection)}
+
+
+def cmd_similar(connection, args) -> dict:
+    """
+    Finds the stored images within a Hamming distance of the perceptual hash of the target, an
+    image file on disk or a stored image, without decoding any stored image.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    result = {'command': 'similar', 'target': args.target, 'matches': []}
+    source, file_id = Path(args.target), None
+
+    # If the target is an image file on disk #
+    if source.is_file():
+        phash = dhash_file(source)
+        error = 'Unable to decode image file'
+    # If the target is a stored image #
+    else:
+        row, _ = locate(connection, args.target)
+        # If the item is not stored #
+        if not row:
+            result['results'] = [{'target': args.target, 'ok': False, 'error': 'Not found'}]
+            return result
+
+        file_id = row[0]
+        stored = query_handler(connection, query_phash_fetch(), file_id, fetch='one')
+        phash = stored[0] if stored else None
+        error = 'No perceptual hash, undecodable or not yet backfilled'
+
+    # If the target could not be hashed #
+    if phash is None:
+        result['results'] = [{'target': args.target, 'ok': False, 'error': error}]
+        return result
+
+    result['matches'] = [dict(zip(SIMILAR_KEYS, row))
+                         for row in similar(connection, phash, args.distance, args.limit, file_id)]
+    return result
+
+
+def cmd_backfill(connection, args) -> dict:
+    """
+    Computes the perceptual hash of the stored images lacking one.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    hashed, skipped = backfill_phashes(connection)
+    return {'command': args.command, 'hashed': hashed, 'undecodable': skipped}
+
+
+def shard_store(store: ShardedStore, args) -> dict:
+    """
+    Stores the target files and the supported files of target directories in the shards their
+    names are routed to, each shard being written in parallel.
+
+    :param store:  The sharded store.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    results = []
+    walk = {'include': args.include, 'exclude': args.exclude,
+            'max_depth': None if args.recursive else 0}
+    stored, failed = store.store_files(collect_jobs(args.targets, results, walk))
+
+    results += [{'target': str(source), 'ok': True} for source in stored]
+    results += [{'target': str(source), 'ok': False, 'error': 'Not stored'} for source in failed]
+
+    return {'command': 'shard store', 'results': results}
+
+
+def shard_extract(store: ShardedStore, args) -> dict:
+    """
+    Extracts the target items, or the items selected by glob, type or all at once, from the
+    shards to the destination directory.
+
+    :param store:  The sharded store.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    # If nothing or both targets and a selection were passed #
+    if bool(args.targets) == bool(args.glob or args.ext_type or args.all):
+        return {'command': 'shard extract', 'results': [
+            {'target': None, 'ok': False, 'error': 'Pass either targets or --glob, --type, --all'}]}
+
+    results = store.extract(args.dest, args.targets or None, args.glob, args.ext_type)
+
+    return {'command': 'shard extract', 'results': [
+        {'target': name, 'ok': True, 'path': str(args.dest / name)} if error is None
+        else {'target': name, 'ok': False, 'error': error} for name, error in results]}
+
+
+def shard_delete(store: ShardedStore, args) -> dict:
+    """
+    Deletes the target items from the shards holding them.
+
+    :param store:  The sharded store.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    results = []
+    # Iterate through the target names #
+    for target in args.targets:
+        try:
+            store.delete(target)
+
+        # If no shard holds the item #
+        except KeyError:
+            results.append({'target': target, 'ok': False, 'error': 'Not found'})
+            continue
+
+        results.append({'target': target, 'ok': True})
+
+    return {'command': 'shard delete', 'results': results}
+
+
+def shard_list(store: ShardedStore, args) -> dict:
+    """
+    Lists the stored items matching the filters across the shards, ordered by name.
+
+    :param store:  The sharded store.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    return {'command': 'shard list',
+            'files': store.list(args.limit, ext_type=args.ext_type, name=args.name)}
+
+
+def shard_search(store: ShardedStore, args) -> dict:
+    """
+    Full-text searches the stored text files across the shards.
+
+    :param store:  The sharded store.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    return {'command': 'shard search', 'query': args.query,
+            'matches': store.search(args.query, args.limit)}
+
+
+def shard_stats(store: ShardedStore, args) -> dict:
+    """
+    Gathers the storage statistics combined across the shards.
+
+    :param store:  The sharded store.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    return {'command': 'shard stats', **store.stats()}
+
+
+def shard_rebalance(store: ShardedStore, args) -> dict:
+    """
+    Changes the shard count, moving the items routed to another shard.
+
+    :param store:  The sharded store.
+    :param args:  The parsed command arguments.
+    :return:  The JSON result document.
+    """
+    result = store.rebalance(args.count)
+    return {'command': 'shard rebalance', **result, 'results': [
+        {'target': name, 'ok': False, 'error': 'Name held by another item on its new shard'}
+        for name in result['conflicts']]}
+
+
+# Handler of each subcommand #
+COMMANDS = {'store': cmd_store, 'sync': cmd_sync, 'extract': cmd_extract, 'delete': cmd_delete,
+            'list': cmd_list, 'stats': cmd_stats, 'search': cmd_search, 'reindex': cmd_reindex,
+            'similar': cmd_similar, 'backfill': cmd_backfill}
+# Handler of each shard action #
+SHARD_ACTIONS = {'store': shard_store, 'extract': shard_extract, 'delete': shard_delete,
+                 'list': shard_list, 'search': shard_search, 'stats': shard_stats,
+                 'rebalance': shard_rebalance}
+
+
+def run_cli(argv: list, db_file: Path, dock_path: Path) -> int:
+    """
+    Runs a single non-interactive command, printing its result as a JSON document on stdout.
+    There are no prompts, banners or delays.
+
+    :param argv:  The command line arguments.
+    :param db_file:  The path to the storage database.
+    :param dock_path:  The default directory files are extracted to.
+    :return:  The exit code, 0 on success, 2 on database error, 5 if any target failed.
+    """
+    parser = build_parser(dock_path)
+    args = parser.parse_args(argv)
+    exists = db_file.exists()
+
+    # If no profile was passed, the one of the environment is checked as the choices are #
+    if args.profile is None and (profile_err := check_env_profile()):
+        parser.error(profile_err)
+
+    # If the queries are to be instrumented #
+    if args.instrument or args.slow_ms is not None:
+        QUERY_STATS.enable(args.slow_ms, args.slow_log)
+
+    # If the database is to be served until interrupted #
+    if args.command == 'serve':
+        # The server and asyncio are only imported when serving, keeping other commands fast #
+        import asyncio
+        from Modules.server import MAX_CLIENTS, SERVER_READERS, serve
+
+        try:
+            asyncio.run(serve(db_file, args.host, args.port, args.socket,
+                              args.readers or SERVER_READERS, args.max_clients or MAX_CLIENTS,
+                              args.profile, args.cache_mb * 1024 * 1024))
+
+        # If Ctrl + C is detected #
+        except KeyboardInterrupt:
+            pass
+
+        return 0
+
+    try:
+        # If the command runs against the sharded layout #
+        if args.command == 'shard':
+            try:
+                store = ShardedStore(db_file, args.shards, profile=args.profile)
+
+            # If the shard count does not match the existing sharded layout #
+            except ValueError as layout_err:
+                print(json.dumps({'command': 'shard', 'ok': False, 'error': str(layout_err)}))
+                return 2
+
+            with store:
+                return finish(SHARD_ACTIONS[args.action](store, args))
+
+        with DbConnectionHandler(db_file, args.profile) as connection:
+            # Send any migration progress to stderr #
+            with redirect_stdout(sys.stderr):
+                # If the database does not exist yet #
+                if not exists:
+                    create_db(connection)
+                # If the database exists, migrate legacy schema to the current version #
+                else:
+                    migrate_db(connection)
+
+            result = COMMANDS[args.command](connection, args)
+
+    # If any sqlite3 error occurs during database operation #
+    except sqlite3.Error as db_err:
+        db_error_query(db_err)
+        print(json.dumps({'command': args.command, 'ok': False, 'error': str(db_err)}))
+        return 2
+
+    return finish(result)
+
+
+def finish(result: dict) -> int:
+    """
+    Prints the JSON result document of a command.
+
+    :param result:  The JSON result document.
+    :return:  The exit code, 0 on success or 5 if any target failed.
+    """
+    result['ok'] = all(item['ok'] for item in result.get('results', ()))
+    # If the queries are instrumented #
+    if QUERY_STATS.enabled:
+        result['queries'] = QUERY_STATS.dump()
+
+    print(json.dumps(result))
+
+    return 0 if result['ok'] else EXIT_PARTIAL
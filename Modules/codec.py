@@ -0,0 +1,90 @@
+""" Built-in modules """
+import hashlib
+import lzma
+import zlib
+
+
+# Codec applied to chunks of each storage type, images are already compressed #
+CODEC_POLICY = {'TEXT': 'zlib', 'IMAGE': 'none'}
+# Default compression level per codec, lower is faster and higher is smaller #
+CODEC_LEVELS = {'zlib': 6, 'lzma': 6}
+
+
+def compress(data, codec: str, level: int) -> bytes:
+    """
+    Compresses data with the named stdlib codec.
+
+    :param data:  The bytes to be compressed.
+    :param codec:  The codec name (zlib or lzma).
+    :param level:  The compression level, zlib 0-9 or lzma preset 0-9.
+    :return:  The compressed bytes.
+    """
+    # If zlib codec #
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    # If lzma codec #
+    if codec == 'lzma':
+        return lzma.compress(data, preset=level)
+
+    raise ValueError(f'Unsupported codec: {codec}')
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    """
+    Decompresses data stored with the named codec.
+
+    :param data:  The stored bytes.
+    :param codec:  The codec the data was stored with (none, zlib or lzma).
+    :return:  The original bytes.
+    """
+    # If the data was stored uncompressed #
+    if codec == 'none':
+        return data
+    # If zlib codec #
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    # If lzma codec #
+    if codec == 'lzma':
+        return lzma.decompress(data)
+
+    raise ValueError(f'Unsupported codec: {codec}')
+
+
+def prepare_chunk(data, ext_type: str, level=None) -> tuple:
+    """
+    Hashes a raw chunk and compresses it with the codec chosen by policy for its storage type.
+    Chunks that do not shrink are kept uncompressed. The raw bytes of TEXT chunks are kept so
+    they can be full-text indexed without decompressing them again.
+
+    :param data:  The raw chunk bytes.
+    :param ext_type:  The storage type of the file (TEXT or IMAGE).
+    :param level:  The compression level, None for the codec default.
+    :return:  Tuple of (SHA-256 hex digest, raw size, codec, stored bytes, raw bytes of TEXT
+              chunks or None).
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    codec = CODEC_POLICY.get(ext_type, 'none')
+    text = data if ext_type == 'TEXT' else None
+
+    # If the storage type is compressed by policy #
+    if codec != 'none':
+        packed = compress(data, codec, CODEC_LEVELS[codec] if level is None else level)
+        # If compression shrank the chunk #
+        if len(packed) < len(data):
+            return digest, len(data), codec, packed, text
+
+    return digest, len(data), 'none', data, text
+
+
+def prepare_chunks(chunks, ext_type: str, level=None):
+    """
+    Lazily hashes and compresses raw chunks for storage.
+
+    :param chunks:  Iterable of raw chunk bytes in file order.
+    :param ext_type:  The storage type of the file (TEXT or IMAGE).
+    :param level:  The compression level, None for the codec default.
+    :return:  Generator of prepared chunk tuples.
+    """
+    # Iterate through the raw chunks preparing each in turn #
+    for data in chunks:
+        yield prepare_chunk(data, ext_type, level)
@@ -0,0 +1,332 @@
+""" Built-in modules """
+import logging
+import os
+import queue
+import sqlite3
+import tarfile
+import threading
+from pathlib import Path
+# Custom Modules #
+from Modules.catalog import check_name, iter_files, resolve_id
+from Modules.ingest import QUEUE_DEPTH, queue_get, queue_put
+from Modules.storage import iter_content
+from Modules.utils import DbConnectionHandler, query_db_file, query_handler, query_item_extract
+
+
+# Default number of extraction threads, one per CPU core #
+EXTRACT_WORKERS = os.cpu_count() or 1
+# Archive write modes by suffix, tarfile stream modes never seek the output #
+TAR_MODES = {'.tar': 'w|', '.tar.gz': 'w|gz', '.tgz': 'w|gz'}
+# Permissions of the archive members, the umask applying when they are unpacked #
+MEMBER_MODE = 0o644
+
+
+class ContentReader:
+    """ File-like reader over the content chunks of a stored item, for tarfile to copy from. """
+    def __init__(self, chunks):
+        """
+        Content reader initializer.
+
+        :param chunks:  Iterable of content byte chunks in file order.
+        """
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b'')
+        self.offset = 0
+
+    def read(self, size=-1) -> bytes:
+        """
+        Reads up to size bytes, fewer only once the content is exhausted. Chunks are sliced
+        through a memoryview so no chunk is copied more than once.
+
+        :param size:  The number of bytes to be read, negative for the rest of the content.
+        :return:  The bytes read, empty once the content is exhausted.
+        """
+        pieces, wanted = [], size
+        # Gather slices of chunks until enough bytes are read or the content is exhausted #
+        while wanted != 0:
+            # If the current chunk is used up, move to the next one #
+            if self.offset >= len(self.chunk):
+                chunk = next(self.chunks, None)
+                # If the content is exhausted #
+                if chunk is None:
+                    break
+
+                self.chunk, self.offset = memoryview(chunk), 0
+
+            end = len(self.chunk) if wanted < 0 else min(len(self.chunk), self.offset + wanted)
+            pieces.append(self.chunk[self.offset:end])
+            wanted -= end - self.offset if wanted > 0 else 0
+            self.offset = end
+
+        return b''.join(pieces)
+
+
+def select_items(connection, names=None, pattern=None, ext_type=None, missing=None):
+    """
+    Lazily selects the stored items to be extracted, either by name or id, or by name glob and
+    storage type, every item being selected when neither is set. Matching items are fetched one
+    keyset page at a time.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param names:  Iterable of stored file names or ids, None to select by glob and type.
+    :param pattern:  Name glob the selected items match, a name without glob characters being
+                     matched as a prefix, None for any name.
+    :param ext_type:  The storage type of the selected items (TEXT or IMAGE), None for any type.
+    :param missing:  List the names or ids with no stored item are appended to.
+    :return:  Generator of (id, name, size, mtime) rows.
+    """
+    # If the items are selected by glob and type #
+    if names is None:
+        # Iterate through the matching items page by page #
+        for file_id, name, _, _, size, mtime, _ in iter_files(connection, name=pattern,
+                                                               ext_type=ext_type):
+            yield file_id, name, size, mtime
+
+        return
+
+    # Iterate through the target names or ids #
+    for target in names:
+        # If the target is a listed id, resolve its name #
+        name = resolve_id(connection, int(target)) if str(target).isdigit() else target
+        row = query_handler(connection, query_item_extract(), name, fetch='one') \
+            if name else None
+        # If the item is not stored #
+        if not row:
+            # If the missing targets are collected #
+            if missing is not None:
+                missing.append(target)
+            continue
+
+        yield row
+
+
+def tar_mode(tar_path: Path):
+    """
+    Gets the tarfile write mode of an archive path from its suffixes, .gz only being an archive
+    as part of .tar.gz.
+
+    :param tar_path:  The path of the archive.
+    :return:  The tarfile stream mode, None if the path is not a supported archive.
+    """
+    suffix = ''.join(tar_path.suffixes[-2:]) if tar_path.suffix == '.gz' else tar_path.suffix
+    return TAR_MODES.get(suffix)
+
+
+def extract_target(dest_root: Path, name: str) -> Path:
+    """
+    Builds the path a stored item is extracted to, creating the subdirectories of a nested name.
+    Unsafe names and paths resolving outside the destination, through a link for instance, are
+    refused.
+
+    :param dest_root:  The resolved destination directory.
+    :param name:  The stored file name.
+    :return:  The resolved path the item is extracted to.
+    """
+    extract_path = (dest_root / check_name(name)).resolve()
+    # If the path escapes the destination directory #
+    if not extract_path.is_relative_to(dest_root):
+        raise ValueError(f'Extract path of {name!r} is outside {dest_root}')
+
+    extract_path.parent.mkdir(parents=True, exist_ok=True)
+    return extract_path
+
+
+def open_temp(final_path: Path) -> tuple:
+    """
+    Creates a temp file alongside the path it is renamed to once complete. Unlike mkstemp's
+    0600, the file gets the regular new file permissions from the current umask, which is
+    applied by the operating system rather than read from the process.
+
+    :param final_path:  The path the temp file is renamed to.
+    :return:  Tuple of (file descriptor opened for binary writes, temp path).
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    # Draw random names until one is free #
+    while True:
+        temp_path = final_path.parent / f'.{final_path.name}.{os.urandom(4).hex()}.part'
+        try:
+            return os.open(temp_path, flags, 0o666), temp_path
+
+        # If the name is taken, draw another #
+        except FileExistsError:
+            continue
+
+
+def stream_extract(connection, file_id: int, extract_path: Path):
+    """
+    Streams the content of a stored item to a temp file in the destination directory, which is
+    atomically renamed to the extract path once complete. Memory use is bounded by the chunk
+    size regardless of file size and an existing file is replaced rather than appended to.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param file_id:  The id of the stored item.
+    :param extract_path:  The path the item is extracted to.
+    :return:  Nothing
+    """
+    # Create the temp file alongside the destination so the rename stays on one filesystem #
+    file_desc, temp_path = open_temp(extract_path)
+    try:
+        with os.fdopen(file_desc, 'wb') as out_file:
+            # Iterate through the content chunks and write them out #
+            for chunk in iter_content(connection, file_id):
+                out_file.write(chunk)
+
+        # Move the complete file into place #
+        os.replace(temp_path, extract_path)
+
+    # If any error occurs, remove the partial temp file #
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+
+
+def open_readers(connection, count: int) -> list:
+    """
+    Opens read-only connections to the database file of a connection, to be handed to other
+    threads.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param count:  The number of connections to be opened.
+    :return:  List of the connection handlers, empty if the database is not backed by a file.
+    """
+    db_file = query_handler(connection, query_db_file(), fetch='one')[0]
+    # If the database is in memory or temporary #
+    if not db_file:
+        return []
+
+    return [DbConnectionHandler(f'{Path(db_file).as_uri()}?mode=ro', uri=True,
+                                check_same_thread=False) for _ in range(count)]
+
+
+def extract_files(connection, items, dest_path: Path, workers=EXTRACT_WORKERS,
+                  queue_depth=QUEUE_DEPTH) -> list:
+    """
+    Extracts stored items to a directory. With more than one worker, the calling thread feeds the
+    selected items into a bounded queue drained by a pool of threads that each stream items to
+    disk over their own read-only connection, so memory stays bounded by the queue depth and
+    chunk size however many items are selected.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param items:  Iterable of (id, name, size, mtime) rows, see select_items.
+    :param dest_path:  The directory the items are extracted to.
+    :param workers:  The number of extraction threads, 1 or less extracts on the calling thread.
+    :param queue_depth:  The max number of items queued for the extraction threads.
+    :return:  List of (name, error) results, error being None for extracted items.
+    """
+    results = []
+    dest_root = dest_path.resolve()
+
+    def extract(reader, item):
+        try:
+            # Stream the content to disk in fixed-size chunks, under the destination only #
+            stream_extract(reader, item[0], extract_target(dest_root, item[1]))
+
+        # If the name is unsafe, or error occurs during file operation or reading the database #
+        except (ValueError, OSError, sqlite3.Error) as extract_err:
+            logging.error('Error occurred extracting %s: %s', item[1], extract_err)
+            results.append((item[1], str(extract_err)))
+            return
+
+        results.append((item[1], None))
+
+    readers = open_readers(connection, workers) if workers > 1 else []
+    # If the items are to be extracted on the calling thread #
+    if not readers:
+        # Iterate through the items extracting each in turn #
+        for item in items:
+            extract(connection, item)
+
+        return results
+
+    item_queue = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+
+    def work(reader):
+        # Extract items until the feeder signals the end or the pipeline is shut down #
+        while (item := queue_get(item_queue, stop)) is not None:
+            extract(reader, item)
+
+    threads = [threading.Thread(target=work, args=(handler.connection,), daemon=True)
+               for handler in readers]
+    # Iterate through the extraction threads and start them #
+    for thread in threads:
+        thread.start()
+
+    try:
+        # Iterate through the items queueing them for the extraction threads #
+        for item in items:
+            queue_put(item_queue, item, stop)
+
+        # Signal each extraction thread there are no more items #
+        for _ in threads:
+            queue_put(item_queue, None, stop)
+
+        # Wait for the queued items to be extracted #
+        for thread in threads:
+            thread.join()
+
+    finally:
+        # Shut down the pipeline so no thread stays blocked on the queue #
+        stop.set()
+        # Wait for the items being extracted before closing the read-only connections #
+        for thread in threads:
+            thread.join()
+
+        # Iterate through the read-only connections and close them #
+        for handler in readers:
+            handler.__exit__(None, None, None)
+
+    return results
+
+
+def extract_tar(connection, items, tar_path: Path, refused=None) -> list:
+    """
+    Streams stored items into a single tar archive, gzip compressed if the path ends with .tar.gz
+    or .tgz. Content goes from the database into the archive one chunk at a time without staging
+    files on disk, and the archive is written to a temp file atomically renamed once complete.
+    Items with an absolute name or a name with .. parts are left out, so the archive cannot
+    write outside the directory it is unpacked in.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param items:  Iterable of (id, name, size, mtime) rows, see select_items.
+    :param tar_path:  The path of the archive to be written.
+    :param refused:  List the names of the items left out as unsafe are appended to.
+    :return:  List of the names of the archived items.
+    """
+    mode = tar_mode(tar_path)
+    # If the archive suffix is not supported #
+    if not mode:
+        raise ValueError(f'Unsupported archive suffix of {tar_path.name}, use .tar, .tar.gz or '
+                         '.tgz')
+
+    file_desc, temp_path = open_temp(tar_path)
+    archived = []
+    try:
+        with os.fdopen(file_desc, 'wb') as out_file, \
+                tarfile.open(fileobj=out_file, mode=mode) as archive:
+            # Iterate through the items adding each to the archive #
+            for file_id, name, size, mtime in items:
+                try:
+                    member = tarfile.TarInfo(check_name(name))
+
+                # If the name is not safe to be unpacked #
+                except ValueError as name_err:
+                    logging.error('Error occurred archiving item: %s', name_err)
+                    # If the refused names are collected #
+                    if refused is not None:
+                        refused.append(name)
+                    continue
+
+                member.size, member.mtime, member.mode = size, mtime or 0, MEMBER_MODE
+                archive.addfile(member, ContentReader(iter_content(connection, file_id)))
+                archived.append(name)
+
+        # Move the complete archive into place #
+        os.replace(temp_path, tar_path)
+
+    # If any error occurs, remove the partial archive #
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+
+    return archived
@@ -0,0 +1,436 @@
+""" Built-in modules """
+import io
+import os
+from contextlib import nullcontext, redirect_stdout
+from pathlib import Path
+# Custom Modules #
+from Modules.cache import ContentCache
+from Modules.catalog import LIST_KEYS, check_name, iter_files, resolve_id
+from Modules.codec import prepare_chunks
+from Modules.extract import EXTRACT_WORKERS, extract_files, extract_tar, select_items
+from Modules.ingest import EXTENSIONS, STREAM_THRESHOLD, read_chunks
+from Modules.migrate import create_db, migrate_db
+from Modules.phash import SIMILAR_DISTANCE, SIMILAR_KEYS, SIMILAR_LIMIT, backfill_phashes, \
+                          dhash_bytes, dhash_file, similar
+from Modules.pool import BUSY_TIMEOUT, WAL_AUTOCHECKPOINT, ConnectionPool
+from Modules.search import SEARCH_KEYS, SEARCH_LIMIT, rebuild_index, search
+from Modules.sync import sync_dir
+from Modules.storage import delete_file_row, get_stats, insert_file, iter_content, \
+                            split_payload, store_phash
+from Modules.utils import DbConnectionHandler, query_handler, query_item_locate, \
+                          query_item_version, query_phash_fetch, query_wal_checkpoint
+
+
+class FileStore:
+    """ Embeddable storage database API holding one connection open for its whole lifetime. """
+    def __init__(self, db_file, level=None, readers=0, busy_timeout=BUSY_TIMEOUT,
+                 autocheckpoint=WAL_AUTOCHECKPOINT, profile=None, cache_bytes=0):
+        """
+        File store initializer, creating or migrating the storage database. Migration progress is
+        discarded since the store does no terminal I/O. With readers set, the store runs in
+        concurrent mode: the database is switched to WAL journaling, writes go through a single
+        writer connection and get, list and stats borrow from a bounded pool of read-only
+        connections, so the store can be shared by threads.
+
+        :param db_file:  The path to the storage database.
+        :param level:  The compression level, None for the codec default.
+        :param readers:  The number of pooled read-only connections, 0 for a single connection.
+        :param busy_timeout:  Milliseconds a statement waits on a locked database in concurrent
+                              mode.
+        :param autocheckpoint:  WAL pages that trigger an automatic checkpoint in concurrent
+                                mode, 0 to only checkpoint when requested.
+        :param profile:  The name of the performance profile, None for the default.
+        :param cache_bytes:  The memory budget of the cache of decoded content served by get, 0
+                             to read every item from the database.
+        """
+        exists = Path(db_file).exists()
+        self.level = level
+        self.pool = None
+        self.cache = ContentCache(cache_bytes) if cache_bytes else None
+
+        # If the store is to be shared by concurrent readers #
+        if readers > 0:
+            self.pool = ConnectionPool(db_file, readers, busy_timeout, autocheckpoint,
+                                       profile)
+            self.handler = self.pool.write_handler
+        # If the store uses a single connection #
+        else:
+            self.handler = DbConnectionHandler(db_file, profile)
+
+        self.connection = self.handler.connection
+
+        with redirect_stdout(io.StringIO()):
+            # If the database does not exist yet #
+            if not exists:
+                create_db(self.connection)
+            # If the database exists, migrate legacy schema to the current version #
+            else:
+                migrate_db(self.connection)
+
+    def __enter__(self):
+        """
+        Method for managing what is returned into the context manager as proxy variable(store).
+
+        :return:  The file store instance.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        """
+        Method for handling the events that occurs when exiting context manager, closing the
+        connection.
+
+        :param exc_type:  The exception type.
+        :param exc_val:  The exception value.
+        :param traceback:  Exception traceback occurrence in stack.
+        """
+        self.close()
+
+    def close(self):
+        """
+        Closes the database connections.
+
+        :return:  Nothing
+        """
+        # If the store is in concurrent mode #
+        if self.pool:
+            self.pool.close()
+        # If the store uses a single connection #
+        else:
+            self.handler.__exit__(None, None, None)
+
+    def reading(self):
+        """
+        Context giving a connection to read with, borrowed from the pool in concurrent mode.
+
+        :return:  Context yielding the connection.
+        """
+        return self.pool.reader() if self.pool else nullcontext(self.connection)
+
+    def writing(self):
+        """
+        Context giving the connection to write with, held exclusively in concurrent mode.
+
+        :return:  Context yielding the connection.
+        """
+        return self.pool.writer() if self.pool else nullcontext(self.connection)
+
+    def checkpoint(self, mode='PASSIVE') -> tuple:
+        """
+        Checkpoints the write-ahead log into the database, for use when automatic checkpoints
+        are disabled or the log is to be truncated.
+
+        :param mode:  The checkpoint mode (PASSIVE, FULL, RESTART or TRUNCATE).
+        :return:  Tuple of (busy flag, pages in the log, pages checkpointed).
+        """
+        with self.writing() as connection:
+            return query_handler(connection, query_wal_checkpoint(mode), fetch='one')
+
+    @staticmethod
+    def locate(connection, target) -> tuple:
+        """
+        Locates a stored item by its name or id.
+
+        :param connection:  The database connection to be interacted with.
+        :param target:  The stored file name or integer id.
+        :return:  Tuple of (id, path, ext, size).
+        """
+        name = resolve_id(connection, target) if isinstance(target, int) else target
+        row = query_handler(connection, query_item_locate(), name, fetch='one')
+
+        # If the item is not stored #
+        if not row:
+            raise KeyError(target)
+
+        return row
+
+    def put(self, source, name=None, ext_type=None) -> int:
+        """
+        Stores a file from disk, streamed in chunks, an in-memory payload, or an iterable of raw
+        chunks in one transaction. Images are given their perceptual hash, images given in
+        chunks only up to the stream threshold as they are held in memory to be decoded.
+
+        :param source:  The path of the file to be stored, its content bytes, or an iterable of
+                        its content in CHUNK_SIZE chunks (the last one may be shorter).
+        :param name:  The name the item is stored under, defaults to the file name for paths.
+                      Absolute names and names with . or .. parts raise ValueError.
+        :param ext_type:  The storage type (TEXT or IMAGE), defaults to the one of the name
+                          extension.
+        :return:  The id of the stored item.
+        """
+        # If the source is a file on disk #
+        if isinstance(source, (str, os.PathLike)):
+            source = Path(source)
+            name = name or source.name
+            path, mtime = str(source.absolute().parent), source.stat().st_mtime
+            chunks = read_chunks(source)
+        # If the content was not given a name #
+        elif name is None:
+            raise ValueError('A name is required to store in-memory content')
+        # If the source is in-memory content #
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            path, mtime = '', None
+            chunks = split_payload(source)
+        # If the source is already split into chunks #
+        else:
+            path, mtime, chunks = '', None, source
+
+        # Names become paths once extracted, so refuse any that could escape the destination #
+        check_name(name)
+        ext_type = ext_type or EXTENSIONS.get(Path(name).suffix[1:].lower())
+        # If the storage type could not be determined #
+        if ext_type not in ('TEXT', 'IMAGE'):
+            raise ValueError(f'Unsupported file type: {name}')
+
+        # Chunks of an image given as an iterable, held to be hashed unless over the threshold #
+        held = [] if ext_type == 'IMAGE' and not isinstance(source, (Path, bytes, bytearray,
+                                                                     memoryview)) else None
+
+        def tap(items):
+            nonlocal held
+            # Iterate through the raw chunks holding a copy while the image is small enough #
+            for chunk in items:
+                # If the image is still being held #
+                if held is not None:
+                    held.append(bytes(chunk))
+                    # If the image is too large to be hashed in memory, leave it to the backfill #
+                    if sum(map(len, held)) > STREAM_THRESHOLD:
+                        held = None
+
+                yield chunk
+
+        with self.writing() as connection, connection:
+            file_id = insert_file(connection, name, path, ext_type,
+                                  prepare_chunks(tap(chunks), ext_type, self.level), mtime)
+            # If the stored file is an image read from disk #
+            if ext_type == 'IMAGE' and isinstance(source, Path):
+                store_phash(connection, file_id, dhash_file(source))
+            # If the stored file is an image held in memory #
+            elif ext_type == 'IMAGE' and isinstance(source, (bytes, bytearray, memoryview)):
+                store_phash(connection, file_id, dhash_bytes(source))
+            # If the stored file is an image given in chunks small enough to be held #
+            elif held is not None:
+                store_phash(connection, file_id, dhash_bytes(b''.join(held)))
+
+        # If content is cached, drop any entry left under the name #
+        if self.cache:
+            self.cache.invalidate(name)
+
+        return file_id
+
+    def sync(self, dir_path, prune=False) -> dict:
+        """
+        Stores the new and changed files of a directory, skipping the unchanged ones without
+        reading them (see sync.sync_dir).
+
+        :param dir_path:  The directory to be synced.
+        :param prune:  If set to True, items whose source file disappeared are deleted.
+        :return:  Dict of the sync results.
+        """
+        with self.writing() as connection, redirect_stdout(io.StringIO()):
+            result = sync_dir(connection, dir_path, prune, level=self.level)
+
+        # If content is cached, drop the entries of pruned items, replaced ones being stale #
+        if self.cache:
+            # Iterate through the names of the pruned items #
+            for name in result['removed']:
+                self.cache.invalidate(name)
+
+        return result
+
+    def get(self, target):
+        """
+        Streams the content of a stored item one chunk at a time. The item is located before
+        returning, so a missing item raises KeyError right away.
+
+        :param target:  The stored file name or integer id.
+        :return:  Generator of content byte chunks in file order.
+        """
+        stream = self.stream(target)
+        # Run the stream up to the item lookup #
+        next(stream)
+
+        return stream
+
+    def stream(self, target):
+        """
+        Generator locating a stored item and reassembling its content. The first value yielded is
+        None once the item is located, a borrowed connection being held until exhausted. With the
+        cache enabled, content cached under the stored content hash is served without reading the
+        chunks, and items small enough to be cached are read whole and cached.
+
+        :param target:  The stored file name or integer id.
+        :return:  Generator of None followed by the content byte chunks in file order.
+        """
+        # If content is not cached #
+        if not self.cache:
+            with self.reading() as connection:
+                file_id = self.locate(connection, target)[0]
+                yield None
+                yield from iter_content(connection, file_id)
+
+            return
+
+        with self.reading() as connection:
+            name = resolve_id(connection, target) if isinstance(target, int) else target
+            row = query_handler(connection, query_item_version(), name, fetch='one')
+            # If the item is not stored #
+            if not row:
+                raise KeyError(target)
+
+            file_id, version, size = row
+            chunks = self.cache.get(name, version)
+            yield None
+
+            # If the content is not cached and too large to be #
+            if chunks is None and size > self.cache.max_item_bytes:
+                yield from iter_content(connection, file_id)
+                return
+
+            # If the content is to be read and cached #
+            if chunks is None:
+                chunks = list(iter_content(connection, file_id))
+                self.cache.put(name, version, chunks)
+
+        yield from chunks
+
+    def cache_stats(self) -> dict:
+        """
+        Gathers the hit, miss, eviction and invalidation counters of the content cache.
+
+        :return:  Dict of the cache counters, empty if content is not cached.
+        """
+        return self.cache.stats() if self.cache else {}
+
+    def extract(self, dest_path, names=None, pattern=None, ext_type=None,
+                workers=EXTRACT_WORKERS) -> list:
+        """
+        Extracts stored items to a directory on a bounded pool of threads, each reading over its
+        own read-only connection.
+
+        :param dest_path:  The directory the items are extracted to.
+        :param names:  Iterable of stored file names or ids, None to select by glob and type.
+        :param pattern:  Name glob of the items extracted, None for any name.
+        :param ext_type:  The storage type of the items extracted, None for any type.
+        :param workers:  The number of extraction threads.
+        :return:  List of (name, error) results, error being None for extracted items and
+                  'Not found' for names or ids not stored.
+        """
+        missing = []
+        with self.reading() as connection:
+            results = extract_files(connection, select_items(connection, names, pattern,
+                                                             ext_type, missing),
+                                    Path(dest_path), workers)
+
+        return results + [(target, 'Not found') for target in missing]
+
+    def archive(self, tar_path, names=None, pattern=None, ext_type=None) -> list:
+        """
+        Streams stored items into a single tar archive, gzip compressed if the path ends with
+        .tar.gz or .tgz. Names or ids not stored are skipped.
+
+        :param tar_path:  The path of the archive to be written.
+        :param names:  Iterable of stored file names or ids, None to select by glob and type.
+        :param pattern:  Name glob of the items archived, None for any name.
+        :param ext_type:  The storage type of the items archived, None for any type.
+        :return:  List of the names of the archived items.
+        """
+        with self.reading() as connection:
+            return extract_tar(connection, select_items(connection, names, pattern, ext_type),
+                               Path(tar_path))
+
+    def delete(self, target):
+        """
+        Deletes a stored item, garbage-collecting content no longer referenced.
+
+        :param target:  The stored file name or integer id.
+        :return:  Nothing
+        """
+        with self.writing() as connection:
+            name = resolve_id(connection, target) if isinstance(target, int) else target
+            delete_file_row(connection, self.locate(connection, target)[0])
+
+        # If content is cached, drop the entry of the deleted item #
+        if self.cache:
+            self.cache.invalidate(name)
+
+    def list(self, **filters):
+        """
+        Lazily lists the metadata of the stored items matching the filters.
+
+        :param filters:  Keyword listing filters and paging arguments (see catalog.iter_files).
+        :return:  Generator of item metadata dicts.
+        """
+        with self.reading() as connection:
+            # Iterate through the matching items page by page #
+            for row in iter_files(connection, **filters):
+                yield dict(zip(LIST_KEYS, row))
+
+    def search(self, query: str, limit=SEARCH_LIMIT) -> list:
+        """
+        Full-text searches the stored TEXT items.
+
+        :param query:  The FTS5 full-text query.
+        :param limit:  The max number of items returned.
+        :return:  List of match dicts (id, name, rank, snippet), best match first.
+        """
+        with self.reading() as connection:
+            return [dict(zip(SEARCH_KEYS, row)) for row in search(connection, query, limit)]
+
+    def reindex(self) -> int:
+        """
+        Rebuilds the full-text index from the stored TEXT items.
+
+        :return:  The number of items indexed.
+        """
+        with self.writing() as connection:
+            return rebuild_index(connection)
+
+    def similar(self, target, distance=SIMILAR_DISTANCE, limit=SIMILAR_LIMIT) -> list:
+        """
+        Finds the stored images within a Hamming distance of the perceptual hash of a stored
+        image, or of an image file on disk, without decoding any stored image.
+
+        :param target:  The stored file name or integer id, or the Path of an image file.
+        :param distance:  The max Hamming distance.
+        :param limit:  The max number of images returned.
+        :return:  List of match dicts (id, name, distance), closest first.
+        """
+        with self.reading() as connection:
+            # If the query image is a file on disk #
+            if isinstance(target, Path):
+                phash, file_id = dhash_file(target), None
+                # If the file could not be decoded #
+                if phash is None:
+                    raise ValueError(f'Unable to decode image file {target}')
+            # If the query image is stored #
+            else:
+                file_id = self.locate(connection, target)[0]
+                row = query_handler(connection, query_phash_fetch(), file_id, fetch='one')
+                # If the image has no perceptual hash #
+                if not row:
+                    raise ValueError(f'No perceptual hash for {target}, undecodable or not '
+                                     'yet backfilled')
+
+                phash = row[0]
+
+            return [dict(zip(SIMILAR_KEYS, row))
+                    for row in similar(connection, phash, distance, limit, file_id)]
+
+    def backfill(self) -> tuple:
+        """
+        Hashes the stored images without a perceptual hash.
+
+        :return:  Tuple of (number of images hashed, number that could not be decoded).
+        """
+        with self.writing() as connection:
+            return backfill_phashes(connection)
+
+    def stats(self) -> dict:
+        """
+        Gathers the storage statistics.
+
+        :return:  Dict of storage statistics.
+        """
+        with self.reading() as connection:
+            return get_stats(connection)
@@ -0,0 +1,456 @@
+""" Built-in modules """
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from pathlib import Path
+# Custom Modules #
+from Modules.codec import prepare_chunks
+from Modules.phash import dhash_bytes, dhash_file
+from Modules.storage import CHUNK_SIZE, insert_file, replace_file, split_payload, store_phash
+from Modules.utils import query_handler, query_begin, query_item_locate, query_release, \
+                          query_rollback_to, query_savepoint
+
+
+# Supported file extensions and the storage type they map to #
+ALLOWED_EXT = ('.txt', '.py', '.html', '.jpg', '.png', '.jpeg')
+EXTENSIONS = {'txt': 'TEXT', 'py': 'TEXT', 'html': 'TEXT', 'jpg': 'IMAGE', 'png': 'IMAGE',
+              'jpeg': 'IMAGE'}
+# Default limits on the number of files and payload bytes committed per transaction #
+BATCH_FILES = 500
+BATCH_BYTES = 64 * 1024 * 1024
+# Default number of reader threads and the depth of the queues feeding them and the writer #
+INGEST_WORKERS = os.cpu_count() or 1
+QUEUE_DEPTH = 64
+# Seconds a blocked queue operation waits before re-checking for pipeline shutdown #
+QUEUE_POLL = 0.1
+# Files larger than this are streamed from disk by the writer instead of read into memory #
+STREAM_THRESHOLD = 4 * CHUNK_SIZE
+
+
+class BatchWriter:
+    """ Buffers rows to be stored and writes their chunks in bounded transactions. """
+    def __init__(self, connection, batch_files=BATCH_FILES, batch_bytes=BATCH_BYTES, level=None,
+                 upsert=False, on_commit=None):
+        """
+        Batch writer initializer.
+
+        :param connection:  The protected database connection to be interacted with.
+        :param batch_files:  The max number of files committed per transaction.
+        :param batch_bytes:  The max number of payload bytes committed per transaction.
+        :param level:  The compression level for streamed files, None for the codec default.
+        :param upsert:  If set to True, the content of items already stored under a name is
+                        replaced instead of failing.
+        :param on_commit:  Callable receiving the source paths of each committed batch, which are
+                           then not retained, None to collect them in stored.
+        """
+        self.connection = connection
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+        self.level = level
+        self.upsert = upsert
+        self.on_commit = on_commit
+        self.rows = []
+        self.sources = []
+        self.pending_bytes = 0
+        # Source paths of the files that were committed or rolled back #
+        self.stored = []
+        self.failed = []
+        self.stored_count = 0
+
+    def __enter__(self):
+        """
+        Method for managing what is returned into the context manager as proxy variable(writer).
+
+        :return:  The batch writer instance.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        """
+        Method for handling the events that occurs when exiting context manager, writing any
+        rows still buffered.
+
+        :param exc_type:  The exception type.
+        :param exc_val:  The exception value.
+        :param traceback:  Exception traceback occurrence in stack.
+        """
+        self.flush()
+
+    def add(self, name: str, path: str, ext_type: str, chunks: list, source: Path, phash=None):
+        """
+        Buffers a row to be stored, writing the batch once either batch limit is reached.
+
+        :param name:  The file name the row is stored under.
+        :param path:  The directory the file was stored from.
+        :param ext_type:  The storage type of the file (TEXT or IMAGE).
+        :param chunks:  List of prepared chunk tuples, None to stream the file from its source.
+        :param source:  The path of the source file the row was read from.
+        :param phash:  The perceptual hash of an image, None if not hashed.
+        :return:  Nothing
+        """
+        # If the file is to be streamed from disk #
+        if chunks is None:
+            # Commit the pending batch, then the streamed file in a transaction of its own #
+            self.flush()
+            self.rows.append((name, path, ext_type, chunks, phash))
+            self.sources.append(source)
+            self.flush()
+            return
+
+        self.rows.append((name, path, ext_type, chunks, phash))
+        self.sources.append(source)
+        # Held bytes count the stored data plus the raw text kept for the full-text index #
+        self.pending_bytes += sum(len(chunk[3]) + len(chunk[4] or b'') for chunk in chunks)
+
+        # If the batch has reached either of its limits #
+        if len(self.rows) >= self.batch_files or self.pending_bytes >= self.batch_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows in a single transaction. A file whose name is already stored is
+        rolled back to its own savepoint and recorded as failed, while any other failure rolls back
+        the current batch only and records its files as failed.
+
+        :return:  Nothing
+        """
+        # If there are no buffered rows #
+        if not self.rows:
+            return
+
+        committed, duplicates = [], []
+        try:
+            # Store the whole batch in one transaction #
+            with self.connection:
+                # Open the batch transaction so the savepoint of each file nests within it #
+                if not self.connection.in_transaction:
+                    query_handler(self.connection, query_begin(), commit=False)
+
+                # Iterate through the buffered rows and their source paths #
+                for row, source in zip(self.rows, self.sources):
+                    query_handler(self.connection, query_savepoint('ingest_file'), commit=False)
+                    try:
+                        self.write_row(*row, source)
+
+                    # If the name is already stored, only this file is rolled back #
+                    except sqlite3.IntegrityError as dup_err:
+                        query_handler(self.connection, query_rollback_to('ingest_file'),
+                                      commit=False)
+                        logging.error('File %s not stored: %s', source, dup_err)
+                        duplicates.append(source)
+
+                    # If the file was written #
+                    else:
+                        committed.append((row[0], source))
+
+                    finally:
+                        query_handler(self.connection, query_release('ingest_file'),
+                                      commit=False)
+
+        # If any other sqlite3 or file error occurs, the batch transaction was rolled back #
+        except (sqlite3.Error, OSError) as batch_err:
+            logging.error('Batch of %d files rolled back: %s', len(self.rows), batch_err)
+            self.failed.extend(self.sources)
+
+        # If the batch was committed #
+        else:
+            # Iterate through the committed rows and print success #
+            for name, _ in committed:
+                print(f'File => {name} Stored')
+
+            self.failed.extend(duplicates)
+            self.stored_count += len(committed)
+            # If the committed sources are handed off rather than retained #
+            if self.on_commit:
+                self.on_commit([source for _, source in committed])
+            else:
+                self.stored.extend(source for _, source in committed)
+
+        self.rows, self.sources = [], []
+        self.pending_bytes = 0
+
+    def write_row(self, name: str, path: str, ext_type: str, chunks, phash, source: Path):
+        """
+        Writes a buffered row within the batch transaction, replacing the content of an item
+        already stored under the name in upsert mode.
+
+        :param name:  The file name the row is stored under.
+        :param path:  The directory the file was stored from.
+        :param ext_type:  The storage type of the file (TEXT or IMAGE).
+        :param chunks:  List of prepared chunk tuples, None to stream the file from its source.
+        :param phash:  The perceptual hash of an image, None if not hashed.
+        :param source:  The path of the source file the row was read from.
+        :return:  Nothing
+        """
+        # If the file is streamed, read and prepare its chunks as they are stored #
+        if chunks is None:
+            chunks = prepare_chunks(read_chunks(source), ext_type, self.level)
+
+        mtime = source.stat().st_mtime
+        row = query_handler(self.connection, query_item_locate(), name, fetch='one',
+                            commit=False) if self.upsert else None
+        # If the item is stored, replace its content keeping its id #
+        if row:
+            # If the content changed, the old perceptual hash was dropped #
+            if replace_file(self.connection, row[0], path, ext_type, chunks, mtime):
+                store_phash(self.connection, row[0], phash)
+        # If the item is new #
+        else:
+            file_id = insert_file(self.connection, name, path, ext_type, chunks, mtime)
+            store_phash(self.connection, file_id, phash)
+
+
+def read_payload(current_file: Path, file_ext: str, ext_type: str, reencode=False) -> bytes:
+    """
+    Reads the bytes of a file to be stored. Files are passed through byte-exact unless image
+    re-encoding is explicitly requested, and files over the stream threshold are left to be
+    streamed from disk in chunks by the writer.
+
+    :param current_file:  The path to the file to be read.
+    :param file_ext:  The file extension without the leading period.
+    :param ext_type:  The storage type of the file (TEXT or IMAGE).
+    :param reencode:  If set to True, images are decoded and re-encoded through OpenCV.
+    :return:  The file payload bytes, None if the file is to be streamed from disk.
+    """
+    # If image re-encoding was explicitly requested #
+    if reencode and ext_type == 'IMAGE':
+        return reencode_image(current_file, file_ext)
+
+    # If the file is too large to be held in memory #
+    if current_file.stat().st_size > STREAM_THRESHOLD:
+        return None
+
+    with current_file.open('rb') as file:
+        return file.read()
+
+
+def read_chunks(current_file: Path, chunk_size=CHUNK_SIZE):
+    """
+    Lazily reads a file from disk in fixed-size chunks.
+
+    :param current_file:  The path to the file to be read.
+    :param chunk_size:  The number of bytes read per chunk.
+    :return:  Generator of file byte chunks.
+    """
+    with current_file.open('rb') as file:
+        # Read the file until exhausted #
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+
+def reencode_image(current_file: Path, file_ext: str) -> bytes:
+    """
+    Decodes an image to a pixel array and compresses it again in the same image format.
+
+    :param current_file:  The path to the image to be re-encoded.
+    :param file_ext:  The image extension without the leading period.
+    :return:  The re-encoded image bytes.
+    """
+    # OpenCV is only imported when images are re-encoded, as it dominates startup time #
+    import cv2
+
+    try:
+        # Get the image data #
+        img = cv2.imread(str(current_file))
+        # If the image could not be decoded #
+        if img is None:
+            raise OSError(f'Unable to decode image file {current_file.name}')
+
+        # Compress the pixel array back into the original image format #
+        return cv2.imencode(f'.{file_ext}', img)[1].tobytes()
+
+    # If OpenCV failed, report it as a file error #
+    except cv2.error as cv_err:
+        raise OSError(f'Unable to re-encode image file {current_file.name}: {cv_err}') from cv_err
+
+
+def read_job(job: tuple, reencode: bool, level=None) -> tuple:
+    """
+    Reads the payload for an ingest job and splits it into hashed and compressed chunks, catching
+    file errors so they can be reported per file. Images are also given their perceptual hash on
+    the reader thread.
+
+    :param job:  Tuple of (stored name, file extension, storage type, source path).
+    :param reencode:  If set to True, images are decoded and re-encoded through OpenCV.
+    :param level:  The compression level, None for the codec default.
+    :return:  Tuple of (prepared chunk list or None to stream, perceptual hash or None,
+              error or None).
+    """
+    _, file_ext, ext_type, source = job
+    try:
+        payload = read_payload(source, file_ext, ext_type, reencode)
+        # If the file is too large to be held in memory, it is streamed by the writer #
+        if payload is None:
+            return None, dhash_file(source) if ext_type == 'IMAGE' else None, None
+
+        phash = dhash_bytes(payload) if ext_type == 'IMAGE' else None
+        return list(prepare_chunks(split_payload(payload), ext_type, level)), phash, None
+
+    # If error occurs during file operation or image re-encoding #
+    except OSError as file_err:
+        logging.error('Error occurred during file operation: %s\n\n', file_err)
+        return None, None, file_err
+
+
+def write_job(writer: BatchWriter, job: tuple, chunks: list, phash, error):
+    """
+    Hands a read job to the batch writer, or records it as failed if it could not be read.
+
+    :param writer:  The batch writer storing the rows.
+    :param job:  Tuple of (stored name, file extension, storage type, source path).
+    :param chunks:  List of prepared chunk tuples, None if streamed or the read failed.
+    :param phash:  The perceptual hash of an image, None if not hashed.
+    :param error:  The error raised while reading the file, None on success.
+    :return:  Nothing
+    """
+    name, _, ext_type, source = job
+
+    # If the file could not be read #
+    if error:
+        writer.failed.append(source)
+        return
+
+    writer.add(name, str(source.parent), ext_type, chunks, source, phash)
+
+
+def queue_put(pipe: queue.Queue, item, stop: threading.Event) -> bool:
+    """
+    Puts item in bounded queue, giving up if the pipeline is shut down while blocked.
+
+    :param pipe:  The bounded queue to put the item in.
+    :param item:  The item to be queued.
+    :param stop:  Event set when the pipeline is shut down.
+    :return:  True if the item was queued, False if the pipeline was shut down.
+    """
+    while not stop.is_set():
+        try:
+            pipe.put(item, timeout=QUEUE_POLL)
+            return True
+
+        # If the queue stayed full, re-check for shutdown #
+        except queue.Full:
+            continue
+
+    return False
+
+
+def queue_get(pipe: queue.Queue, stop: threading.Event):
+    """
+    Gets item from bounded queue, giving up if the pipeline is shut down while blocked.
+
+    :param pipe:  The bounded queue to get the item from.
+    :param stop:  Event set when the pipeline is shut down.
+    :return:  The dequeued item, None if the pipeline was shut down.
+    """
+    while not stop.is_set():
+        try:
+            return pipe.get(timeout=QUEUE_POLL)
+
+        # If the queue stayed empty, re-check for shutdown #
+        except queue.Empty:
+            continue
+
+    return None
+
+
+def ingest_files(connection, jobs, reencode=False, workers=INGEST_WORKERS,
+                 queue_depth=QUEUE_DEPTH, batch_files=BATCH_FILES, batch_bytes=BATCH_BYTES,
+                 level=None, upsert=False, on_commit=None) -> BatchWriter:
+    """
+    Stores ingest jobs in the database. With more than one worker, a bounded pool of reader
+    threads reads, hashes and compresses payloads into a bounded queue drained by the calling
+    thread, which is the only one writing to the database connection. An error raised listing or
+    reading the jobs in a pipeline thread is raised on the calling thread, once the jobs already
+    queued are written.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param jobs:  Iterable of (stored name, file extension, storage type, source path) tuples.
+    :param reencode:  If set to True, images are decoded and re-encoded through OpenCV.
+    :param workers:  The number of reader threads, 1 or less reads on the calling thread.
+    :param queue_depth:  The max number of jobs and payloads queued between pipeline stages.
+    :param batch_files:  The max number of files committed per transaction.
+    :param batch_bytes:  The max number of payload bytes committed per transaction.
+    :param level:  The compression level, None for the codec default.
+    :param upsert:  If set to True, the content of items already stored under a name is replaced.
+    :param on_commit:  Callable receiving the source paths of each committed batch, which are then
+                       not retained, None to collect them in the writer.
+    :return:  The batch writer holding the stored and failed source paths.
+    """
+    with BatchWriter(connection, batch_files, batch_bytes, level, upsert, on_commit) as writer:
+        # If the files are to be read on the calling thread #
+        if workers <= 1:
+            # Iterate through the jobs reading and writing each in turn #
+            for job in jobs:
+                write_job(writer, job, *read_job(job, reencode, level))
+
+            return writer
+
+        job_queue = queue.Queue(maxsize=queue_depth)
+        result_queue = queue.Queue(maxsize=queue_depth)
+        stop = threading.Event()
+
+        def feed():
+            try:
+                # Iterate through the jobs queueing them for the readers #
+                for job in jobs:
+                    # If the pipeline was shut down #
+                    if not queue_put(job_queue, job, stop):
+                        return
+
+            # If the jobs could not be listed, hand the error to the writer #
+            except Exception as feed_err:
+                queue_put(result_queue, feed_err, stop)
+
+            finally:
+                # Signal each reader there are no more jobs #
+                for _ in range(workers):
+                    queue_put(job_queue, None, stop)
+
+        def read():
+            try:
+                # Read jobs until the feeder signals the end or the pipeline is shut down #
+                while (job := queue_get(job_queue, stop)) is not None:
+                    queue_put(result_queue, (job, *read_job(job, reencode, level)), stop)
+
+            # If reading failed other than on file access, hand the error to the writer #
+            except Exception as read_err:
+                queue_put(result_queue, read_err, stop)
+
+            finally:
+                # Signal the writer this reader is finished #
+                queue_put(result_queue, None, stop)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        threads += [threading.Thread(target=read, daemon=True) for _ in range(workers)]
+        # Iterate through the pipeline threads and start them #
+        for thread in threads:
+            thread.start()
+
+        finished, errors = 0, []
+        try:
+            # Drain payloads until every reader is finished #
+            while finished < workers:
+                result = result_queue.get()
+                # If a reader is finished #
+                if result is None:
+                    finished += 1
+                    continue
+
+                # If a pipeline thread failed, keep its error to be raised once drained #
+                if isinstance(result, Exception):
+                    errors.append(result)
+                    continue
+
+                write_job(writer, *result)
+
+            # If a pipeline thread failed, raise its error as the calling thread would have #
+            if errors:
+                raise errors[0]
+
+        finally:
+            # Shut down the pipeline so no thread stays blocked on a queue #
+            stop.set()
+
+    return writer
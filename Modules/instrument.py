@@ -0,0 +1,150 @@
+""" Built-in modules """
+import functools
+import logging
+import os
+import threading
+
+
+# Upper bounds in milliseconds of the latency histogram buckets, the last one being unbounded #
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf'))
+# Max number of statement characters written to the slow-query log #
+SLOW_QUERY_CHARS = 200
+# Maps each built query string to the name of the query builder that returned it #
+QUERY_NAMES = {}
+
+
+def query_builder(func):
+    """
+    Decorator registering the queries returned by a query builder under its name, so timings can
+    be aggregated per builder.
+
+    :param func:  The query builder function.
+    :return:  The wrapped query builder.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        query = func(*args, **kwargs)
+        QUERY_NAMES[query] = func.__name__
+        return query
+
+    return wrapper
+
+
+def fetched_bytes(result) -> int:
+    """
+    Estimates the size of fetched data, counting the length of text and BLOB values and 8 bytes
+    per other value.
+
+    :param result:  The fetched row, list of rows or None.
+    :return:  The number of bytes fetched.
+    """
+    # If nothing was fetched #
+    if result is None:
+        return 0
+
+    rows = result if isinstance(result, list) else (result,)
+    return sum(len(value) if isinstance(value, (bytes, str)) else 8
+               for row in rows for value in row)
+
+
+class QueryStats:
+    """ Aggregates query timings per query builder and logs slow statements. """
+    def __init__(self):
+        """
+        Query stats initializer, disabled until enabled.
+        """
+        self.enabled = False
+        self.slow_ms = None
+        self.lock = threading.Lock()
+        self.builders = {}
+        self.slow_log = logging.getLogger('filedb.slow')
+        # Callback run once after the first query, set while the startup is profiled #
+        self.on_first_query = None
+
+    def enable(self, slow_ms=None, slow_log=None):
+        """
+        Enables the instrumentation of query_handler.
+
+        :param slow_ms:  Statements taking at least this many milliseconds are logged, None to
+                         log none.
+        :param slow_log:  The path of the slow-query log file, None to log to the root logger.
+        :return:  Nothing
+        """
+        self.enabled = True
+        self.slow_ms = slow_ms
+
+        # If slow queries get a log file of their own #
+        if slow_log and not self.slow_log.handlers:
+            handler = logging.FileHandler(slow_log)
+            handler.setFormatter(logging.Formatter('%(asctime)s [SLOW]>>  %(message)s',
+                                                   '%Y-%m-%d %H:%M:%S'))
+            self.slow_log.addHandler(handler)
+            self.slow_log.setLevel(logging.WARNING)
+            self.slow_log.propagate = False
+
+    def record(self, query: str, seconds: float, result):
+        """
+        Records the execution of a statement.
+
+        :param query:  The executed query.
+        :param seconds:  The wall time of the execution.
+        :param result:  The fetched row, list of rows or None.
+        :return:  Nothing
+        """
+        name = QUERY_NAMES.get(query, 'unregistered')
+        rows = len(result) if isinstance(result, list) else int(result is not None)
+        size = fetched_bytes(result)
+        millis = seconds * 1000
+        bucket = next(index for index, bound in enumerate(BUCKETS_MS) if millis <= bound)
+
+        with self.lock:
+            stats = self.builders.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_ms': 0.0,
+                                                    'rows': 0, 'bytes': 0,
+                                                    'histogram': [0] * len(BUCKETS_MS)})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max_ms'] = max(stats['max_ms'], millis)
+            stats['rows'] += rows
+            stats['bytes'] += size
+            stats['histogram'][bucket] += 1
+
+        # If the statement is over the slow-query threshold #
+        if self.slow_ms is not None and millis >= self.slow_ms:
+            self.slow_log.warning('%s %.3fms rows=%d bytes=%d %s', name, millis, rows, size,
+                                  ' '.join(query.split())[:SLOW_QUERY_CHARS])
+
+    def dump(self) -> dict:
+        """
+        Gets the aggregates per query builder, slowest total time first.
+
+        :return:  Dict of aggregates keyed by query builder name.
+        """
+        labels = [f'<={bound}ms' for bound in BUCKETS_MS[:-1]] + [f'>{BUCKETS_MS[-2]}ms']
+
+        with self.lock:
+            ranked = sorted(self.builders.items(), key=lambda item: -item[1]['seconds'])
+            return {name: {'calls': stats['calls'],
+                           'total_ms': round(stats['seconds'] * 1000, 3),
+                           'mean_ms': round(stats['seconds'] * 1000 / stats['calls'], 3),
+                           'max_ms': round(stats['max_ms'], 3), 'rows': stats['rows'],
+                           'bytes': stats['bytes'],
+                           'histogram': {label: count for label, count
+                                         in zip(labels, stats['histogram']) if count}}
+                    for name, stats in ranked}
+
+    def reset(self):
+        """
+        Clears the aggregates.
+
+        :return:  Nothing
+        """
+        with self.lock:
+            self.builders = {}
+
+
+# Process-wide query stats fed by query_handler #
+QUERY_STATS = QueryStats()
+
+# If the slow-query threshold is configured in the environment, instrument from the start #
+if os.environ.get('FILEDB_SLOW_MS'):
+    QUERY_STATS.enable(float(os.environ['FILEDB_SLOW_MS']), os.environ.get('FILEDB_SLOW_LOG'))
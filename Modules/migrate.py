@@ -0,0 +1,314 @@
+""" Built-in modules """
+import base64
+import hashlib
+import logging
+# Custom Modules #
+from Modules.codec import prepare_chunks
+from Modules.storage import CHUNK_SIZE, file_digest, insert_file
+from Modules.utils import query_handler, query_db_create, query_get_version, query_set_version, \
+                          query_chunk_digests, query_column_exists, query_table_exists, \
+                          query_migrate_digest_batch, query_migrate_digest_columns, \
+                          query_migrate_digest_store, query_migrate_blob_create, \
+                          query_migrate_blob_batch, query_migrate_blob_insert, \
+                          query_migrate_blob_purge, query_migrate_blob_swap, \
+                          query_migrate_cas_batch, query_migrate_cas_blob, \
+                          query_migrate_cas_create, query_migrate_cas_insert, \
+                          query_migrate_cas_purge, query_migrate_cas_swap, \
+                          query_migrate_chunks_batch, query_migrate_chunks_drop, \
+                          query_migrate_codec, query_migrate_fts, query_migrate_fts_content, \
+                          query_migrate_indexes, query_migrate_phash, query_migrate_slice
+
+
+# Current version of the storage database schema #
+SCHEMA_VERSION = 10
+# Number of legacy rows converted per migration transaction #
+MIGRATE_BATCH = 64
+
+
+def get_version(connection) -> int:
+    """
+    Retrieves the schema version stamped in the database header.
+
+    :param connection:  The protected database connection to be interacted with.
+    :return:  The schema version number.
+    """
+    return query_handler(connection, query_get_version(), fetch='one')[0]
+
+
+def create_db(connection):
+    """
+    Creates the current version of the storage database schema and stamps its version.
+
+    :param connection:  The protected database connection to be interacted with.
+    :return:  Nothing
+    """
+    # Get formatted query to create database #
+    create_query = query_db_create()
+    # Create storage database #
+    query_handler(connection, create_query, exec_script=True)
+    # Stamp the schema version in the database header #
+    query_handler(connection, query_set_version(SCHEMA_VERSION))
+
+
+def migrate_db(connection, batch_size=MIGRATE_BATCH):
+    """
+    Brings an existing storage database up to the current schema version, creating it if the
+    storage table does not exist yet.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param batch_size:  The number of rows converted per migration transaction.
+    :return:  Nothing
+    """
+    version = get_version(connection)
+
+    # If the database is already at the current version #
+    if version == SCHEMA_VERSION:
+        return
+
+    # If the database has no schema version and no storage table #
+    if version == 0 and not query_handler(connection, query_table_exists(), 'storage',
+                                          fetch='one'):
+        return create_db(connection)
+
+    # If the database holds legacy base64 TEXT content #
+    if version == 0:
+        migrate_blob(connection, batch_size)
+
+    # If the database holds whole files in single BLOB rows, import them at the current version #
+    if version <= 1:
+        return migrate_chunks(connection, batch_size)
+
+    # If the database holds chunk content inline rather than content-addressed #
+    if version == 2:
+        migrate_cas(connection, batch_size)
+
+    # If the blobs do not record the codec they are stored with #
+    if version <= 3:
+        # Add the codec column, existing blobs being uncompressed #
+        query_handler(connection, query_migrate_codec(4), exec_script=True)
+
+    # If the files metadata lacks the modification time and content hash #
+    if version <= 4:
+        migrate_digest(connection, batch_size)
+
+    # If the files metadata lacks the indexes backing filtered listing #
+    if version <= 5:
+        query_handler(connection, query_migrate_indexes(6), exec_script=True)
+
+    # If the database has no full-text index, it is created empty to be filled by a rebuild #
+    if version <= 6:
+        query_handler(connection, query_migrate_fts(7), exec_script=True)
+        print('[*] Full-text index created, run the reindex command to index stored TEXT files')
+
+    # If the database has no perceptual hash table, it is created empty to be filled by a backfill #
+    if version <= 7:
+        query_handler(connection, query_migrate_phash(8), exec_script=True)
+        print('[*] Perceptual hash table created, run the backfill command to hash stored images')
+
+    # If the full-text index is contentless, it is replaced by an empty one holding the text #
+    if version == 9:
+        query_handler(connection, query_migrate_fts_content(10), exec_script=True)
+        print('[*] Full-text index rebuilt to hold the indexed text, run the reindex command to '
+              'index stored TEXT files')
+
+    # If the full-text index already holds the text, only the version is stamped #
+    elif version <= 8:
+        query_handler(connection, query_set_version(10))
+
+
+def migrate_blob(connection, batch_size: int):
+    """
+    Converts legacy base64 TEXT content to raw BLOB content in bounded batches. Each batch is
+    moved into the staging table and purged from the legacy table in a single transaction, so
+    freed pages are reused and an interrupted migration resumes where it left off.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param batch_size:  The number of rows converted per migration transaction.
+    :return:  Nothing
+    """
+    migrated = 0
+    print('[*] Migrating storage database to BLOB content, this only happens once ..')
+
+    # Create the BLOB-backed staging table if a prior run did not already #
+    query_handler(connection, query_migrate_blob_create())
+
+    while True:
+        # Batch transaction, rolled back as a whole on failure #
+        with connection:
+            rows = query_handler(connection, query_migrate_blob_batch(), batch_size,
+                                 fetch='all', commit=False)
+            # If all the legacy rows have been migrated #
+            if not rows:
+                break
+
+            # Decode the base64 content of the batch to raw bytes #
+            blob_rows = [(name, path, ext, base64.b64decode(content))
+                         for _, name, path, ext, content in rows]
+            # Store the decoded batch in the staging table #
+            query_handler(connection, query_migrate_blob_insert(), blob_rows, many=True,
+                          commit=False)
+            # Purge the migrated batch from the legacy table #
+            query_handler(connection, query_migrate_blob_purge(), rows[-1][0], commit=False)
+
+        migrated += len(rows)
+        print(f'[+] {migrated} rows migrated')
+
+    # Swap the staging table in place of the legacy table and stamp the version #
+    query_handler(connection, query_migrate_blob_swap(1), exec_script=True)
+    logging.info('Migrated %d legacy rows to BLOB content', migrated)
+    print(f'\n[!] Migration complete, {migrated} rows converted')
+
+
+def iter_legacy_content(connection, rowid: int, length: int):
+    """
+    Lazily yields the content of a single BLOB row in chunk size pieces using incremental BLOB
+    I/O, falling back to substr slices on Python versions without Connection.blobopen.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param rowid:  The rowid of the single BLOB row.
+    :param length:  The length of the row content in bytes.
+    :return:  Generator of content byte chunks.
+    """
+    # If incremental BLOB I/O is supported #
+    if hasattr(connection, 'blobopen'):
+        with connection.blobopen('storage', 'content', rowid, readonly=True) as blob:
+            # Read the blob until exhausted #
+            while chunk := blob.read(CHUNK_SIZE):
+                yield chunk
+
+        return
+
+    # Iterate through the content in chunk size steps (substr offsets are 1-based) #
+    for offset in range(1, length + 1, CHUNK_SIZE):
+        yield query_handler(connection, query_migrate_slice(), offset, CHUNK_SIZE, rowid,
+                            fetch='one', commit=False)[0]
+
+
+def migrate_chunks(connection, batch_size: int):
+    """
+    Splits files held in single BLOB rows into the current chunked schema in bounded batches. Each
+    row's content is streamed into chunks, so no file is held in memory as a whole, and each batch
+    is purged from the single BLOB table in the same transaction.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param batch_size:  The number of rows converted per migration transaction.
+    :return:  Nothing
+    """
+    migrated = 0
+    print('[*] Migrating storage database to chunked content, this only happens once ..')
+
+    # Create the current tables if a prior run did not already #
+    query_handler(connection, query_db_create(), exec_script=True)
+
+    while True:
+        # Batch transaction, rolled back as a whole on failure #
+        with connection:
+            rows = query_handler(connection, query_migrate_chunks_batch(), batch_size,
+                                 fetch='all', commit=False)
+            # If all the single BLOB rows have been migrated #
+            if not rows:
+                break
+
+            # Iterate through the batch streaming each row into chunks #
+            for rowid, name, path, ext, length in rows:
+                chunks = prepare_chunks(iter_legacy_content(connection, rowid, length), ext)
+                insert_file(connection, name, path, ext, chunks)
+
+            # Purge the migrated batch from the single BLOB table #
+            query_handler(connection, query_migrate_blob_purge(), rows[-1][0], commit=False)
+
+        migrated += len(rows)
+        print(f'[+] {migrated} rows migrated')
+
+    # Drop the emptied single BLOB table and stamp the version #
+    query_handler(connection, query_migrate_chunks_drop(SCHEMA_VERSION), exec_script=True)
+    logging.info('Migrated %d single BLOB rows to chunked content', migrated)
+    print(f'\n[!] Migration complete, {migrated} rows converted')
+
+
+def migrate_cas(connection, batch_size: int):
+    """
+    Moves chunk content held inline in the chunks table into reference counted blobs addressed
+    by their SHA-256 hash in bounded batches, so identical chunks are only stored once.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param batch_size:  The number of chunks converted per migration transaction.
+    :return:  Nothing
+    """
+    migrated = 0
+    print('[*] Migrating storage database to content-addressed chunks, this only happens once ..')
+
+    # Create the blobs and staging tables if a prior run did not already #
+    query_handler(connection, query_migrate_cas_create(), exec_script=True)
+
+    while True:
+        # Batch transaction, rolled back as a whole on failure #
+        with connection:
+            rows = query_handler(connection, query_migrate_cas_batch(), batch_size,
+                                 fetch='all', commit=False)
+            # If all the inline chunks have been migrated #
+            if not rows:
+                break
+
+            # Iterate through the batch storing each chunk by content #
+            for _, file_id, seq, data in rows:
+                digest = hashlib.sha256(data).hexdigest()
+                blob_id = query_handler(connection, query_migrate_cas_blob(), digest, len(data),
+                                        data, fetch='one', commit=False)[0]
+                query_handler(connection, query_migrate_cas_insert(), file_id, seq, blob_id,
+                              commit=False)
+
+            # Purge the migrated batch from the inline chunks table #
+            query_handler(connection, query_migrate_cas_purge(), rows[-1][0], commit=False)
+
+        migrated += len(rows)
+        print(f'[+] {migrated} chunks migrated')
+
+    # Swap the staging table in place of the inline chunks table and stamp the version #
+    query_handler(connection, query_migrate_cas_swap(3), exec_script=True)
+    logging.info('Migrated %d inline chunks to content-addressed blobs', migrated)
+    print(f'\n[!] Migration complete, {migrated} chunks converted')
+
+
+def migrate_digest(connection, batch_size: int):
+    """
+    Adds the modification time and content hash columns to the files metadata and backfills the
+    hash of existing items in bounded batches. The hash is derived from the stored chunk hashes,
+    so no file content is read.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param batch_size:  The number of items hashed per migration transaction.
+    :return:  Nothing
+    """
+    migrated, last_id = 0, 0
+    print('[*] Migrating storage database to record content hashes, this only happens once ..')
+
+    # If a prior run did not already add the columns #
+    if not query_handler(connection, query_column_exists(), 'files', 'hash', fetch='one'):
+        query_handler(connection, query_migrate_digest_columns(), exec_script=True)
+
+    while True:
+        # Batch transaction, rolled back as a whole on failure #
+        with connection:
+            rows = query_handler(connection, query_migrate_digest_batch(), last_id, batch_size,
+                                 fetch='all', commit=False)
+            # If all the items have been hashed #
+            if not rows:
+                break
+
+            # Iterate through the batch deriving each hash from its chunk hashes #
+            for (file_id,) in rows:
+                digests = query_handler(connection, query_chunk_digests(), file_id,
+                                        fetch='all', commit=False)
+                query_handler(connection, query_migrate_digest_store(),
+                              file_digest(row[0] for row in digests), file_id, commit=False)
+
+            last_id = rows[-1][0]
+
+        migrated += len(rows)
+        print(f'[+] {migrated} files hashed')
+
+    # Stamp the schema version in the database header #
+    query_handler(connection, query_set_version(5))
+    logging.info('Backfilled content hashes of %d files', migrated)
+    print(f'\n[!] Migration complete, {migrated} files hashed')
@@ -0,0 +1,169 @@
+""" Built-in modules """
+from itertools import chain, combinations
+from pathlib import Path
+# Custom Modules #
+from Modules.storage import iter_content, store_phash
+from Modules.utils import PHASH_BAND_BITS, PHASH_BANDS, query_handler, query_phash_candidates, \
+                          query_phash_missing, query_phash_scan
+
+
+# Rows and columns of the difference hash grid, giving a 64-bit hash #
+HASH_SIZE = 8
+# Default max Hamming distance of similar images and number of results #
+SIMILAR_DISTANCE = 6
+SIMILAR_LIMIT = 20
+# Distances above this scan every hash rather than probing the band indexes #
+MAX_PROBE_DISTANCE = 3 * PHASH_BANDS - 1
+# Number of hashes fetched per scan batch and images hashed per backfill transaction #
+SCAN_BATCH = 10000
+BACKFILL_BATCH = 50
+# Keys of the similar image result rows #
+SIMILAR_KEYS = ('id', 'name', 'distance')
+
+
+def dhash_pixels(img) -> int:
+    """
+    Computes the difference hash of a grayscale pixel array, each bit recording whether a pixel of
+    the downscaled image is brighter than its left neighbour.
+
+    :param img:  The grayscale pixel array.
+    :return:  The hash as a signed 64-bit integer, the form it is stored in SQLite.
+    """
+    # OpenCV is only imported by the code paths handling images, as it dominates startup time #
+    import cv2
+
+    small = cv2.resize(img, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = sum(1 << index for index, bit in enumerate(bits) if bit)
+
+    return value - (1 << 64) if value >> 63 else value
+
+
+def dhash_bytes(payload) -> int:
+    """
+    Computes the difference hash of an encoded image. The image is decoded at an eighth of its
+    size, as the hash only needs a 9x8 thumbnail.
+
+    :param payload:  The encoded image bytes.
+    :return:  The signed 64-bit hash, None if the image could not be decoded.
+    """
+    import cv2
+    import numpy
+
+    try:
+        img = cv2.imdecode(numpy.frombuffer(payload, numpy.uint8),
+                           cv2.IMREAD_REDUCED_GRAYSCALE_8)
+
+    # If the payload is not a supported image #
+    except cv2.error:
+        return None
+
+    return None if img is None else dhash_pixels(img)
+
+
+def dhash_file(image_path: Path) -> int:
+    """
+    Computes the difference hash of an image file.
+
+    :param image_path:  The path to the image file.
+    :return:  The signed 64-bit hash, None if the image could not be decoded.
+    """
+    import cv2
+
+    try:
+        img = cv2.imread(str(image_path), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+
+    # If the file is not a supported image #
+    except cv2.error:
+        return None
+
+    return None if img is None else dhash_pixels(img)
+
+
+def hamming(first: int, second: int) -> int:
+    """
+    Counts the bits differing between two 64-bit hashes.
+
+    :param first:  The first hash.
+    :param second:  The second hash.
+    :return:  The Hamming distance.
+    """
+    return bin((first ^ second) & ((1 << 64) - 1)).count('1')
+
+
+def band_probes(phash: int, radius: int) -> list:
+    """
+    Lists the values within a number of bit flips of each band of a hash. By the pigeonhole
+    principle, a hash within distance d shares a band within d // bands flips of the query.
+
+    :param phash:  The query hash.
+    :param radius:  The max number of flipped bits per band.
+    :return:  List of the probe values of each band, in band order.
+    """
+    masks = [sum(1 << bit for bit in flips) for count in range(radius + 1)
+             for flips in combinations(range(PHASH_BAND_BITS), count)]
+    mask = (1 << PHASH_BAND_BITS) - 1
+
+    return [[((phash >> (band * PHASH_BAND_BITS)) & mask) ^ flip for flip in masks]
+            for band in range(PHASH_BANDS)]
+
+
+def similar(connection, phash: int, distance=SIMILAR_DISTANCE, limit=SIMILAR_LIMIT,
+            exclude=None) -> list:
+    """
+    Finds the stored images within a Hamming distance of a hash, without decoding any stored image.
+    Small distances probe the band indexes, larger ones scan the stored hashes.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param phash:  The query hash.
+    :param distance:  The max Hamming distance.
+    :param limit:  The max number of images returned.
+    :param exclude:  The id of an item left out of the results, None to keep all.
+    :return:  List of (id, name, distance) rows, closest first.
+    """
+    # If the distance is small enough for the band indexes to find every match #
+    if distance <= MAX_PROBE_DISTANCE:
+        probes = band_probes(phash, distance // PHASH_BANDS)
+        rows = query_handler(connection, query_phash_candidates(len(probes[0])),
+                             *chain.from_iterable(probes), fetch='all')
+    # If every stored hash is to be compared #
+    else:
+        rows, after_id = [], 0
+        # Fetch keyset batches of hashes until there are none left #
+        while batch := query_handler(connection, query_phash_scan(), after_id, SCAN_BATCH,
+                                     fetch='all'):
+            rows.extend(row for row in batch if hamming(phash, row[2]) <= distance)
+            after_id = batch[-1][0]
+
+    matches = sorted((hamming(phash, stored), file_id, name) for file_id, name, stored in rows
+                     if file_id != exclude)
+
+    return [(file_id, name, dist) for dist, file_id, name in matches if dist <= distance][:limit]
+
+
+def backfill_phashes(connection, batch_size=BACKFILL_BATCH) -> tuple:
+    """
+    Hashes the stored IMAGE items without a perceptual hash, committing one batch of hashes at a
+    time. Each image is reassembled in memory once to be decoded.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param batch_size:  The number of images hashed per transaction.
+    :return:  Tuple of (number of images hashed, number that could not be decoded).
+    """
+    after_id, hashed, skipped = 0, 0, 0
+    # Fetch keyset batches of unhashed image ids until there are none left #
+    while rows := query_handler(connection, query_phash_missing(), after_id, batch_size,
+                                fetch='all'):
+        hashes = [(file_id, dhash_bytes(b''.join(iter_content(connection, file_id))))
+                  for (file_id,) in rows]
+
+        with connection:
+            # Iterate through the hashes of the batch storing the decoded ones #
+            for file_id, phash in hashes:
+                store_phash(connection, file_id, phash)
+
+        after_id = rows[-1][0]
+        skipped += sum(phash is None for _, phash in hashes)
+        hashed += len(hashes)
+
+    return hashed - skipped, skipped
@@ -0,0 +1,121 @@
+""" Built-in modules """
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+# Custom Modules #
+from Modules.utils import DbConnectionHandler, query_handler, query_begin, query_busy_timeout, \
+                          query_journal_wal, query_wal_autocheckpoint, query_wal_checkpoint
+
+
+# Default number of read-only connections, one per CPU core #
+READ_POOL_SIZE = os.cpu_count() or 1
+# Milliseconds a statement waits on a locked database before failing #
+BUSY_TIMEOUT = 5000
+# Write-ahead log size in pages that triggers an automatic checkpoint, SQLite's default #
+WAL_AUTOCHECKPOINT = 1000
+
+
+class ConnectionPool:
+    """ Single writer connection and a bounded pool of read-only connections on a WAL database. """
+    def __init__(self, db_file, size=READ_POOL_SIZE, busy_timeout=BUSY_TIMEOUT,
+                 autocheckpoint=WAL_AUTOCHECKPOINT, profile=None):
+        """
+        Connection pool initializer, switching the database to WAL journaling so readers and the
+        writer do not block each other.
+
+        :param db_file:  The path to the storage database.
+        :param size:  The max number of read-only connections.
+        :param busy_timeout:  Milliseconds a statement waits on a locked database before failing.
+        :param autocheckpoint:  WAL pages that trigger an automatic checkpoint, 0 to only
+                                checkpoint when requested.
+        :param profile:  The name of the performance profile, None for the default.
+        """
+        self.db_file = Path(db_file)
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.profile = profile
+        self.write_lock = threading.Lock()
+        self.create_lock = threading.Lock()
+        self.idle = queue.Queue(maxsize=size)
+        self.handlers = []
+
+        self.write_handler = DbConnectionHandler(self.db_file, profile, check_same_thread=False)
+        self.connection = self.write_handler.connection
+        query_handler(self.connection, query_busy_timeout(busy_timeout))
+        query_handler(self.connection, query_journal_wal(), fetch='one')
+        query_handler(self.connection, query_wal_autocheckpoint(autocheckpoint), fetch='one')
+
+    def acquire(self):
+        """
+        Borrows an idle read-only connection, opening a new one while under the pool size and
+        otherwise blocking until one is released.
+
+        :return:  The read-only connection.
+        """
+        try:
+            return self.idle.get_nowait()
+
+        # If no connection is idle #
+        except queue.Empty:
+            with self.create_lock:
+                # If the pool is under its size, open another connection #
+                if len(self.handlers) < self.size:
+                    handler = DbConnectionHandler(f'{self.db_file.absolute().as_uri()}?mode=ro',
+                                                  self.profile, uri=True,
+                                                  check_same_thread=False)
+                    query_handler(handler.connection, query_busy_timeout(self.busy_timeout))
+                    self.handlers.append(handler)
+                    return handler.connection
+
+        return self.idle.get()
+
+    @contextmanager
+    def reader(self):
+        """
+        Borrows a read-only connection inside a read transaction, so every query sees the same
+        snapshot while the writer keeps committing.
+
+        :return:  Context yielding the read-only connection.
+        """
+        connection = self.acquire()
+        try:
+            query_handler(connection, query_begin(), commit=False)
+            yield connection
+
+        finally:
+            connection.rollback()
+            self.idle.put(connection)
+
+    @contextmanager
+    def writer(self):
+        """
+        Holds the writer connection for exclusive use by the calling thread.
+
+        :return:  Context yielding the writer connection.
+        """
+        with self.write_lock:
+            yield self.connection
+
+    def checkpoint(self, mode='PASSIVE') -> tuple:
+        """
+        Checkpoints the write-ahead log into the database.
+
+        :param mode:  The checkpoint mode (PASSIVE, FULL, RESTART or TRUNCATE).
+        :return:  Tuple of (busy flag, pages in the log, pages checkpointed).
+        """
+        with self.writer() as connection:
+            return query_handler(connection, query_wal_checkpoint(mode), fetch='one')
+
+    def close(self):
+        """
+        Closes the read-only connections and the writer connection.
+
+        :return:  Nothing
+        """
+        # Iterate through the read-only connections and close them #
+        for handler in self.handlers:
+            handler.__exit__(None, None, None)
+
+        self.write_handler.__exit__(None, None, None)
@@ -0,0 +1,66 @@
+""" Custom Modules """
+from Modules.codec import decompress
+from Modules.storage import index_text
+from Modules.utils import query_handler, query_chunk_fetch, query_fts_purge, query_fts_search, \
+                          query_fts_snippet, query_fts_text_batch
+
+
+# Default max number of search results #
+SEARCH_LIMIT = 20
+# Number of tokens around the match in a result snippet #
+SNIPPET_TOKENS = 16
+# Number of TEXT items re-indexed per transaction by a rebuild #
+REINDEX_BATCH = 50
+# Keys of the search result rows #
+SEARCH_KEYS = ('id', 'name', 'rank', 'snippet')
+
+
+def search(connection, query: str, limit=SEARCH_LIMIT) -> list:
+    """
+    Searches the full-text index of the stored TEXT items, ranking each item by its best matching
+    segment. Snippets are only built for the returned segments, as highlighting every match of a
+    frequent term is costly. The query uses the SQLite FTS5 syntax (terms, "phrases", prefix*,
+    AND/OR/NOT).
+
+    :param connection:  The protected database connection to be interacted with.
+    :param query:  The full-text query.
+    :param limit:  The max number of items returned.
+    :return:  List of (id, name, rank, snippet) rows, best match first.
+    """
+    rows = query_handler(connection, query_fts_search(), query, limit, fetch='all')
+
+    return [(file_id, name, rank, query_handler(connection, query_fts_snippet(), SNIPPET_TOKENS,
+                                                 query, hit, fetch='one')[0])
+            for file_id, name, rank, hit in rows]
+
+
+def rebuild_index(connection, batch_size=REINDEX_BATCH) -> int:
+    """
+    Rebuilds the full-text index from the stored TEXT items, committing one batch of items at a
+    time so the write lock is released between batches.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param batch_size:  The number of items indexed per transaction.
+    :return:  The number of items indexed.
+    """
+    with connection:
+        query_handler(connection, query_fts_purge(), commit=False)
+
+    after_id, indexed = 0, 0
+    # Fetch keyset batches of TEXT item ids until there are none left #
+    while rows := query_handler(connection, query_fts_text_batch(), after_id, batch_size,
+                                fetch='all'):
+        with connection:
+            # Iterate through the items of the batch indexing their chunks #
+            for (file_id,) in rows:
+                seq = 0
+                # Fetch chunks by sequence number within the batch transaction #
+                while row := query_handler(connection, query_chunk_fetch(), file_id, seq,
+                                           fetch='one', commit=False):
+                    index_text(connection, file_id, seq, decompress(row[1], row[0]))
+                    seq += 1
+
+        after_id = rows[-1][0]
+        indexed += len(rows)
+
+    return indexed
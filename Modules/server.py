@@ -0,0 +1,402 @@
+""" Built-in modules """
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from urllib.parse import parse_qs, unquote, urlsplit
+# Custom Modules #
+from Modules.cache import CACHE_BYTES
+from Modules.catalog import PAGE_SIZE, check_name
+from Modules.file_store import FileStore
+from Modules.instrument import QUERY_STATS
+from Modules.phash import SIMILAR_DISTANCE, SIMILAR_LIMIT
+from Modules.search import SEARCH_LIMIT
+from Modules.storage import CHUNK_SIZE
+
+
+# Default number of pooled read-only connections serving concurrent reads #
+SERVER_READERS = min(32, (os.cpu_count() or 1) + 4)
+# Default max number of requests handled at once, the rest wait their turn #
+MAX_CLIENTS = 64
+# Max size of a request line and headers #
+HEADER_LIMIT = 64 * 1024
+# Max number of files in a listing page, larger limits being clamped #
+MAX_PAGE_SIZE = 1000
+# Seconds an upload may stall between body reads before the request is dropped #
+BODY_TIMEOUT = 30
+# Upload bytes spooled in memory before the spool spills to a temp file #
+SPOOL_MEMORY = 4 * CHUNK_SIZE
+# Reason phrases of the response status codes sent #
+STATUS = {200: 'OK', 201: 'Created', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found',
+          405: 'Method Not Allowed', 408: 'Request Timeout', 409: 'Conflict',
+          411: 'Length Required',
+          500: 'Internal Server Error'}
+# Listing query parameters and the type they are parsed to #
+LIST_PARAMS = {'type': ('ext_type', str), 'path': ('path', str), 'name': ('name', str),
+               'size_min': ('size_min', int), 'size_max': ('size_max', int),
+               'mtime_min': ('mtime_min', float), 'mtime_max': ('mtime_max', float)}
+
+
+class FileServer:
+    """ HTTP/1.1 file server streaming request and response bodies through a shared FileStore. """
+    def __init__(self, store: FileStore, readers=SERVER_READERS, max_clients=MAX_CLIENTS):
+        """
+        File server initializer.
+
+        :param store:  The file store in concurrent mode with the given number of readers.
+        :param readers:  The number of pooled read-only connections of the store.
+        :param max_clients:  The max number of requests handled at once.
+        """
+        self.store = store
+        # One thread per reader plus the writer, so no thread ever waits on the connection pool #
+        self.executor = ThreadPoolExecutor(max_workers=readers + 1)
+        self.read_slots = asyncio.Semaphore(readers)
+        self.write_lock = asyncio.Lock()
+        self.client_slots = asyncio.Semaphore(max_clients)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        Runs a blocking SQLite call on the bounded executor.
+
+        :param func:  The function to be called.
+        :param args:  Positional arguments of the call.
+        :param kwargs:  Keyword arguments of the call.
+        :return:  The result of the call.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves the requests of a client connection until it is closed.
+
+        :param reader:  The connection stream reader.
+        :param writer:  The connection stream writer.
+        :return:  Nothing
+        """
+        try:
+            keep_alive = True
+            # Serve requests while the connection is kept alive #
+            while keep_alive:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+
+                # If the client closed the connection or sent oversized headers #
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, version = lines[0].split(' ', 2)
+                headers = {key.strip().lower(): value.strip()
+                           for key, value in (line.split(':', 1) for line in lines[1:] if line)}
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection') != 'close'
+
+                async with self.client_slots:
+                    keep_alive &= await self.dispatch(method, target, headers, reader, writer)
+
+        # If the client dropped the connection or sent a malformed request #
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as conn_err:
+            logging.error('Client connection error: %s', conn_err)
+
+        finally:
+            writer.close()
+
+    async def dispatch(self, method: str, target: str, headers: dict, reader, writer) -> bool:
+        """
+        Routes a request to its endpoint.
+
+        :param method:  The request method.
+        :param target:  The request target path and query.
+        :param headers:  Dict of lower case request header names and values.
+        :param reader:  The connection stream reader.
+        :param writer:  The connection stream writer.
+        :return:  True if the connection can serve another request, False otherwise.
+        """
+        url = urlsplit(target)
+        name = unquote(url.path[len('/files/'):]) if url.path.startswith('/files/') else None
+
+        try:
+            # If a file is to be stored #
+            if method == 'PUT' and name:
+                return await self.put(name, parse_qs(url.query), headers, reader, writer)
+            # If a file is to be retrieved #
+            if method == 'GET' and name:
+                return await self.get(name, writer)
+            # If a file is to be deleted #
+            if method == 'DELETE' and name:
+                async with self.write_lock:
+                    await self.run_blocking(self.store.delete, name)
+
+                return await self.send(writer, 204)
+            # If the stored files are to be listed #
+            if method == 'GET' and url.path in ('/files', '/files/'):
+                return await self.listing(parse_qs(url.query), writer)
+            # If the images similar to a stored image are to be found #
+            if method == 'GET' and url.path.startswith('/similar/'):
+                name = unquote(url.path[len('/similar/'):])
+                return await self.similar(name, parse_qs(url.query), writer)
+            # If the stored text files are to be searched #
+            if method == 'GET' and url.path == '/search':
+                return await self.search(parse_qs(url.query), writer)
+            # If the query instrumentation aggregates are to be retrieved #
+            if method == 'GET' and url.path == '/stats/queries':
+                return await self.send(writer, 200, {'enabled': QUERY_STATS.enabled,
+                                                     'queries': QUERY_STATS.dump()})
+            # If the content cache counters are to be retrieved #
+            if method == 'GET' and url.path == '/stats/cache':
+                return await self.send(writer, 200, {'enabled': self.store.cache is not None,
+                                                     **self.store.cache_stats()})
+            # If the storage statistics are to be retrieved #
+            if method == 'GET' and url.path == '/stats':
+                async with self.read_slots:
+                    stats = await self.run_blocking(self.store.stats)
+
+                return await self.send(writer, 200, stats)
+
+            return await self.send(writer, 405 if name else 404, {'error': 'Unknown endpoint'})
+
+        # If the file is not stored #
+        except KeyError:
+            return await self.send(writer, 404, {'error': f'Not found: {name}'})
+
+        # If the request parameters are invalid #
+        except ValueError as val_err:
+            return await self.send(writer, 400, {'error': str(val_err)})
+
+        # If a file is already stored under the name #
+        except sqlite3.IntegrityError:
+            await self.send(writer, 409, {'error': f'Already stored: {name}'},
+                            {'Connection': 'close'})
+            return False
+
+        # If any other sqlite3 error occurs #
+        except sqlite3.Error as db_err:
+            logging.error('Database error serving %s %s: %s', method, target, db_err)
+            await self.send(writer, 500, {'error': str(db_err)}, {'Connection': 'close'})
+            return False
+
+    @staticmethod
+    async def send(writer, status: int, body=None, extra=None) -> bool:
+        """
+        Sends a response with an optional JSON body.
+
+        :param writer:  The connection stream writer.
+        :param status:  The response status code.
+        :param body:  The object sent as JSON, None for no body.
+        :param extra:  Dict of extra response headers.
+        :return:  True so the connection can serve another request.
+        """
+        payload = json.dumps(body).encode() if body is not None else b''
+        headers = {'Content-Length': len(payload), **(extra or {})}
+        # If there is a body to be sent #
+        if payload:
+            headers['Content-Type'] = 'application/json'
+
+        head = ''.join(f'{key}: {value}\r\n' for key, value in headers.items())
+        writer.write(f'HTTP/1.1 {status} {STATUS[status]}\r\n{head}\r\n'.encode() + payload)
+        await writer.drain()
+
+        return True
+
+    async def put(self, name: str, query: dict, headers: dict, reader, writer) -> bool:
+        """
+        Stores a request body. The body is first spooled, in memory up to SPOOL_MEMORY and in a
+        temp file beyond, with a timeout on each read, and the write lock is only taken to store
+        the complete body, so a slow or stalled client never holds back other writes.
+
+        :param name:  The name the file is stored under.
+        :param query:  Dict of parsed query parameters, type overriding the storage type.
+        :param headers:  Dict of lower case request header names and values.
+        :param reader:  The connection stream reader.
+        :param writer:  The connection stream writer.
+        :return:  True if the connection can serve another request, False otherwise.
+        """
+        # If the body length is not known up front #
+        if 'content-length' not in headers:
+            await self.send(writer, 411, {'error': 'Content-Length required'})
+            return False
+
+        length = headers['content-length']
+        # If the body length is not a decimal count, the body cannot be delimited #
+        if not (length.isascii() and length.isdigit()):
+            await self.send(writer, 400, {'error': f'Invalid Content-Length: {length!r}'},
+                            {'Connection': 'close'})
+            return False
+
+        try:
+            # Uploaded names are flat, refusing separators, . or .. and NUL characters #
+            check_name(name, nested=False)
+
+        # If the name is unsafe, the unread body leaves the connection unusable #
+        except ValueError as name_err:
+            await self.send(writer, 400, {'error': str(name_err)}, {'Connection': 'close'})
+            return False
+
+        remaining = int(length)
+        ext_type = query.get('type', [None])[0]
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY) as spool:
+            try:
+                # Spool the body one chunk at a time, giving up on a stalled client #
+                while remaining:
+                    chunk = await asyncio.wait_for(
+                        reader.readexactly(min(CHUNK_SIZE, remaining)), BODY_TIMEOUT)
+                    spool.write(chunk)
+                    remaining -= len(chunk)
+
+            # If the client stalled, the unread body leaves the connection unusable #
+            except asyncio.TimeoutError:
+                await self.send(writer, 408, {'error': 'Request body timed out'},
+                                {'Connection': 'close'})
+                return False
+
+            spool.seek(0)
+            try:
+                async with self.write_lock:
+                    file_id = await self.run_blocking(
+                        self.store.put, iter(partial(spool.read, CHUNK_SIZE), b''), name,
+                        ext_type)
+
+            # If the file type is not supported #
+            except ValueError as val_err:
+                return await self.send(writer, 400, {'error': str(val_err)})
+
+        return await self.send(writer, 201, {'id': file_id, 'name': name})
+
+    async def get(self, name: str, writer) -> bool:
+        """
+        Streams a stored file with chunked transfer encoding, waiting for the socket to drain
+        after each chunk.
+
+        :param name:  The stored file name.
+        :param writer:  The connection stream writer.
+        :return:  True so the connection can serve another request.
+        """
+        async with self.read_slots:
+            stream = await self.run_blocking(self.store.get, name)
+            try:
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n'
+                             b'Transfer-Encoding: chunked\r\n\r\n')
+                # Fetch chunks on the executor until the stream is exhausted #
+                while (chunk := await self.run_blocking(next, stream, None)) is not None:
+                    writer.writelines((f'{len(chunk):X}\r\n'.encode(), chunk, b'\r\n'))
+                    await writer.drain()
+
+                writer.write(b'0\r\n\r\n')
+                await writer.drain()
+
+            finally:
+                # Release the borrowed read connection #
+                await self.run_blocking(stream.close)
+
+        return True
+
+    async def listing(self, query: dict, writer) -> bool:
+        """
+        Sends a keyset page of the stored files matching the query filters, of at most
+        MAX_PAGE_SIZE files.
+
+        :param query:  Dict of parsed query parameters (filters, after and limit).
+        :param writer:  The connection stream writer.
+        :return:  True so the connection can serve another request.
+        """
+        filters = {key: cast(query[param][0]) for param, (key, cast) in LIST_PARAMS.items()
+                   if param in query}
+        after = int(query.get('after', [0])[0])
+        limit = min(int(query.get('limit', [PAGE_SIZE])[0]), MAX_PAGE_SIZE)
+
+        def list_page():
+            items = self.store.list(page_size=limit, after_id=after, **filters)
+            try:
+                return list(islice(items, limit))
+
+            finally:
+                items.close()
+
+        async with self.read_slots:
+            files = await self.run_blocking(list_page)
+
+        return await self.send(writer, 200, {'files': files,
+                                             'next': files[-1]['id'] if files else None})
+
+    async def search(self, query: dict, writer) -> bool:
+        """
+        Sends the stored text files matching a full-text query, best match first.
+
+        :param query:  Dict of parsed query parameters (q and limit).
+        :param writer:  The connection stream writer.
+        :return:  True so the connection can serve another request.
+        """
+        # If there is no full-text query #
+        if 'q' not in query:
+            return await self.send(writer, 400, {'error': 'Missing query parameter q'})
+
+        limit = int(query.get('limit', [SEARCH_LIMIT])[0])
+        try:
+            async with self.read_slots:
+                matches = await self.run_blocking(self.store.search, query['q'][0], limit)
+
+        # If the full-text query syntax is invalid #
+        except sqlite3.OperationalError as op_err:
+            return await self.send(writer, 400, {'error': str(op_err)})
+
+        return await self.send(writer, 200, {'query': query['q'][0], 'matches': matches})
+
+    async def similar(self, name: str, query: dict, writer) -> bool:
+        """
+        Sends the stored images within a Hamming distance of a stored image, closest first.
+
+        :param name:  The stored image name.
+        :param query:  Dict of parsed query parameters (distance and limit).
+        :param writer:  The connection stream writer.
+        :return:  True so the connection can serve another request.
+        """
+        distance = int(query.get('distance', [SIMILAR_DISTANCE])[0])
+        limit = int(query.get('limit', [SIMILAR_LIMIT])[0])
+
+        async with self.read_slots:
+            matches = await self.run_blocking(self.store.similar, name, distance, limit)
+
+        return await self.send(writer, 200, {'name': name, 'matches': matches})
+
+
+async def serve(db_file, host='127.0.0.1', port=8080, socket_path=None,
+                readers=SERVER_READERS, max_clients=MAX_CLIENTS, profile=None,
+                cache_bytes=CACHE_BYTES):
+    """
+    Serves the storage database over localhost TCP or a Unix socket until cancelled.
+
+    :param db_file:  The path to the storage database.
+    :param host:  The address to listen on.
+    :param port:  The TCP port to listen on.
+    :param socket_path:  The Unix socket path to listen on instead of TCP, None for TCP.
+    :param readers:  The number of pooled read-only connections.
+    :param max_clients:  The max number of requests handled at once.
+    :param profile:  The name of the performance profile, None for the default.
+    :param cache_bytes:  The memory budget of the cache of hot file content, 0 to disable it.
+    :return:  Nothing
+    """
+    with FileStore(db_file, readers=readers, profile=profile, cache_bytes=cache_bytes) as store:
+        server = FileServer(store, readers, max_clients)
+        # If the server listens on a Unix socket #
+        if socket_path:
+            listener = await asyncio.start_unix_server(server.handle, path=socket_path,
+                                                       limit=HEADER_LIMIT)
+        # If the server listens on TCP #
+        else:
+            listener = await asyncio.start_server(server.handle, host, port, limit=HEADER_LIMIT)
+
+        address = socket_path or '{}:{}'.format(*listener.sockets[0].getsockname()[:2])
+        print(json.dumps({'command': 'serve', 'listening': address}), flush=True)
+
+        try:
+            async with listener:
+                await listener.serve_forever()
+
+        finally:
+            server.executor.shutdown(wait=True, cancel_futures=True)
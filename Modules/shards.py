@@ -0,0 +1,543 @@
+""" Built-in modules """
+import hashlib
+import heapq
+import io
+import json
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from itertools import islice
+from pathlib import Path
+# Custom Modules #
+from Modules.catalog import LIST_KEYS, PAGE_SIZE, list_files, list_names
+from Modules.codec import decompress
+from Modules.file_store import FileStore
+from Modules.ingest import QUEUE_DEPTH, ingest_files, queue_get, queue_put
+from Modules.search import SEARCH_LIMIT
+from Modules.storage import delete_file_row, insert_file, store_phash
+from Modules.utils import query_handler, query_chunk_copy, query_item_locate, \
+                          query_item_version, query_phash_fetch
+
+
+# Default number of shards of a new sharded layout #
+SHARD_COUNT = 4
+# Pooled read-only connections per shard #
+SHARD_READERS = 2
+# Statistics summed across shards, the ratios being recomputed from the sums #
+SUMMED_STATS = ('files', 'logical_bytes', 'chunks', 'unique_chunks', 'unique_bytes',
+                'stored_bytes', 'bytes_saved')
+
+
+def shard_of(name: str, shards: int) -> int:
+    """
+    Routes a file name to a shard with a stable hash, the same in every process and run unlike
+    the salted built-in hash.
+
+    :param name:  The stored file name.
+    :param shards:  The number of shards.
+    :return:  The index of the shard the name belongs to.
+    """
+    digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+
+def shard_path(db_file: Path, index: int) -> Path:
+    """
+    Formats the path of a shard alongside the unsharded database (Dbs/storage.0.db, etc.).
+
+    :param db_file:  The path of the unsharded storage database.
+    :param index:  The index of the shard.
+    :return:  The path of the shard database file.
+    """
+    return db_file.with_name(f'{db_file.stem}.{index}{db_file.suffix}')
+
+
+def count_shards(db_file: Path) -> int:
+    """
+    Counts the shards of an existing sharded layout, numbered from 0 without gaps.
+
+    :param db_file:  The path of the unsharded storage database.
+    :return:  The number of shards, 0 if there is no sharded layout.
+    """
+    count = 0
+    # Count shard files until the next index is missing #
+    while shard_path(db_file, count).exists():
+        count += 1
+
+    return count
+
+
+def layout_path(db_file: Path) -> Path:
+    """
+    Formats the path of the layout file alongside the shards (Dbs/storage.layout.json).
+
+    :param db_file:  The path of the unsharded storage database.
+    :return:  The path of the layout file.
+    """
+    return db_file.with_name(f'{db_file.stem}.layout.json')
+
+
+def read_layout(db_file: Path) -> int:
+    """
+    Reads the shard count names are routed with, persisted while it differs from the number of
+    shard files, as after a shrink keeping shards that hold conflicting items.
+
+    :param db_file:  The path of the unsharded storage database.
+    :return:  The routed shard count, 0 if none is persisted.
+    """
+    try:
+        return json.loads(layout_path(db_file).read_text())['shards']
+
+    # If no routed shard count is persisted #
+    except FileNotFoundError:
+        return 0
+
+
+def write_layout(db_file: Path, shards: int, files: int):
+    """
+    Persists the shard count names are routed with, removing the layout file once it matches
+    the number of shard files. The file is replaced atomically so it is never read half written.
+
+    :param db_file:  The path of the unsharded storage database.
+    :param shards:  The routed shard count.
+    :param files:  The number of shard files.
+    :return:  Nothing
+    """
+    path = layout_path(db_file)
+    # If the names are routed to every shard file #
+    if shards == files:
+        path.unlink(missing_ok=True)
+        return
+
+    temp_path = path.with_suffix('.tmp')
+    temp_path.write_text(json.dumps({'shards': shards}))
+    os.replace(temp_path, path)
+
+
+def copy_chunks(connection, file_id: int, ext_type: str):
+    """
+    Lazily yields the chunks of a stored item as prepared chunk tuples, reusing the stored hash
+    and compressed bytes so the content is not compressed again. TEXT chunks are decompressed
+    for the full-text index of the destination.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param file_id:  The id of the stored item.
+    :param ext_type:  The storage type of the item (TEXT or IMAGE).
+    :return:  Generator of prepared chunk tuples (see codec.prepare_chunk).
+    """
+    seq = 0
+    # Fetch chunks by sequence number until there are none left #
+    while row := query_handler(connection, query_chunk_copy(), file_id, seq, fetch='one'):
+        digest, size, codec, data = row
+        yield digest, size, codec, data, decompress(data, codec) if ext_type == 'TEXT' else None
+        seq += 1
+
+
+class ShardedStore:
+    """ Storage spread over several database files, each name routed to one by a stable hash. """
+    def __init__(self, db_file, shards=None, level=None, readers=SHARD_READERS, profile=None):
+        """
+        Sharded store initializer, opening each shard as a file store in concurrent mode so
+        shards are written and queried in parallel.
+
+        :param db_file:  The path of the unsharded storage database the shards are named after.
+        :param shards:  The number of shards, None for the existing layout or SHARD_COUNT if
+                        there is none. It must match an existing layout, see rebalance.
+        :param level:  The compression level, None for the codec default.
+        :param readers:  The number of pooled read-only connections per shard.
+        :param profile:  The name of the performance profile, None for the default.
+        """
+        self.db_file = Path(db_file)
+        self.level = level
+        self.readers = readers
+        self.profile = profile
+        existing = count_shards(self.db_file)
+        routed = read_layout(self.db_file) or existing
+
+        # If the routed shard count is more than the shard files #
+        if routed > existing:
+            raise ValueError(f'Layout routes to {routed} shards but only {existing} exist')
+
+        # If the shard count differs from the existing layout #
+        if shards and existing and shards != routed:
+            raise ValueError(f'Layout has {routed} shards, rebalance to change it to {shards}')
+
+        self.stores = [self.open_shard(index)
+                       for index in range(existing or shards or SHARD_COUNT)]
+        # Number of shards names are routed to, fewer than the shard files after a shrink kept #
+        # shards holding conflicting items #
+        self.shards = routed or len(self.stores)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.stores))
+
+    def __enter__(self):
+        """
+        Method for managing what is returned into the context manager as proxy variable(store).
+
+        :return:  The sharded store instance.
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        """
+        Method for handling the events that occurs when exiting context manager, closing the
+        shards.
+
+        :param exc_type:  The exception type.
+        :param exc_val:  The exception value.
+        :param traceback:  Exception traceback occurrence in stack.
+        """
+        self.close()
+
+    def open_shard(self, index: int) -> FileStore:
+        """
+        Opens a shard, creating it if it does not exist yet.
+
+        :param index:  The index of the shard.
+        :return:  The file store of the shard.
+        """
+        return FileStore(shard_path(self.db_file, index), self.level, self.readers,
+                         profile=self.profile)
+
+    def close(self):
+        """
+        Shuts down the fan-out threads and closes the shards.
+
+        :return:  Nothing
+        """
+        self.executor.shutdown()
+        # Iterate through the shards and close them #
+        for store in self.stores:
+            store.close()
+
+    def fan_out(self, func) -> list:
+        """
+        Runs a call against every shard concurrently.
+
+        :param func:  Callable receiving the file store of a shard.
+        :return:  List of the results, in shard order.
+        """
+        return list(self.executor.map(func, self.stores))
+
+    def route(self, name: str) -> FileStore:
+        """
+        Finds the shard a name is routed to.
+
+        :param name:  The stored file name.
+        :return:  The file store of the shard.
+        """
+        return self.stores[shard_of(name, self.shards)]
+
+    def locate(self, name: str) -> FileStore:
+        """
+        Finds the shard holding a stored item, looking in the other shards only if it is missing
+        from the one it is routed to, as after an interrupted rebalance.
+
+        :param name:  The stored file name.
+        :return:  The file store of the shard holding the item.
+        """
+        routed = self.route(name)
+        # Iterate through the routed shard first, then the others #
+        for store in [routed] + [store for store in self.stores if store is not routed]:
+            with store.reading() as connection:
+                # If the shard holds the item #
+                if query_handler(connection, query_item_locate(), name, fetch='one'):
+                    return store
+
+        raise KeyError(name)
+
+    def put(self, source, name=None, ext_type=None) -> tuple:
+        """
+        Stores a file in the shard its name is routed to (see FileStore.put).
+
+        :param source:  The path of the file to be stored, its content bytes, or an iterable of
+                        its content chunks.
+        :param name:  The name the item is stored under, defaults to the file name for paths.
+        :param ext_type:  The storage type (TEXT or IMAGE), None for the one of the extension.
+        :return:  Tuple of (shard index, id of the item within the shard).
+        """
+        # If a file on disk is stored under its own name #
+        if name is None and isinstance(source, (str, os.PathLike)):
+            name = Path(source).name
+        # If the content was not given a name #
+        elif name is None:
+            raise ValueError('A name is required to store in-memory content')
+
+        store = self.route(name)
+
+        return self.stores.index(store), store.put(source, name, ext_type)
+
+    def store_files(self, jobs, reencode=False, queue_depth=QUEUE_DEPTH):
+        """
+        Stores ingest jobs, each shard being written by its own thread over its own connection
+        so shards commit their batches in parallel. The calling thread routes the jobs into a
+        bounded queue per shard, so a lazy walk keeps memory bounded.
+
+        :param jobs:  Iterable of (stored name, file extension, storage type, source path) tuples.
+        :param reencode:  If set to True, images are decoded and re-encoded through OpenCV.
+        :param queue_depth:  The max number of jobs queued per shard.
+        :return:  Tuple of the lists of stored and failed source paths.
+        """
+        queues = [queue.Queue(maxsize=queue_depth) for _ in self.stores]
+        stop = threading.Event()
+
+        def drain(pipe):
+            # Yield jobs until the router signals the end or the pipeline is shut down #
+            while (job := queue_get(pipe, stop)) is not None:
+                yield job
+
+        def write(store, pipe):
+            try:
+                with store.writing() as connection:
+                    return ingest_files(connection, drain(pipe), reencode, workers=1,
+                                        level=self.level)
+
+            # If the shard could not be written, stop routing jobs to the other shards #
+            except BaseException:
+                stop.set()
+                raise
+
+        # Discard the progress printed by the writers, redirected once as stdout is global #
+        with redirect_stdout(io.StringIO()):
+            futures = [self.executor.submit(write, store, pipe)
+                       for store, pipe in zip(self.stores, queues)]
+            try:
+                # Iterate through the jobs routing each to the queue of its shard #
+                for job in jobs:
+                    queue_put(queues[shard_of(job[0], self.shards)], job, stop)
+
+                # Signal each shard writer there are no more jobs #
+                for pipe in queues:
+                    queue_put(pipe, None, stop)
+
+                writers = [future.result() for future in futures]
+
+            finally:
+                # Shut down the pipeline so no writer stays blocked on a queue #
+                stop.set()
+
+        return [source for writer in writers for source in writer.stored], \
+               [source for writer in writers for source in writer.failed]
+
+    def get(self, name: str):
+        """
+        Streams the content of a stored item one chunk at a time.
+
+        :param name:  The stored file name.
+        :return:  Generator of content byte chunks in file order.
+        """
+        return self.locate(name).get(name)
+
+    def extract(self, dest_path, names=None, pattern=None, ext_type=None) -> list:
+        """
+        Extracts stored items to a directory, each shard extracting its own items concurrently.
+
+        :param dest_path:  The directory the items are extracted to.
+        :param names:  Iterable of stored file names, None to select by glob and type.
+        :param pattern:  Name glob of the items extracted, None for any name.
+        :param ext_type:  The storage type of the items extracted, None for any type.
+        :return:  List of (name, error) results, error being None for extracted items and
+                  'Not found' for names not stored.
+        """
+        groups, missing = {id(store): [] for store in self.stores}, []
+        # Iterate through the target names grouping them by the shard holding them #
+        for name in names or ():
+            try:
+                groups[id(self.locate(name))].append(name)
+
+            # If no shard holds the item #
+            except KeyError:
+                missing.append((name, 'Not found'))
+
+        # If the items are selected by name, only shards holding some are extracted from #
+        if names is not None:
+            results = self.fan_out(lambda store: store.extract(dest_path, groups[id(store)],
+                                                               workers=1)
+                                   if groups[id(store)] else [])
+        # If the items are selected by glob and type #
+        else:
+            results = self.fan_out(lambda store: store.extract(dest_path, None, pattern,
+                                                               ext_type, workers=1))
+
+        return [result for shard in results for result in shard] + missing
+
+    def delete(self, name: str):
+        """
+        Deletes a stored item from the shard holding it.
+
+        :param name:  The stored file name.
+        :return:  Nothing
+        """
+        self.locate(name).delete(name)
+
+    def list(self, limit=None, **filters) -> list:
+        """
+        Lists the metadata of the stored items matching the filters, each shard being queried
+        concurrently for its first names in name order and the results merged by name. Ids are
+        only unique within a shard.
+
+        :param limit:  The max number of items listed, None for all.
+        :param filters:  Keyword listing filters (see catalog.list_files).
+        :return:  List of item metadata dicts with the index of their shard, ordered by name.
+        """
+        def shard_names(store: FileStore) -> list:
+            rows, after_name = [], ''
+            with store.reading() as connection:
+                # Fetch name ordered pages until the limit is met or the shard is exhausted #
+                while page := list_names(connection, after_name,
+                                         PAGE_SIZE if limit is None else limit - len(rows),
+                                         **filters):
+                    rows += page
+                    after_name = page[-1][1]
+                    # If the limit is met #
+                    if limit is not None and len(rows) >= limit:
+                        break
+
+            return rows
+
+        pages = self.fan_out(shard_names)
+        merged = heapq.merge(*[[dict(zip(LIST_KEYS, row), shard=index) for row in page]
+                               for index, page in enumerate(pages)],
+                             key=lambda item: item['name'])
+
+        return list(islice(merged, limit))
+
+    def search(self, query: str, limit=SEARCH_LIMIT) -> list:
+        """
+        Full-text searches every shard concurrently, merging the best matches of each by rank.
+        Ranks are computed per shard, so they are comparable only approximately.
+
+        :param query:  The FTS5 full-text query.
+        :param limit:  The max number of items returned.
+        :return:  List of match dicts with the index of their shard, best match first.
+        """
+        pages = self.fan_out(lambda store: store.search(query, limit))
+        merged = heapq.merge(*[[dict(match, shard=index) for match in page]
+                               for index, page in enumerate(pages)],
+                             key=lambda match: match['rank'])
+
+        return list(islice(merged, limit))
+
+    def stats(self) -> dict:
+        """
+        Gathers the storage statistics of every shard concurrently and combines them. Content
+        is only deduplicated within a shard.
+
+        :return:  Dict of storage statistics with the per-shard file counts.
+        """
+        shards = self.fan_out(lambda store: store.stats())
+        stats = {key: sum(shard[key] for shard in shards) for key in SUMMED_STATS}
+        stats['dedup_ratio'] = round(stats['logical_bytes'] / stats['unique_bytes'], 3) \
+            if stats['unique_bytes'] else 1.0
+        stats['compression_ratio'] = round(stats['unique_bytes'] / stats['stored_bytes'], 3) \
+            if stats['stored_bytes'] else 1.0
+        stats['shard_files'] = [shard['files'] for shard in shards]
+
+        return stats
+
+    @staticmethod
+    def move_item(source: FileStore, target: FileStore, row: tuple) -> bool:
+        """
+        Moves an item between shards, copying its stored chunks without compressing them again,
+        then deleting it from the source. The copy and the delete are separate transactions, so
+        an item already copied by an interrupted rebalance is only deleted from the source once
+        the copy is confirmed by its content hash. If the target holds another item under the
+        name, the source is kept.
+
+        :param source:  The file store of the shard holding the item.
+        :param target:  The file store of the shard the item is moved to.
+        :param row:  The (id, name, path, ext, size, mtime, hash) metadata of the item.
+        :return:  True if the item was moved, False if the name conflicts on the target.
+        """
+        file_id, name, path, ext_type, _, mtime, digest = row
+        with source.reading() as src_conn, target.writing() as dest_conn:
+            phash = query_handler(src_conn, query_phash_fetch(), file_id, fetch='one')
+            try:
+                with dest_conn:
+                    new_id = insert_file(dest_conn, name, path, ext_type,
+                                         copy_chunks(src_conn, file_id, ext_type), mtime)
+                    # If the item is an image with a perceptual hash #
+                    if phash:
+                        store_phash(dest_conn, new_id, phash[0])
+
+            # If the name is already stored on the target #
+            except sqlite3.IntegrityError:
+                copied = query_handler(dest_conn, query_item_version(), name, fetch='one')
+                # If it is not a copy of the item, keep the source so nothing is lost #
+                if not copied or copied[1] is None or copied[1] != digest:
+                    return False
+
+        with source.writing() as connection:
+            delete_file_row(connection, file_id)
+
+        return True
+
+    def rebalance(self, shards: int) -> dict:
+        """
+        Changes the number of shards, moving every item whose name routes to another shard under
+        the new count. New shards are created and the new count persisted before any item moves,
+        and emptied shards are removed once every item has moved. Items whose name is held by
+        another item on their new shard are left in place and reported, a shard still holding
+        any being kept past the new count, which names are still routed with. A rebalance is
+        meant to run while nothing else writes to the shards and can be re-run if interrupted.
+
+        :param shards:  The new number of shards.
+        :return:  Dict of the old and new shard counts, the number of shard files kept, the
+                  number of items moved and the names of the items left in place.
+        """
+        # If the shard count is not positive #
+        if shards < 1:
+            raise ValueError(f'Invalid shard count: {shards}')
+
+        old_count, moved, conflicts = self.shards, 0, []
+        self.stores += [self.open_shard(index) for index in range(len(self.stores), shards)]
+        # Route with the new count from now on, so an interrupted rebalance keeps routing names #
+        # to the shards they are moved to #
+        write_layout(self.db_file, shards, len(self.stores))
+        self.shards = shards
+
+        # Iterate through every shard moving the items routed elsewhere #
+        for index, source in enumerate(self.stores):
+            after_id = 0
+            # Fetch keyset pages of item metadata until there are none left #
+            while True:
+                with source.reading() as connection:
+                    rows = list_files(connection, after_id, PAGE_SIZE)
+
+                # If every item of the shard was checked #
+                if not rows:
+                    break
+
+                # Iterate through the items of the page moving those routed elsewhere #
+                for row in rows:
+                    # If the item routes to another shard under the new count #
+                    if shard_of(row[1], shards) != index:
+                        # If the item was moved #
+                        if self.move_item(source, self.stores[shard_of(row[1], shards)], row):
+                            moved += 1
+                        # If another item holds the name on the new shard #
+                        else:
+                            conflicts.append(row[1])
+
+                after_id = rows[-1][0]
+
+        # Iterate through the emptied shards from the last and remove their files #
+        for index in range(len(self.stores) - 1, shards - 1, -1):
+            with self.stores[index].reading() as connection:
+                # If the shard still holds items left in place, it and those before it are kept #
+                if list_files(connection, 0, 1):
+                    break
+
+            self.stores.pop().close()
+            # Iterate through the database and write-ahead log files of the shard #
+            for suffix in ('', '-wal', '-shm'):
+                Path(f'{shard_path(self.db_file, index)}{suffix}').unlink(missing_ok=True)
+
+        write_layout(self.db_file, shards, len(self.stores))
+        self.executor.shutdown()
+        self.executor = ThreadPoolExecutor(max_workers=len(self.stores))
+
+        return {'from': old_count, 'to': shards, 'databases': len(self.stores), 'moved': moved,
+                'conflicts': conflicts}
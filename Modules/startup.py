@@ -0,0 +1,197 @@
+""" Built-in modules """
+import atexit
+import json
+import sys
+import time
+from importlib.abc import Loader, MetaPathFinder
+
+
+# Command line flag enabling the startup profile, handled before argument parsing #
+STARTUP_FLAG = '--profile-startup'
+# Max number of modules listed in the startup report, slowest cumulative import first #
+STARTUP_TOP = 25
+
+
+class TimedLoader(Loader):
+    """ Loader proxy timing the creation and execution of a module. """
+    def __init__(self, loader, profiler, name: str):
+        """
+        Timed loader initializer.
+
+        :param loader:  The loader found by the regular import machinery.
+        :param profiler:  The startup profiler the timings are recorded to.
+        :param name:  The full name of the module being loaded.
+        """
+        self.loader = loader
+        self.profiler = profiler
+        self.name = name
+
+    def __getattr__(self, attr: str):
+        """
+        Forwards any other loader attribute to the proxied loader.
+
+        :param attr:  The attribute name.
+        :return:  The proxied loader attribute.
+        """
+        return getattr(self.loader, attr)
+
+    def create_module(self, spec):
+        """
+        Creates the module, timed as extension modules are initialized here.
+
+        :param spec:  The module spec.
+        :return:  The created module, None for the default module creation.
+        """
+        with self.profiler.timing(self.name):
+            return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        """
+        Executes the module body, including the imports it makes.
+
+        :param module:  The module to be executed.
+        :return:  Nothing
+        """
+        with self.profiler.timing(self.name):
+            self.loader.exec_module(module)
+
+
+class ModuleTimer:
+    """ Context manager adding an elapsed time to a module, minus its nested imports. """
+    def __init__(self, profiler, name: str):
+        """
+        Module timer initializer.
+
+        :param profiler:  The startup profiler the timing is recorded to.
+        :param name:  The full name of the module being loaded.
+        """
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+        self.nested = 0.0
+
+    def __enter__(self):
+        """
+        Method for managing what is returned into the context manager as proxy variable(timer),
+        starting the clock with the module pushed on the stack of modules being loaded.
+
+        :return:  The module timer instance.
+        """
+        self.profiler.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        """
+        Method for handling the events that occurs when exiting context manager, adding the
+        elapsed time to the module and to the nested time of the module importing it.
+
+        :param exc_type:  The exception type.
+        :param exc_val:  The exception value.
+        :param traceback:  Exception traceback occurrence in stack.
+        :return:  Nothing
+        """
+        elapsed = time.perf_counter() - self.start
+        self.profiler.stack.pop()
+        timings = self.profiler.modules.setdefault(self.name, [0.0, 0.0])
+        timings[0] += elapsed - self.nested
+        timings[1] += elapsed
+
+        # If the module was imported by another module, its time is not the importer's own #
+        if self.profiler.stack:
+            self.profiler.stack[-1].nested += elapsed
+
+
+class StartupProfiler(MetaPathFinder):
+    """ Import hook timing each module loaded at startup and the time to the first query. """
+    def __init__(self):
+        """
+        Startup profiler initializer, the clock starting on creation.
+        """
+        self.start = time.perf_counter()
+        # Self and cumulative seconds by module name #
+        self.modules = {}
+        # Timers of the modules being loaded, innermost last #
+        self.stack = []
+        self.first_query = None
+
+    def find_spec(self, fullname: str, path, target=None):
+        """
+        Finds the module through the other finders, wrapping its loader to be timed.
+
+        :param fullname:  The full name of the module.
+        :param path:  The package search path, None for top-level modules.
+        :param target:  The module being reloaded, if any.
+        :return:  The module spec with a timed loader, None if no other finder found it.
+        """
+        # Iterate through the other finders in their regular order #
+        for finder in sys.meta_path:
+            # If the finder is this profiler or does not find specs #
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+
+            spec = finder.find_spec(fullname, path, target)
+            # If the finder did not find the module #
+            if spec is None:
+                continue
+
+            # If the module is loaded by a loader that can be timed #
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = TimedLoader(spec.loader, self, fullname)
+
+            return spec
+
+        return None
+
+    def timing(self, name: str) -> ModuleTimer:
+        """
+        Times a step of loading a module.
+
+        :param name:  The full name of the module.
+        :return:  The module timer context manager.
+        """
+        return ModuleTimer(self, name)
+
+    def query_done(self):
+        """
+        Records the time of the first completed query, called by the query handler.
+
+        :return:  Nothing
+        """
+        # If this is the first query #
+        if self.first_query is None:
+            self.first_query = time.perf_counter()
+
+    def report(self) -> dict:
+        """
+        Builds the startup report of the slowest imports and the time to the first query.
+
+        :return:  Dict of the startup timings in milliseconds.
+        """
+        ranked = sorted(self.modules.items(), key=lambda item: -item[1][1])
+        imports = sum(timings[0] for timings in self.modules.values())
+        return {'startup': {
+            'import_ms': round(imports * 1000, 3), 'modules_loaded': len(self.modules),
+            'first_query_ms': None if self.first_query is None
+                              else round((self.first_query - self.start) * 1000, 3),
+            'modules': [{'module': name, 'self_ms': round(timings[0] * 1000, 3),
+                         'cumulative_ms': round(timings[1] * 1000, 3)}
+                        for name, timings in ranked[:STARTUP_TOP]]}}
+
+
+def profile_startup(argv: list) -> StartupProfiler:
+    """
+    Starts profiling the startup, removing the flag from the arguments. The report is written to
+    stderr as a JSON document on exit, keeping the stdout of commands parseable.
+
+    :param argv:  The command line arguments, edited in place.
+    :return:  The started startup profiler.
+    """
+    argv.remove(STARTUP_FLAG)
+    profiler = StartupProfiler()
+    sys.meta_path.insert(0, profiler)
+    # Imported once the profiler is installed, so its import is timed as well #
+    from Modules.instrument import QUERY_STATS
+    QUERY_STATS.on_first_query = profiler.query_done
+    atexit.register(lambda: print(json.dumps(profiler.report(), indent=2), file=sys.stderr))
+    return profiler
@@ -0,0 +1,260 @@
+""" Built-in modules """
+import hashlib
+# Custom Modules #
+from Modules.codec import decompress
+from Modules.utils import FTS_SEGMENT_BITS, FTS_SEQ_BITS, query_handler, query_blob_collect, \
+                          query_blob_drop, query_blob_release, query_chunk_blobs, \
+                          query_chunk_delete, query_chunk_fetch, query_fts_delete, \
+                          query_fts_insert, query_item_delete, query_item_digest, \
+                          query_item_update, \
+                          query_phash_delete, query_phash_store, \
+                          query_stats_blobs, query_stats_files, query_stats_fts, query_store_blob, \
+                          query_store_chunk, query_store_item, query_store_summary
+
+
+# Number of content bytes held per chunk row #
+CHUNK_SIZE = 1024 * 1024
+# Max number of characters per full-text index segment, keeping bm25 and snippets local #
+FTS_SEGMENT_SIZE = 4096
+
+
+def split_payload(payload: bytes, chunk_size=CHUNK_SIZE):
+    """
+    Lazily splits an in-memory payload into chunk size slices without copying it.
+
+    :param payload:  The payload bytes to be split.
+    :param chunk_size:  The number of bytes per chunk.
+    :return:  Generator of payload memoryview slices.
+    """
+    view = memoryview(payload)
+    # Iterate through the payload in chunk size steps #
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
+
+
+def store_blob(connection, digest: str, size: int, codec: str, data) -> int:
+    """
+    Stores a prepared chunk addressed by its SHA-256 hash within the caller's transaction. If the
+    same content is already stored, its reference count is incremented instead.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param digest:  The SHA-256 hex digest of the raw chunk.
+    :param size:  The raw size of the chunk in bytes.
+    :param codec:  The codec the chunk was compressed with.
+    :param data:  The stored chunk bytes.
+    :return:  The id of the blob holding the content.
+    """
+    return query_handler(connection, query_store_blob(), digest, size, codec, data, fetch='one',
+                         commit=False)[0]
+
+
+def file_digest(chunk_digests) -> str:
+    """
+    Derives the content hash of a file from the SHA-256 hex digests of its chunks in order, so the
+    file content does not have to be hashed a second time.
+
+    :param chunk_digests:  Iterable of chunk hex digests in file order.
+    :return:  The SHA-256 hex digest of the concatenated chunk digests.
+    """
+    return hashlib.sha256(''.join(chunk_digests).encode()).hexdigest()
+
+
+def insert_file(connection, name: str, path: str, ext_type: str, chunks, mtime=None) -> int:
+    """
+    Stores the metadata row and content-addressed chunks of a file within the caller's
+    transaction, adding the text of TEXT chunks to the full-text index. The chunks are consumed
+    lazily, so a file streamed from disk is never held in memory as a whole.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param name:  The file name the item is stored under.
+    :param path:  The directory the file was stored from.
+    :param ext_type:  The storage type of the file (TEXT or IMAGE).
+    :param chunks:  Iterable of prepared chunk tuples in file order (see codec.prepare_chunk).
+    :param mtime:  The modification time of the source file, None if unknown.
+    :return:  The id of the stored item.
+    """
+    # Store the metadata row and get its id #
+    file_id = query_handler(connection, query_store_item(), name, path, ext_type, mtime,
+                            fetch='one', commit=False)[0]
+    store_content(connection, file_id, chunks)
+
+    return file_id
+
+
+def replace_file(connection, file_id: int, path: str, ext_type: str, chunks, mtime=None):
+    """
+    Replaces the content of a stored item within the caller's transaction, keeping its id. A
+    prepared chunk list hashing to the stored content only refreshes the metadata. Otherwise the
+    old references are released before the new chunks are stored, so blobs shared by both
+    versions are kept rather than deleted and stored again.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param file_id:  The id of the stored item.
+    :param path:  The directory the file was stored from.
+    :param ext_type:  The storage type of the file (TEXT or IMAGE).
+    :param chunks:  Iterable of prepared chunk tuples in file order (see codec.prepare_chunk).
+    :param mtime:  The modification time of the source file, None if unknown.
+    :return:  True if the content changed, False if only the metadata was refreshed.
+    """
+    query_handler(connection, query_item_update(), path, ext_type, mtime, file_id, commit=False)
+
+    # If the new content is in memory and hashes to the stored content #
+    if isinstance(chunks, list):
+        stored = query_handler(connection, query_item_digest(), file_id, fetch='one',
+                               commit=False)
+        # If the content is unchanged #
+        if stored[0] == file_digest(chunk[0] for chunk in chunks):
+            return False
+
+    blob_ids = query_handler(connection, query_chunk_blobs(), file_id, fetch='all', commit=False)
+    query_handler(connection, query_blob_release(), file_id, file_id, commit=False)
+    query_handler(connection, query_chunk_delete(), file_id, commit=False)
+    query_handler(connection, query_fts_delete(), file_id, file_id, commit=False)
+    query_handler(connection, query_phash_delete(), file_id, commit=False)
+    store_content(connection, file_id, chunks)
+    # Delete the old blobs the new content did not reference again #
+    query_handler(connection, query_blob_drop(), blob_ids, many=True, commit=False)
+
+    return True
+
+
+def store_content(connection, file_id: int, chunks):
+    """
+    Stores the content-addressed chunks of an item within the caller's transaction, then sets
+    its size and content hash.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param file_id:  The id of the stored item.
+    :param chunks:  Iterable of prepared chunk tuples in file order (see codec.prepare_chunk).
+    :return:  Nothing
+    """
+    size, digests = 0, []
+
+    # Iterate through the chunks storing each by content and referencing it in sequence #
+    for seq, chunk in enumerate(chunks):
+        blob_id = store_blob(connection, *chunk[:4])
+        query_handler(connection, query_store_chunk(), file_id, seq, blob_id, commit=False)
+        # If the chunk carries text to be indexed #
+        if chunk[4] is not None:
+            index_text(connection, file_id, seq, chunk[4])
+        size += chunk[1]
+        digests.append(chunk[0])
+
+    # Set the size and content hash now that all the chunks are counted #
+    query_handler(connection, query_store_summary(), size, file_digest(digests), file_id,
+                  commit=False)
+
+
+def text_segments(data) -> list:
+    """
+    Splits the text of a chunk into the segments it is indexed as, at spaces so a match is ranked
+    and highlighted within its own passage. Bytes that are not valid UTF-8, such as a character
+    split across chunks, are skipped.
+
+    :param data:  The raw chunk bytes.
+    :return:  List of the text segments, each at least half the max size but the last.
+    """
+    text = str(data, 'utf-8', 'ignore')
+    segments, start = [], 0
+
+    # Iterate through the text until it is all segmented #
+    while start < len(text):
+        end = start + FTS_SEGMENT_SIZE
+        # If the segment is not the last, end it at a space when there is one #
+        if end < len(text):
+            space = text.rfind(' ', start + FTS_SEGMENT_SIZE // 2, end)
+            end = space + 1 if space != -1 else end
+
+        segments.append(text[start:end])
+        start = end
+
+    return segments
+
+
+def index_text(connection, file_id: int, seq: int, data):
+    """
+    Adds the text of a chunk to the full-text index within the caller's transaction, one row per
+    text segment.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param file_id:  The id of the stored item.
+    :param seq:  The sequence number of the chunk.
+    :param data:  The raw chunk bytes.
+    :return:  Nothing
+    """
+    rowid = (file_id << FTS_SEQ_BITS) | (seq << FTS_SEGMENT_BITS)
+    query_handler(connection, query_fts_insert(),
+                  [(rowid + index, segment) for index, segment in enumerate(text_segments(data))],
+                  many=True, commit=False)
+
+
+def store_phash(connection, file_id: int, phash: int):
+    """
+    Stores the perceptual hash of an image item within the caller's transaction.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param file_id:  The id of the stored item.
+    :param phash:  The signed 64-bit perceptual hash, None if the image could not be decoded.
+    :return:  Nothing
+    """
+    # If the image was hashed #
+    if phash is not None:
+        query_handler(connection, query_phash_store(), file_id, phash, commit=False)
+
+
+def delete_file_row(connection, file_id: int):
+    """
+    Deletes an item in a single transaction, releasing its references on the content blobs,
+    garbage-collecting any blob no longer referenced by a stored file and removing its text from
+    the full-text index and its perceptual hash.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param file_id:  The id of the item to be deleted.
+    :return:  Nothing
+    """
+    with connection:
+        query_handler(connection, query_blob_release(), file_id, file_id, commit=False)
+        query_handler(connection, query_blob_collect(), file_id, commit=False)
+        query_handler(connection, query_chunk_delete(), file_id, commit=False)
+        query_handler(connection, query_fts_delete(), file_id, file_id, commit=False)
+        query_handler(connection, query_phash_delete(), file_id, commit=False)
+        query_handler(connection, query_item_delete(), file_id, commit=False)
+
+
+def get_stats(connection) -> dict:
+    """
+    Gathers storage statistics comparing the logical size of the stored files to the size of the
+    unique content and the compressed size actually stored, along with the size of the full-text
+    index and the segment text it holds.
+
+    :param connection:  The protected database connection to be interacted with.
+    :return:  Dict of storage statistics.
+    """
+    files, logical_bytes = query_handler(connection, query_stats_files(), fetch='one')
+    blobs, unique_bytes, stored_bytes, refs = query_handler(connection, query_stats_blobs(),
+                                                            fetch='one')
+    index_bytes = query_handler(connection, query_stats_fts(), fetch='one')[0]
+
+    return {'files': files, 'logical_bytes': int(logical_bytes),
+            'chunks': int(refs), 'unique_chunks': blobs, 'unique_bytes': int(unique_bytes),
+            'stored_bytes': int(stored_bytes),
+            'bytes_saved': int(logical_bytes - stored_bytes),
+            'dedup_ratio': round(logical_bytes / unique_bytes, 3) if unique_bytes else 1.0,
+            'compression_ratio': round(unique_bytes / stored_bytes, 3) if stored_bytes else 1.0,
+            'index_bytes': int(index_bytes)}
+
+
+def iter_content(connection, file_id: int):
+    """
+    Lazily reassembles the content of a stored item one chunk at a time.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param file_id:  The id of the stored item.
+    :return:  Generator of content byte chunks in file order.
+    """
+    seq = 0
+    # Fetch chunks by sequence number until there are none left #
+    while row := query_handler(connection, query_chunk_fetch(), file_id, seq, fetch='one'):
+        # Decompress the chunk with the codec it was stored with #
+        yield decompress(row[1], row[0])
+        seq += 1
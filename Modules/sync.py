@@ -0,0 +1,103 @@
+""" Built-in modules """
+import os
+from pathlib import Path
+# Custom Modules #
+from Modules.ingest import EXTENSIONS, INGEST_WORKERS, ingest_files
+from Modules.storage import delete_file_row
+from Modules.utils import query_handler, query_item_locate, query_sync_manifest
+
+
+def scan_dir(dir_path: Path):
+    """
+    Lazily lists the supported files directly in a directory.
+
+    :param dir_path:  The directory to be scanned.
+    :return:  Generator of (directory entry, lower case file extension) tuples.
+    """
+    with os.scandir(dir_path) as entries:
+        # Iterate through the directory entries #
+        for entry in entries:
+            file_ext = entry.name.rpartition('.')[2].lower() if '.' in entry.name else ''
+            # If the entry is a file with a supported extension #
+            if file_ext in EXTENSIONS and entry.is_file():
+                yield entry, file_ext
+
+
+def sync_dir(connection, dir_path, prune=False, workers=INGEST_WORKERS, level=None) -> dict:
+    """
+    Brings the items stored from a directory in line with its files. The stored metadata serves
+    as the manifest: files whose size and modification time match it are skipped without being
+    read, changed files have their content replaced and new files are stored. Items are matched
+    to files by the last part of their name, so items stored by a recursive walk under a relative
+    path keep that name when updated. A file matched by several items, stored from walks rooted
+    at different directories, is reported as a collision and neither it nor those items are
+    touched. Names already taken by a file from another directory are reported as conflicts and
+    left untouched.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param dir_path:  The directory to be synced.
+    :param prune:  If set to True, items whose source file disappeared are deleted.
+    :param workers:  The number of reader threads, 1 or less reads on the calling thread.
+    :param level:  The compression level, None for the codec default.
+    :return:  Dict of the sync results.
+    """
+    dir_path = Path(dir_path).absolute()
+    # Stored items keyed by stored name, each holding its stored name, id, size and mtime #
+    manifest = {row[0]: row for row
+                in query_handler(connection, query_sync_manifest(), str(dir_path), fetch='all')}
+    # Stored names by the file name they end with #
+    file_names = {}
+    # Iterate through the stored names grouping them by file name #
+    for name in manifest:
+        file_names.setdefault(name.rpartition('/')[2], []).append(name)
+
+    jobs, changed, conflicts, collisions, unchanged = [], set(), [], [], 0
+
+    # Iterate through the supported files of the directory #
+    for entry, file_ext in scan_dir(dir_path):
+        stat = entry.stat()
+        names = file_names.pop(entry.name, [])
+
+        # If several items were stored from the file, none is chosen to be updated or pruned #
+        if len(names) > 1:
+            collisions += sorted(names)
+            # Iterate through the colliding items keeping them out of the prune #
+            for name in names:
+                del manifest[name]
+            continue
+
+        known = manifest.pop(names[0]) if names else None
+
+        # If the file matches the manifest, it is skipped without being read #
+        if known and known[2] == stat.st_size and known[3] == stat.st_mtime:
+            unchanged += 1
+            continue
+
+        # If the name is taken by a file stored from another directory #
+        if not known and query_handler(connection, query_item_locate(), entry.name, fetch='one'):
+            conflicts.append(entry.path)
+            continue
+
+        # If the file is stored but has changed #
+        if known:
+            changed.add(entry.path)
+
+        # A changed file replaces the content of the item under its stored name #
+        jobs.append((known[0] if known else entry.name, file_ext, EXTENSIONS[file_ext],
+                     Path(entry.path)))
+
+    writer = ingest_files(connection, jobs, workers=workers, level=level, upsert=True)
+    stored = {str(source) for source in writer.stored}
+    removed = []
+
+    # If the items of vanished source files are to be deleted #
+    if prune:
+        # Iterate through the manifest entries no file was found for #
+        for name, file_id, _, _ in manifest.values():
+            delete_file_row(connection, file_id)
+            removed.append(name)
+
+    return {'path': str(dir_path), 'added': len(stored - changed),
+            'updated': len(stored & changed), 'unchanged': unchanged, 'removed': removed,
+            'conflicts': conflicts, 'collisions': collisions,
+            'failed': [str(source) for source in writer.failed]}
@@ -1,21 +1,59 @@
 """ Built-in modules """
 import logging
+import os
 import sqlite3
 import sys
 import time
+# Custom Modules #
+from Modules.instrument import QUERY_STATS, query_builder
+
+
+# Named SQLite tuning profiles applied on connect, cache_size in KiB when negative #
+PROFILES = {
+    # SQLite defaults, every commit is fully synced to disk #
+    'safe': {'synchronous': 'FULL', 'cache_size': -2000, 'mmap_size': 0,
+             'temp_store': 'DEFAULT', 'page_size': 4096, 'cached_statements': 128},
+    # Large cache and memory-mapped reads, syncs at WAL checkpoints rather than every commit #
+    'balanced': {'synchronous': 'NORMAL', 'cache_size': -65536, 'mmap_size': 256 * 1024 ** 2,
+                 'temp_store': 'MEMORY', 'page_size': 4096, 'cached_statements': 256},
+    # No syncs and big pages for one-off imports, a power loss can corrupt the database #
+    'bulk-ingest': {'synchronous': 'OFF', 'cache_size': -262144, 'mmap_size': 1024 ** 3,
+                    'temp_store': 'MEMORY', 'page_size': 65536, 'cached_statements': 256},
+}
+# Bits of the full-text index rowid holding the chunk position, the rest being the file id #
+FTS_SEQ_BITS = 30
+# Low bits of the chunk position holding the text segment number within the chunk #
+FTS_SEGMENT_BITS = 10
+# Number of bits per band of the perceptual hash index, each band being indexed on its own #
+PHASH_BAND_BITS = 16
+PHASH_BANDS = 4
+# Profile applied when none is selected, overridden by the FILEDB_PROFILE environment variable #
+DEFAULT_PROFILE = os.environ.get('FILEDB_PROFILE', 'safe')
 
 
 class DbConnectionHandler:
     """ Acts as custom context manager for easy integrated management of database connections. """
-    def __init__(self, db_name):
+    def __init__(self, db_name, profile=None, **connect_args):
         """
-        Database connection initializer.
+        Database connection initializer, applying the settings of a named performance profile.
 
         :param db_name:  The string name of the database to be connected to.
+        :param profile:  The name of the profile in PROFILES, None for DEFAULT_PROFILE.
+        :param connect_args:  Extra keyword arguments passed to sqlite3.connect (uri,
+                              check_same_thread, etc.).
         """
         # Set db instance variables #
         self.db_name = db_name
-        self.connection = sqlite3.connect(self.db_name)
+        self.profile = profile or DEFAULT_PROFILE
+
+        # If the profile is not defined #
+        if self.profile not in PROFILES:
+            raise ValueError(f'Unknown database profile: {self.profile}')
+
+        settings = PROFILES[self.profile]
+        connect_args.setdefault('cached_statements', settings['cached_statements'])
+        self.connection = sqlite3.connect(self.db_name, **connect_args)
+        query_handler(self.connection, query_profile(settings), exec_script=True)
 
     def __enter__(self):
         """
@@ -38,7 +76,8 @@ class DbConnectionHandler:
         self.connection.close()
 
 
-def query_handler(connection, query, *args, exec_script=None, fetch=None):
+def query_handler(connection, query, *args, exec_script=None, fetch=None, many=None,
+                  commit=True):
     """
     Database handler to handler various db calls with session locking and error handling.
 
@@ -47,6 +86,9 @@ def query_handler(connection, query, *args, exec_script=None, fetch=None):
     :param args:  Takes variable length arguments to pass as database parameters.
     :param exec_script:  If set to True, runs executescript instead of execute.
     :param fetch:  If set to one, fetchone is returned. If set to all, fetchall is returned.
+    :param many:  If set to True, runs executemany with the first arg as the parameter rows.
+    :param commit:  If set to False, the query joins the transaction opened by the caller instead
+                    of committing/rolling back on its own.
     :return:  If fetching data, the fetched data is returned. Otherwise, None.
     """
     # If the passed in MySQL query was not a complete statement #
@@ -55,41 +97,75 @@ def query_handler(connection, query, *args, exec_script=None, fetch=None):
         print_err(f'Passed in query is not a complete MySQL statement: {query}', None)
         sys.exit(3)
 
-    # Connection context manager auto-handles commits/rollbacks #
-    with connection:
-        # If query is one-liner #
-        if not exec_script:
-            # If no args to be parsed into query #
-            if not args:
-                # Execute SQL query #
-                db_call = connection.execute(query)
-            # If args are to be parsed into query #
-            else:
-                # Execute SQL query #
-                db_call = connection.execute(query, args)
-
-        # If query is multi-liner script #
-        else:
-            # Execute SQL script #
-            db_call = connection.executescript(query)
-
-        # If the fetch flag is at default "None" #
-        if not fetch:
-            return None
-
-        # If the fetch flag is set to "one" #
-        if fetch == 'one':
-            # Return fetched row #
-            return db_call.fetchone()
-
-        # If the fetch flag is set to "all" #
-        if fetch == 'all':
-            # Return all fetched rows #
-            return db_call.fetchall()
-
-        logging.error('Fetch flag is set to unexpected value: %s', fetch)
-        print_err(f'Fetch flag is set to unexpected value: {fetch}', None)
-        sys.exit(4)
+    start = time.perf_counter()
+
+    # If the caller is managing the transaction #
+    if not commit:
+        result = run_query(connection, query, args, exec_script, fetch, many)
+    # If the query commits on its own #
+    else:
+        # Connection context manager auto-handles commits/rollbacks #
+        with connection:
+            result = run_query(connection, query, args, exec_script, fetch, many)
+
+    # If the queries are instrumented, record the time including any commit #
+    if QUERY_STATS.enabled:
+        QUERY_STATS.record(query, time.perf_counter() - start, result)
+
+    # If the startup is profiled, report the completion of the first query once #
+    if QUERY_STATS.on_first_query:
+        QUERY_STATS.on_first_query()
+        QUERY_STATS.on_first_query = None
+
+    return result
+
+
+def run_query(connection, query, args, exec_script, fetch, many):
+    """
+    Executes the query with the mode specified by query_handler and fetches the result.
+
+    :param connection:  The protected database connection to be interacted with.
+    :param query:  The query to be executed in the accessed database.
+    :param args:  Tuple of arguments to pass as database parameters.
+    :param exec_script:  If set to True, runs executescript instead of execute.
+    :param fetch:  If set to one, fetchone is returned. If set to all, fetchall is returned.
+    :param many:  If set to True, runs executemany with the first arg as the parameter rows.
+    :return:  If fetching data, the fetched data is returned. Otherwise, None.
+    """
+    # If query is multi-liner script #
+    if exec_script:
+        # Execute SQL script #
+        db_call = connection.executescript(query)
+    # If query is to be executed for each row of parameters #
+    elif many:
+        # Execute SQL query per parameter row #
+        db_call = connection.executemany(query, args[0])
+    # If no args to be parsed into query #
+    elif not args:
+        # Execute SQL query #
+        db_call = connection.execute(query)
+    # If args are to be parsed into query #
+    else:
+        # Execute SQL query #
+        db_call = connection.execute(query, args)
+
+    # If the fetch flag is at default "None" #
+    if not fetch:
+        return None
+
+    # If the fetch flag is set to "one" #
+    if fetch == 'one':
+        # Return fetched row #
+        return db_call.fetchone()
+
+    # If the fetch flag is set to "all" #
+    if fetch == 'all':
+        # Return all fetched rows #
+        return db_call.fetchall()
+
+    logging.error('Fetch flag is set to unexpected value: %s', fetch)
+    print_err(f'Fetch flag is set to unexpected value: {fetch}', None)
+    sys.exit(4)
 
 
 def db_error_query(db_error):
@@ -146,53 +222,911 @@ def db_error_query(db_error):
         print_err(f'Unexpected database exception: {db_error}', None)
 
 
+@query_builder
 def query_db_create() -> str:
     """
-    MySQL query to create the Storage table.
+    MySQL script to create the files metadata table, the content-addressed blobs table, and the
+    chunks table mapping each file to its blobs.
+
+    :return:  The formatted query.
+    """
+    return 'CREATE TABLE IF NOT EXISTS files (' \
+               'id INTEGER PRIMARY KEY AUTOINCREMENT,' \
+               'name VARCHAR(32) UNIQUE NOT NULL,' \
+               'path TINYTEXT NOT NULL,' \
+               'ext TINYTEXT NOT NULL, size INTEGER NOT NULL,' \
+               'mtime REAL, hash CHAR(64)' \
+           ');' \
+           'CREATE TABLE IF NOT EXISTS blobs (' \
+               'id INTEGER PRIMARY KEY,' \
+               'hash CHAR(64) UNIQUE NOT NULL,' \
+               'size INTEGER NOT NULL, refs INTEGER NOT NULL,' \
+               'data BLOB NOT NULL, codec VARCHAR(8) NOT NULL DEFAULT \'none\'' \
+           ');' \
+           'CREATE TABLE IF NOT EXISTS chunks (' \
+               'file_id INTEGER NOT NULL,' \
+               'seq INTEGER NOT NULL, blob_id INTEGER NOT NULL,' \
+               'PRIMARY KEY (file_id, seq)' \
+           ');' + query_files_indexes() + query_fts_create() + query_phash_create()
+
+
+@query_builder
+def query_files_indexes() -> str:
+    """
+    MySQL script to create the files metadata indexes backing filtered keyset listing.
+
+    :return:  The formatted query.
+    """
+    return 'CREATE INDEX IF NOT EXISTS files_ext ON files (ext, id);' \
+           'CREATE INDEX IF NOT EXISTS files_path ON files (path, id);' \
+           'CREATE INDEX IF NOT EXISTS files_size ON files (size);' \
+           'CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime);'
+
+
+@query_builder
+def query_fts_create() -> str:
+    """
+    MySQL script to create the FTS5 full-text index of TEXT chunk segments, each row id packing
+    the file id above the chunk sequence and segment numbers. The index holds the segment text,
+    so snippets are built and segments removed without decoding the stored content.
+
+    :return:  The formatted query.
+    """
+    return 'CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(body);'
+
+
+@query_builder
+def query_fts_delete() -> str:
+    """
+    MySQL query to remove the indexed segments of an item from the full-text index.
+
+    :return:  The formatted query.
+    """
+    return f'DELETE FROM files_fts WHERE rowid BETWEEN ? << {FTS_SEQ_BITS} ' \
+           f'AND (? << {FTS_SEQ_BITS}) | {(1 << FTS_SEQ_BITS) - 1};'
+
+
+@query_builder
+def query_fts_insert() -> str:
+    """
+    MySQL query to add a text segment of an item chunk to the full-text index.
+
+    :return:  The formatted query.
+    """
+    return 'INSERT INTO files_fts (rowid, body) VALUES (?, ?);'
+
+
+@query_builder
+def query_fts_purge() -> str:
+    """
+    MySQL query to empty the full-text index.
+
+    :return:  The formatted query.
+    """
+    return 'DELETE FROM files_fts;'
+
+
+@query_builder
+def query_fts_search() -> str:
+    """
+    MySQL query to rank the items matching a full-text query by their best matching segment,
+    the ranking being materialized as bm25 cannot be used in an aggregate.
+
+    :return:  The formatted query.
+    """
+    return 'WITH hits AS MATERIALIZED (' \
+               'SELECT rowid AS hit, bm25(files_fts) AS rank FROM files_fts ' \
+               'WHERE files_fts MATCH ?' \
+           ') SELECT files.id, files.name, min(hits.rank), hits.hit FROM hits ' \
+           f'JOIN files ON files.id = hits.hit >> {FTS_SEQ_BITS} ' \
+           'GROUP BY files.id ORDER BY min(hits.rank) LIMIT ?;'
+
+
+@query_builder
+def query_fts_snippet() -> str:
+    """
+    MySQL query to highlight the match of a full-text query in an indexed segment.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT snippet(files_fts, 0, \'[\', \']\', \'...\', ?) FROM files_fts ' \
+           'WHERE files_fts MATCH ? AND rowid=?;'
+
+
+@query_builder
+def query_fts_text_batch() -> str:
+    """
+    MySQL query to retrieve a keyset batch of the TEXT item ids to be indexed.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT id FROM files WHERE ext=\'TEXT\' AND id>? ORDER BY id LIMIT ?;'
+
+
+@query_builder
+def query_phash_create() -> str:
+    """
+    MySQL script to create the perceptual hash table of IMAGE items, with an index per 16-bit band
+    of the hash for multi-index Hamming distance lookups.
+
+    :return:  The formatted query.
+    """
+    return 'CREATE TABLE IF NOT EXISTS phashes (' \
+               'file_id INTEGER PRIMARY KEY, hash INTEGER NOT NULL, ' + \
+               ', '.join(f'band{band} INTEGER NOT NULL' for band in range(PHASH_BANDS)) + \
+           ');' + ''.join(f'CREATE INDEX IF NOT EXISTS phashes_band{band} ON phashes (band{band});'
+                          for band in range(PHASH_BANDS))
+
+
+@query_builder
+def query_phash_candidates(values: int) -> str:
+    """
+    MySQL query to retrieve the hashed items sharing a value with the query hash in any band.
+
+    :param values:  The number of values matched per band.
+    :return:  The formatted query.
+    """
+    marks = ','.join('?' * values)
+    return 'SELECT phashes.file_id, files.name, phashes.hash FROM phashes ' \
+           'JOIN files ON files.id = phashes.file_id WHERE ' + \
+           ' OR '.join(f'phashes.band{band} IN ({marks})' for band in range(PHASH_BANDS)) + ';'
+
+
+@query_builder
+def query_phash_delete() -> str:
+    """
+    MySQL query to delete the perceptual hash of an item.
+
+    :return:  The formatted query.
+    """
+    return 'DELETE FROM phashes WHERE file_id=?;'
+
+
+@query_builder
+def query_phash_fetch() -> str:
+    """
+    MySQL query to retrieve the perceptual hash of an item.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT hash FROM phashes WHERE file_id=?;'
+
+
+@query_builder
+def query_phash_missing() -> str:
+    """
+    MySQL query to retrieve a keyset batch of the IMAGE item ids without a perceptual hash.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT files.id FROM files LEFT JOIN phashes ON phashes.file_id = files.id ' \
+           'WHERE files.ext=\'IMAGE\' AND phashes.file_id IS NULL AND files.id>? ' \
+           'ORDER BY files.id LIMIT ?;'
+
+
+@query_builder
+def query_phash_scan() -> str:
+    """
+    MySQL query to retrieve a keyset batch of the hashed items for a full Hamming distance scan.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT phashes.file_id, files.name, phashes.hash FROM phashes ' \
+           'JOIN files ON files.id = phashes.file_id WHERE phashes.file_id>? ' \
+           'ORDER BY phashes.file_id LIMIT ?;'
+
+
+@query_builder
+def query_phash_store() -> str:
+    """
+    MySQL query to store the perceptual hash of an item, split into its indexed bands.
 
     :return:  The formatted query.
     """
-    return 'CREATE TABLE IF NOT EXISTS storage (' \
+    mask = (1 << PHASH_BAND_BITS) - 1
+    return 'INSERT OR REPLACE INTO phashes (file_id, hash, ' + \
+           ', '.join(f'band{band}' for band in range(PHASH_BANDS)) + ') VALUES (?1, ?2, ' + \
+           ', '.join(f'(?2 >> {band * PHASH_BAND_BITS}) & {mask}'
+                     for band in range(PHASH_BANDS)) + ');'
+
+
+@query_builder
+def query_column_exists() -> str:
+    """
+    MySQL query to check whether a column exists in a table.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT name FROM pragma_table_info(?) WHERE name=?;'
+
+
+@query_builder
+def query_profile(settings: dict) -> str:
+    """
+    MySQL script to apply the pragmas of a performance profile to a connection. The page size
+    only takes effect on a database without tables yet.
+
+    :param settings:  Dict of profile settings (see PROFILES).
+    :return:  The formatted query.
+    """
+    return f'PRAGMA page_size = {int(settings["page_size"])};' \
+           f'PRAGMA cache_size = {int(settings["cache_size"])};' \
+           f'PRAGMA mmap_size = {int(settings["mmap_size"])};' \
+           f'PRAGMA synchronous = {settings["synchronous"]};' \
+           f'PRAGMA temp_store = {settings["temp_store"]};'
+
+
+@query_builder
+def query_savepoint(name: str) -> str:
+    """
+    MySQL query to open a named savepoint within the current transaction.
+
+    :param name:  The savepoint name.
+    :return:  The formatted query.
+    """
+    return f'SAVEPOINT {name};'
+
+
+@query_builder
+def query_release(name: str) -> str:
+    """
+    MySQL query to release a named savepoint, keeping its changes in the current transaction.
+
+    :param name:  The savepoint name.
+    :return:  The formatted query.
+    """
+    return f'RELEASE {name};'
+
+
+@query_builder
+def query_rollback_to(name: str) -> str:
+    """
+    MySQL query to undo the changes made since a named savepoint.
+
+    :param name:  The savepoint name.
+    :return:  The formatted query.
+    """
+    return f'ROLLBACK TO {name};'
+
+
+@query_builder
+def query_begin() -> str:
+    """
+    MySQL query to open a transaction, which on a read-only connection pins a read snapshot.
+
+    :return:  The formatted query.
+    """
+    return 'BEGIN;'
+
+
+@query_builder
+def query_busy_timeout(milliseconds: int) -> str:
+    """
+    MySQL query to set how long a statement waits on a locked database before failing.
+
+    :param milliseconds:  The busy timeout in milliseconds.
+    :return:  The formatted query.
+    """
+    return f'PRAGMA busy_timeout = {int(milliseconds)};'
+
+
+@query_builder
+def query_journal_wal() -> str:
+    """
+    MySQL query to switch the database to write-ahead log journaling.
+
+    :return:  The formatted query.
+    """
+    return 'PRAGMA journal_mode = WAL;'
+
+
+@query_builder
+def query_wal_autocheckpoint(pages: int) -> str:
+    """
+    MySQL query to set the write-ahead log size in pages that triggers an automatic checkpoint.
+
+    :param pages:  The number of pages, 0 or less disables automatic checkpoints.
+    :return:  The formatted query.
+    """
+    return f'PRAGMA wal_autocheckpoint = {int(pages)};'
+
+
+@query_builder
+def query_wal_checkpoint(mode: str) -> str:
+    """
+    MySQL query to checkpoint the write-ahead log into the database.
+
+    :param mode:  The checkpoint mode (PASSIVE, FULL, RESTART or TRUNCATE).
+    :return:  The formatted query.
+    """
+    # If the mode is not a supported checkpoint mode #
+    if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+        raise ValueError(f'Unsupported checkpoint mode: {mode}')
+
+    return f'PRAGMA wal_checkpoint({mode});'
+
+
+@query_builder
+def query_db_file() -> str:
+    """
+    MySQL query to retrieve the path of the file backing the main database, empty if in memory.
+
+    :return:  The formatted query.
+    """
+    return "SELECT file FROM pragma_database_list WHERE name='main';"
+
+
+@query_builder
+def query_get_version() -> str:
+    """
+    MySQL query to retrieve the schema version stamped in the database header.
+
+    :return:  The formatted query.
+    """
+    return 'PRAGMA user_version;'
+
+
+@query_builder
+def query_set_version(version: int) -> str:
+    """
+    MySQL query to stamp the schema version in the database header.
+
+    :param version:  The schema version number to be stamped.
+    :return:  The formatted query.
+    """
+    return f'PRAGMA user_version = {int(version)};'
+
+
+@query_builder
+def query_table_exists() -> str:
+    """
+    MySQL query to check whether a table exists in the database.
+
+    :return:  The formatted query.
+    """
+    return "SELECT name FROM sqlite_master WHERE type='table' AND name=?;"
+
+
+@query_builder
+def query_migrate_blob_create() -> str:
+    """
+    MySQL query to create the BLOB-backed staging table used while migrating legacy base64 rows.
+
+    :return:  The formatted query.
+    """
+    return 'CREATE TABLE IF NOT EXISTS storage_blob (' \
                'name VARCHAR(32) PRIMARY KEY NOT NULL,' \
                'path TINYTEXT NOT NULL,' \
-               'ext TINYTEXT NOT NULL, content LONGTEXT NOT NULL' \
+               'ext TINYTEXT NOT NULL, content BLOB NOT NULL' \
            ');'
 
 
+@query_builder
+def query_migrate_blob_batch() -> str:
+    """
+    MySQL query to retrieve the next batch of legacy base64 rows to be migrated.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT rowid,name,path,ext,content FROM storage ORDER BY rowid LIMIT ?;'
+
+
+@query_builder
+def query_migrate_blob_insert() -> str:
+    """
+    MySQL query to store a migrated row into the BLOB-backed staging table.
+
+    :return:  The formatted query.
+    """
+    return 'INSERT INTO storage_blob (name, path, ext, content) VALUES (?, ?, ?, ?);'
+
+
+@query_builder
+def query_migrate_blob_purge() -> str:
+    """
+    MySQL query to delete the legacy rows that have been migrated.
+
+    :return:  The formatted query.
+    """
+    return 'DELETE FROM storage WHERE rowid<=?;'
+
+
+@query_builder
+def query_migrate_blob_swap(version: int) -> str:
+    """
+    MySQL script to replace the emptied legacy table with the BLOB-backed table.
+
+    :param version:  The schema version number to be stamped after the swap.
+    :return:  The formatted query.
+    """
+    return 'BEGIN;' \
+           'DROP TABLE storage;' \
+           'ALTER TABLE storage_blob RENAME TO storage;' \
+           f'PRAGMA user_version = {int(version)};' \
+           'COMMIT;'
+
+
+@query_builder
+def query_blob_collect() -> str:
+    """
+    MySQL query to garbage-collect the unreferenced blobs of an item's chunks.
+
+    :return:  The formatted query.
+    """
+    return 'DELETE FROM blobs WHERE refs<=0 AND id IN (SELECT blob_id FROM chunks WHERE file_id=?);'
+
+
+@query_builder
+def query_blob_drop() -> str:
+    """
+    MySQL query to delete a blob if it is no longer referenced.
+
+    :return:  The formatted query.
+    """
+    return 'DELETE FROM blobs WHERE id=? AND refs<=0;'
+
+
+@query_builder
+def query_blob_release() -> str:
+    """
+    MySQL query to decrement the reference count of each blob once per chunk of an item using it.
+
+    :return:  The formatted query.
+    """
+    return 'UPDATE blobs SET refs=refs-(' \
+               'SELECT count(*) FROM chunks WHERE file_id=? AND blob_id=blobs.id' \
+           ') WHERE id IN (SELECT blob_id FROM chunks WHERE file_id=?);'
+
+
+@query_builder
+def query_chunk_blobs() -> str:
+    """
+    MySQL query to retrieve the blob ids referenced by an item's chunks.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT DISTINCT blob_id FROM chunks WHERE file_id=?;'
+
+
+@query_builder
+def query_chunk_delete() -> str:
+    """
+    MySQL query to delete the content chunks of an item from storage database.
+
+    :return:  The formatted query.
+    """
+    return 'DELETE FROM chunks WHERE file_id=?;'
+
+
+@query_builder
+def query_chunk_digests() -> str:
+    """
+    MySQL query to retrieve the content hashes of an item's chunks in sequence order.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT blobs.hash FROM chunks JOIN blobs ON blobs.id=chunks.blob_id ' \
+           'WHERE chunks.file_id=? ORDER BY chunks.seq;'
+
+
+@query_builder
+def query_chunk_copy() -> str:
+    """
+    MySQL query to retrieve a single content chunk of an item by sequence number as stored, with
+    its content hash and raw size.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT blobs.hash,blobs.size,blobs.codec,blobs.data FROM chunks JOIN blobs ON ' \
+           'blobs.id=chunks.blob_id WHERE chunks.file_id=? AND chunks.seq=?;'
+
+
+@query_builder
+def query_chunk_fetch() -> str:
+    """
+    MySQL query to retrieve a single content chunk of an item by sequence number.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT blobs.codec,blobs.data FROM chunks JOIN blobs ON blobs.id=chunks.blob_id ' \
+           'WHERE chunks.file_id=? AND chunks.seq=?;'
+
+
+@query_builder
+def query_item_digest() -> str:
+    """
+    MySQL query to retrieve the content hash of an item.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT hash FROM files WHERE id=?;'
+
+
+@query_builder
 def query_item_delete() -> str:
     """
-    MySQL query to delete item from storage database.
+    MySQL query to delete item metadata from storage database.
+
+    :return:  The formatted query.
+    """
+    return 'DELETE FROM files WHERE id=?;'
+
+
+@query_builder
+def query_item_update() -> str:
+    """
+    MySQL query to refresh the source metadata of an item whose content is being replaced.
+
+    :return:  The formatted query.
+    """
+    return 'UPDATE files SET path=?, ext=?, mtime=? WHERE id=?;'
+
+
+@query_builder
+def query_item_name() -> str:
+    """
+    MySQL query to resolve the name of an item by its id.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT name FROM files WHERE id=?;'
+
+
+@query_builder
+def query_item_locate() -> str:
+    """
+    MySQL query to retrieve the id, path, type and size of an item without its content.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT id,path,ext,size FROM files WHERE name=?;'
+
+
+@query_builder
+def query_item_version() -> str:
+    """
+    MySQL query to retrieve the id, content hash and size of an item, the hash versioning its
+    cached content.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT id,hash,size FROM files WHERE name=?;'
+
+
+@query_builder
+def query_item_extract() -> str:
+    """
+    MySQL query to retrieve the id, name, size and modification time of an item to be extracted.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT id,name,size,mtime FROM files WHERE name=?;'
+
+
+@query_builder
+def query_migrate_cas_batch() -> str:
+    """
+    MySQL query to retrieve the next batch of inline chunk rows to be content-addressed.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT rowid,file_id,seq,data FROM chunks ORDER BY rowid LIMIT ?;'
+
+
+@query_builder
+def query_migrate_cas_blob() -> str:
+    """
+    MySQL query to store a migrated chunk as a reference counted blob and return its id.
+
+    :return:  The formatted query.
+    """
+    return 'INSERT INTO blobs (hash, size, refs, data) VALUES (?, ?, 1, ?) ' \
+           'ON CONFLICT(hash) DO UPDATE SET refs=refs+1 RETURNING id;'
+
+
+@query_builder
+def query_migrate_cas_create() -> str:
+    """
+    MySQL script to create the blobs table and the staging table for content-addressed chunks.
+
+    :return:  The formatted query.
+    """
+    return 'CREATE TABLE IF NOT EXISTS blobs (' \
+               'id INTEGER PRIMARY KEY,' \
+               'hash CHAR(64) UNIQUE NOT NULL,' \
+               'size INTEGER NOT NULL, refs INTEGER NOT NULL,' \
+               'data BLOB NOT NULL' \
+           ');' \
+           'CREATE TABLE IF NOT EXISTS chunks_cas (' \
+               'file_id INTEGER NOT NULL,' \
+               'seq INTEGER NOT NULL, blob_id INTEGER NOT NULL,' \
+               'PRIMARY KEY (file_id, seq)' \
+           ');'
+
+
+@query_builder
+def query_migrate_cas_insert() -> str:
+    """
+    MySQL query to store a migrated chunk reference in the staging table.
+
+    :return:  The formatted query.
+    """
+    return 'INSERT INTO chunks_cas (file_id, seq, blob_id) VALUES (?, ?, ?);'
+
+
+@query_builder
+def query_migrate_cas_purge() -> str:
+    """
+    MySQL query to delete the inline chunk rows that have been migrated.
 
     :return:  The formatted query.
     """
-    return 'DELETE FROM storage WHERE name=?;'
+    return 'DELETE FROM chunks WHERE rowid<=?;'
 
 
-def query_item_fetch() -> str:
+@query_builder
+def query_migrate_cas_swap(version: int) -> str:
     """
-    MySQL query to retrieve item from storage database.
+    MySQL script to replace the emptied inline chunks table with the content-addressed one.
 
+    :param version:  The schema version number to be stamped after the swap.
     :return:  The formatted query.
     """
-    return 'SELECT name,path,ext,content FROM storage WHERE name=?;'
+    return 'BEGIN;' \
+           'DROP TABLE chunks;' \
+           'ALTER TABLE chunks_cas RENAME TO chunks;' \
+           f'PRAGMA user_version = {int(version)};' \
+           'COMMIT;'
 
 
-def query_select_all() -> str:
+@query_builder
+def query_migrate_indexes(version: int) -> str:
     """
-    MySQL query to retrieve all contents of storage database.
+    MySQL script to create the files metadata indexes on an existing database.
 
+    :param version:  The schema version number to be stamped after the indexes are created.
     :return:  The formatted query.
     """
-    return 'SELECT * FROM storage;'
+    return 'BEGIN;' + query_files_indexes() + f'PRAGMA user_version = {int(version)};' \
+           'COMMIT;'
 
 
+@query_builder
+def query_migrate_fts(version: int) -> str:
+    """
+    MySQL script to create the empty full-text index on an existing database.
+
+    :param version:  The schema version number to be stamped after the index is created.
+    :return:  The formatted query.
+    """
+    return 'BEGIN;' + query_fts_create() + f'PRAGMA user_version = {int(version)};COMMIT;'
+
+
+@query_builder
+def query_migrate_fts_content(version: int) -> str:
+    """
+    MySQL script to replace a contentless full-text index with an empty one holding the segment
+    text.
+
+    :param version:  The schema version number to be stamped after the index is replaced.
+    :return:  The formatted query.
+    """
+    return 'BEGIN;DROP TABLE IF EXISTS files_fts;' + query_fts_create() + \
+           f'PRAGMA user_version = {int(version)};COMMIT;'
+
+
+@query_builder
+def query_migrate_phash(version: int) -> str:
+    """
+    MySQL script to create the empty perceptual hash table on an existing database.
+
+    :param version:  The schema version number to be stamped after the table is created.
+    :return:  The formatted query.
+    """
+    return 'BEGIN;' + query_phash_create() + f'PRAGMA user_version = {int(version)};COMMIT;'
+
+
+@query_builder
+def query_migrate_codec(version: int) -> str:
+    """
+    MySQL script to add the codec column to the blobs table, existing blobs being uncompressed.
+
+    :param version:  The schema version number to be stamped after the change.
+    :return:  The formatted query.
+    """
+    return 'BEGIN;' \
+           'ALTER TABLE blobs ADD COLUMN codec VARCHAR(8) NOT NULL DEFAULT \'none\';' \
+           f'PRAGMA user_version = {int(version)};' \
+           'COMMIT;'
+
+
+@query_builder
+def query_migrate_digest_batch() -> str:
+    """
+    MySQL query to retrieve the next batch of item ids missing their content hash.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT id FROM files WHERE id>? AND hash IS NULL ORDER BY id LIMIT ?;'
+
+
+@query_builder
+def query_migrate_digest_columns() -> str:
+    """
+    MySQL script to add the modification time and content hash columns to the files table.
+
+    :return:  The formatted query.
+    """
+    return 'BEGIN;' \
+           'ALTER TABLE files ADD COLUMN mtime REAL;' \
+           'ALTER TABLE files ADD COLUMN hash CHAR(64);' \
+           'COMMIT;'
+
+
+@query_builder
+def query_migrate_digest_store() -> str:
+    """
+    MySQL query to set the content hash of an item.
+
+    :return:  The formatted query.
+    """
+    return 'UPDATE files SET hash=? WHERE id=?;'
+
+
+@query_builder
+def query_migrate_chunks_batch() -> str:
+    """
+    MySQL query to retrieve the next batch of single BLOB rows to be split into chunks.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT rowid,name,path,ext,length(content) FROM storage ORDER BY rowid LIMIT ?;'
+
+
+@query_builder
+def query_migrate_chunks_drop(version: int) -> str:
+    """
+    MySQL script to drop the emptied single BLOB table once split into chunks.
+
+    :param version:  The schema version number to be stamped after the drop.
+    :return:  The formatted query.
+    """
+    return 'BEGIN;' \
+           'DROP TABLE storage;' \
+           f'PRAGMA user_version = {int(version)};' \
+           'COMMIT;'
+
+
+@query_builder
+def query_migrate_slice() -> str:
+    """
+    MySQL query to retrieve a slice of a single BLOB row's content by offset, length, and rowid.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT substr(content, ?, ?) FROM storage WHERE rowid=?;'
+
+
+@query_builder
+def query_list_page(filters, key='id') -> str:
+    """
+    MySQL query to retrieve a keyset page of item metadata after an id or name, narrowed by the
+    named filters whose parameters follow the key in the order passed.
+
+    :param filters:  Iterable of filter names (ext_type, path, name, size_min, size_max,
+                     mtime_min, mtime_max).
+    :param key:  The indexed column the page is ordered by (id or name).
+    :return:  The formatted query.
+    """
+    clauses = {'ext_type': 'ext=?', 'path': 'path=?', 'name': 'name GLOB ?',
+               'size_min': 'size>=?', 'size_max': 'size<=?', 'mtime_min': 'mtime>=?',
+               'mtime_max': 'mtime<=?'}
+    where = ''.join(f' AND {clauses[filter_name]}' for filter_name in filters)
+
+    return f'SELECT id,name,path,ext,size,mtime,hash FROM files WHERE {key}>?{where} ' \
+           f'ORDER BY {key} LIMIT ?;'
+
+
+@query_builder
+def query_stats_blobs() -> str:
+    """
+    MySQL query to retrieve the count, total raw size, total stored size and total references of
+    the stored blobs.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT count(*),total(size),total(length(data)),total(refs) FROM blobs;'
+
+
+@query_builder
+def query_stats_files() -> str:
+    """
+    MySQL query to retrieve the count and total size of the stored items.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT count(*),total(size) FROM files;'
+
+
+@query_builder
+def query_stats_fts() -> str:
+    """
+    MySQL query to retrieve the size of the full-text index, its term data, segment text and
+    segment sizes.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT (SELECT total(length(block)) FROM files_fts_data) + ' \
+           '(SELECT total(length(c0)) FROM files_fts_content) + ' \
+           '(SELECT total(length(sz)) FROM files_fts_docsize);'
+
+
+@query_builder
+def query_sync_manifest() -> str:
+    """
+    MySQL query to retrieve the name, id, size and modification time of the items stored from a
+    source directory.
+
+    :return:  The formatted query.
+    """
+    return 'SELECT name, id, size, mtime FROM files WHERE path=?;'
+
+
+@query_builder
+def query_store_blob() -> str:
+    """
+    MySQL query to store a content-addressed blob, or add a reference to it if its hash is already
+    stored, and return its id.
+
+    :return:  The formatted query.
+    """
+    return 'INSERT INTO blobs (hash, size, refs, codec, data) VALUES (?, ?, 1, ?, ?) ' \
+           'ON CONFLICT(hash) DO UPDATE SET refs=refs+1 RETURNING id;'
+
+
+@query_builder
+def query_store_chunk() -> str:
+    """
+    MySQL query to store a chunk of an item referencing its content blob.
+
+    :return:  The formatted query.
+    """
+    return 'INSERT INTO chunks (file_id, seq, blob_id) VALUES (?, ?, ?);'
+
+
+@query_builder
 def query_store_item() -> str:
     """
-    MySQL query to store data into the Storage database.
+    MySQL query to store item metadata into the storage database and return its id.
+
+    :return:  The formatted query.
+    """
+    return 'INSERT INTO files (name, path, ext, size, mtime) VALUES (?, ?, ?, 0, ?) RETURNING id;'
+
+
+@query_builder
+def query_store_summary() -> str:
+    """
+    MySQL query to set the size and content hash of a stored item once its chunks are written.
 
     :return:  The formatted query.
     """
-    return 'INSERT INTO storage (name, path, ext, content) VALUES (?, ?, ?, ?);'
+    return 'UPDATE files SET size=?, hash=? WHERE id=?;'
+
+
+def check_env_profile() -> str:
+    """
+    Checks the profile selected by the FILEDB_PROFILE environment variable against PROFILES, so
+    an unknown one is reported as a usage error before any connection is opened.
+
+    :return:  The error message, None if the profile is defined.
+    """
+    # If the profile is defined #
+    if DEFAULT_PROFILE in PROFILES:
+        return None
+
+    return f'invalid FILEDB_PROFILE: {DEFAULT_PROFILE!r} ' \
+           f'(choose from {", ".join(map(repr, PROFILES))})'
 
 
 def print_err(msg: str, seconds):
@@ -0,0 +1,113 @@
+""" Built-in modules """
+import logging
+import os
+from fnmatch import fnmatchcase
+from pathlib import Path
+# Custom Modules #
+from Modules.catalog import check_name
+from Modules.ingest import EXTENSIONS
+
+
+# Symbolic link policies: skip every link, follow links to files only, or follow all links #
+SYMLINK_POLICIES = ('skip', 'files', 'follow')
+
+
+def matches(patterns, rel_path: str, name: str) -> bool:
+    """
+    Checks whether an entry matches any of the glob patterns, by its path relative to the walk
+    root or by its name alone.
+
+    :param patterns:  Iterable of glob patterns.
+    :param rel_path:  The entry path relative to the walk root, with forward slashes.
+    :param name:  The entry name.
+    :return:  True if any pattern matches, False otherwise.
+    """
+    return any(fnmatchcase(rel_path, pattern) or fnmatchcase(name, pattern)
+               for pattern in patterns)
+
+
+def walk_files(root, include=(), exclude=(), max_depth=None, symlinks='skip'):
+    """
+    Lazily walks a directory tree depth first, yielding an ingest job per supported file as it is
+    found, so storing starts while the walk is still going. Only the stack of directories left
+    to visit is held, never the whole tree. Files are yielded under their POSIX path relative to
+    the root, so files sharing a name in sibling directories do not collide, and files directly
+    in the root keep their own names.
+
+    :param root:  The directory to be walked.
+    :param include:  Glob patterns a file must match to be yielded, empty to yield all files.
+    :param exclude:  Glob patterns of the files and directories to be skipped.
+    :param max_depth:  The max depth of the directories walked below the root, 0 for the root
+                       only, None for no limit.
+    :param symlinks:  The symbolic link policy (skip, files or follow).
+    :return:  Generator of (stored name, file extension, storage type, source path) jobs.
+    """
+    # If the symbolic link policy is not supported #
+    if symlinks not in SYMLINK_POLICIES:
+        raise ValueError(f'Unsupported symbolic link policy: {symlinks}')
+
+    root = Path(root).absolute()
+    # Directories left to visit, with their relative path and depth #
+    stack = [(root, '', 0)]
+    # Identities of the visited directories, guarding followed links against cycles #
+    visited = set()
+
+    # Visit directories until there are none left #
+    while stack:
+        dir_path, rel_dir, depth = stack.pop()
+        try:
+            # If links are followed, skip directories already visited through another path #
+            if symlinks == 'follow':
+                stat = dir_path.stat()
+                # If the directory was already visited #
+                if (stat.st_dev, stat.st_ino) in visited:
+                    continue
+
+                visited.add((stat.st_dev, stat.st_ino))
+
+            with os.scandir(dir_path) as entries:
+                subdirs = []
+                # Iterate through the directory entries #
+                for entry in entries:
+                    rel_path = f'{rel_dir}{entry.name}'
+                    is_link = entry.is_symlink()
+
+                    # If the entry is excluded #
+                    if exclude and matches(exclude, rel_path, entry.name):
+                        continue
+
+                    # If the entry is a directory to descend into #
+                    if entry.is_dir():
+                        # If it is within the depth limit and the link policy allows it #
+                        if (max_depth is None or depth < max_depth) and \
+                                (not is_link or symlinks == 'follow'):
+                            subdirs.append((Path(entry.path), f'{rel_path}/', depth + 1))
+                        continue
+
+                    file_ext = entry.name.rpartition('.')[2].lower() if '.' in entry.name else ''
+                    # If the file type is not supported or it is not included #
+                    if file_ext not in EXTENSIONS or \
+                            (include and not matches(include, rel_path, entry.name)):
+                        continue
+
+                    # If the entry is not a file or the link policy skips it #
+                    if not entry.is_file() or (is_link and symlinks == 'skip'):
+                        continue
+
+                    try:
+                        name = check_name(rel_path)
+
+                    # If the relative path is not a safe stored name, the file is skipped #
+                    except ValueError as name_err:
+                        logging.error('Error occurred walking directory: %s', name_err)
+                        continue
+
+                    yield name, file_ext, EXTENSIONS[file_ext], Path(entry.path)
+
+        # If the directory could not be read, it is skipped #
+        except OSError as dir_err:
+            logging.error('Error occurred walking directory: %s', dir_err)
+            continue
+
+        # Visit the subdirectories in name order, the stack popping the last one first #
+        stack.extend(sorted(subdirs, key=lambda item: item[0].name, reverse=True))
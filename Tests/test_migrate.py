@@ -0,0 +1,75 @@
+""" Built-in modules """
+import sqlite3
+# Custom Modules #
+from Modules.file_store import FileStore
+from Modules.migrate import SCHEMA_VERSION
+
+
+def make_v6_db(db_file):
+    """
+    Creates a database at schema version 6, before the full-text index and perceptual hashes.
+
+    :param db_file:  The path of the database file to be created.
+    :return:  Nothing
+    """
+    FileStore(db_file).close()
+    connection = sqlite3.connect(db_file)
+    connection.executescript('DROP TABLE files_fts;DROP TABLE phashes;PRAGMA user_version = 6;')
+    connection.close()
+
+
+def make_v9_db(db_file):
+    """
+    Creates a database at schema version 9, with a contentless full-text index.
+
+    :param db_file:  The path of the database file to be created.
+    :return:  Nothing
+    """
+    FileStore(db_file).close()
+    connection = sqlite3.connect(db_file)
+    connection.executescript('DROP TABLE files_fts;'
+                             'CREATE VIRTUAL TABLE files_fts USING fts5(body, content=\'\');'
+                             'PRAGMA user_version = 9;')
+    connection.close()
+
+
+def get_version(db_file) -> int:
+    """
+    Reads the schema version stamped in a database file.
+
+    :param db_file:  The path of the database file.
+    :return:  The schema version number.
+    """
+    connection = sqlite3.connect(db_file)
+    try:
+        return connection.execute('PRAGMA user_version;').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def test_migrate_v6_to_current(tmp_path):
+    db_file = tmp_path / 'storage.db'
+    make_v6_db(db_file)
+
+    with FileStore(db_file) as store:
+        store.put(b'the lazy dog sleeps', 'dog.txt')
+        assert [match['name'] for match in store.search('lazy')] == ['dog.txt']
+
+    assert get_version(db_file) == SCHEMA_VERSION
+
+    # Reopening the migrated database must keep the items indexed since the migration #
+    with FileStore(db_file) as store:
+        assert [match['name'] for match in store.search('lazy')] == ['dog.txt']
+
+
+def test_migrate_v9_to_current(tmp_path):
+    db_file = tmp_path / 'storage.db'
+    make_v9_db(db_file)
+
+    with FileStore(db_file) as store:
+        store.put(b'the lazy dog sleeps', 'dog.txt')
+        assert store.search('lazy')[0]['snippet'] == 'the [lazy] dog sleeps'
+        store.delete('dog.txt')
+        assert not store.search('lazy')
+
+    assert get_version(db_file) == SCHEMA_VERSION
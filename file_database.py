@@ -1,22 +1,35 @@
-# pylint: disable=W0106,E1101,E0401
+# pylint: disable=W0106,E1101,E0401,C0413
 """ Built-in modules """
-import base64
+import sys
+# Custom Modules #
+from Modules.startup import STARTUP_FLAG, profile_startup
+
+# If the startup is profiled, install the import timer before the remaining imports #
+if STARTUP_FLAG in sys.argv:
+    profile_startup(sys.argv)
+
+# Built-in modules #
 import logging
 import os
 import re
 import sqlite3
-import sys
 import time
 from pathlib import Path
 from shlex import quote
 from threading import BoundedSemaphore
-# External Modules #
-import cv2
-from pyfiglet import Figlet
 # Custom Modules #
-from Modules.utils import DbConnectionHandler, db_error_query, query_select_all, \
-                          query_item_delete, query_item_fetch, query_db_create, query_store_item, \
-                          print_err, query_handler
+from Modules.catalog import PAGE_SIZE, iter_files, resolve_id
+from Modules.cli import run_cli
+from Modules.ingest import BATCH_BYTES, BATCH_FILES, INGEST_WORKERS, QUEUE_DEPTH, ingest_files
+from Modules.extract import EXTRACT_WORKERS, extract_files, extract_tar, extract_target, \
+                            select_items, stream_extract, tar_mode
+from Modules.instrument import QUERY_STATS
+from Modules.migrate import create_db, migrate_db
+from Modules.storage import delete_file_row, get_stats
+from Modules.sync import sync_dir
+from Modules.utils import DbConnectionHandler, check_env_profile, db_error_query, \
+                          query_item_locate, print_err, query_handler
+from Modules.walker import walk_files
 
 
 # Global variables #
@@ -25,32 +38,19 @@ DB_NAME = 'storage'
 
 def get_by_index(file: int, db_conn: sqlite3):
     """
-    Finds file name in storage location based on passed in index.
+    Finds file name in storage location based on the stable id shown in the storage listing.
 
-    :param file:  The integer representing the row in the storage database where the file is stored.
+    :param file:  The integer id of the row in the storage database where the file is stored.
     :param db_conn:  The protected database connection to be interacted with.
     :return: The actual file name on success and prints error on failure.
     """
-    # Get formatted query to retrieve the contents of database #
-    list_query = query_select_all()
-    # Execute query to list the contents of storage database #
-    rows = query_handler(db_conn, list_query, fetch='all')
-
-    # If no rows are returned #
-    if not rows:
-        return print_err(f'{DB_NAME} database currently has no data stored in it', 2)
-
-    # Populate file names from db to list #
-    files = [row[0] for row in rows]
-
-    try:
-        # Assign file name with full path as designated index #
-        filename = files[file]
+    # Resolve the file name with a single lookup on the id #
+    filename = resolve_id(db_conn, file)
 
-    # If trying to access index that does not exist #
-    except IndexError as index_err:
-        logging.error('Index error accessing file index: %s', index_err)
-        return print_err(f'Index error accessing file index: {index_err}', 2)
+    # If no row has the id #
+    if filename is None:
+        logging.error('No file stored with id: %d', file)
+        return print_err(f'No file stored in {DB_NAME} database with id {file}', 2)
 
     return filename
 
@@ -72,38 +72,56 @@ def delete_file(db_conn: sqlite3):
 
     # If the user entered a number #
     if file_name.isdigit():
-        # Get the file name from specified row index #
+        # Get the file name from its listed id #
         file_name = get_by_index(int(file_name), db_conn)
 
-    # Get formatted query to delete item from database #
-    delete_query = query_item_delete()
-    # Execute query to delete item in storage database #
-    query_handler(db_conn, delete_query, file_name)
+    # Get formatted query to locate an item without loading its content #
+    item_query = query_item_locate()
+    # Execute query to locate single file in storage database #
+    row = query_handler(db_conn, item_query, file_name, fetch='one')
+
+    # If entry in storage database was not retrieved #
+    if not row:
+        return print_err('Queried database entry does not exist', 2)
+
+    # Delete the item chunks and metadata from storage database #
+    delete_file_row(db_conn, row[0])
 
     return print(f'\n[!] {file_name} has been successfully deleted from {DB_NAME} database')
 
 
-def store_file(path_regex, db_conn: sqlite3):
+def store_file(path_regex, db_conn: sqlite3, workers=INGEST_WORKERS, queue_depth=QUEUE_DEPTH,
+               batch_files=BATCH_FILES, batch_bytes=BATCH_BYTES, level=None):
     """
-    Stores files in the storage database.
+    Stores files in the storage database, reading them on a pool of worker threads and committing
+    them in bounded batches.
 
     :param path_regex:  Compiled regex pattern to match file path.
     :param db_conn:  The protected database connection to be interacted with.
+    :param workers:  The number of reader threads, 1 or less reads on the calling thread.
+    :param queue_depth:  The max number of jobs and payloads queued between pipeline stages.
+    :param batch_files:  The max number of files committed per transaction.
+    :param batch_bytes:  The max number of payload bytes committed per transaction.
+    :param level:  The compression level, None for the codec default.
     :return:  Prints success or error message.
     """
     store_path = input('Enter the absolute path of directory to store files or '
                        'hit enter to store files from the Dock directory:\n')
     prompt = input('\nShould the files being stored be deleted after storage operation (y or n)? ')
+    reencode = input('\nShould images be re-encoded through OpenCV instead of stored byte-exact '
+                     '(y or hit enter for n)? ') or 'n'
+    recursive = input('\nShould files in subdirectories be stored as well '
+                      '(y or hit enter for n)? ') or 'n'
     print()
 
     # If one of the options was not selected #
-    if prompt not in ('y', 'n'):
+    if prompt not in ('y', 'n') or reencode not in ('y', 'n') or recursive not in ('y', 'n'):
         return print_err('Improper input .. pick y or n', 2)
 
     # If the user selects the Dock directory #
     if store_path == '':
-        # Get the current working directory and append Dock path #
-        file_path = curr_path / 'Dock'
+        # Set the Dock directory in the current working directory #
+        file_path = dock_path
     # If path regex fails #
     elif not re.search(path_regex, store_path):
         # Return error #
@@ -112,100 +130,78 @@ def store_file(path_regex, db_conn: sqlite3):
     else:
         file_path = Path(store_path)
 
-    name, ext = [], []
-    allowed_ext = ('.txt', '.py', '.html', '.jpg', '.png', '.jpeg')
-    extensions = {'txt': 'TEXT', 'py': 'TEXT', 'html': 'TEXT', 'jpg': 'IMAGE',
-                  'png': 'IMAGE', 'jpeg': 'IMAGE'}
-
     print(f'Storing files in {file_path}:\n{(19 + len(str(file_path))) * "*"}\n')
 
-    # Iterate through the file names in path #
-    for file in os.scandir(file_path):
-        # If file does not have supported file type #
-        if not file.name.endswith(allowed_ext):
-            continue
+    # Files are stored under their path relative to the directory as the walk yields them #
+    jobs = walk_files(file_path, max_depth=None if recursive == 'y' else 0)
 
-        # Split the file name and extension #
-        res = file.name.split('.')
-
-        # If the filename contains more than one period for extension #
-        if not re.search(r'^[^.]{1,30}\.[a-z]{2,4}$', file.name):
-            # Remove the extension from list #
-            file_ext = res.pop()
-            # Append the last member in list as extension #
-            ext.append(file_ext)
-            # Re-append remaining name #
-            parse_name = ''.join(res)
-            # Append fixed name to list #
-            name.append(parse_name)
-            # Format the new path with parsed data #
-            src_file = file_path / file.name
-            dest_file = file_path / f'{parse_name}.{file_ext}'
-            # Rename the file to new name #
-            os.rename(src_file, dest_file)
-
-        # If the file name only has a single period for file ext #
-        else:
-            # Append name to name list #
-            name.append(res[0])
-            # Append extension to extension list #
-            ext.append(res[1])
+    def delete_sources(sources):
+        # Iterate through the committed files of the batch and delete them #
+        for current_file in sources:
+            current_file.unlink()
 
-    # Iterate through file names and extensions #
-    for file_name, file_ext in zip(name, ext):
-        try:
-            ext_type = extensions[file_ext]
-        # If file extension not in defined dict #
-        except KeyError:
-            return print_err(f'File {file_name} has extension type '
-                             f'{file_ext} that is not supported', 2)
-
-        # Format the current file path #
-        current_file = file_path / f'{file_name}.{file_ext}'
-
-        # If image file #
-        if ext_type == 'IMAGE':
-            # Get the image data #
-            img = cv2.imread(str(current_file))
-
-            # If jpg image #
-            if file_ext == 'jpg':
-                file_string = base64.b64encode(cv2.imencode('.jpg', img)[1])
-            # If jpeg image #
-            elif file_ext == 'jpeg':
-                file_string = base64.b64encode(cv2.imencode('.jpeg', img)[1])
-            # If png image #
-            elif file_ext == 'png':
-                file_string = base64.b64encode(cv2.imencode('.png', img)[1])
-            # If unsupported image type #
-            else:
-                return print_err('Unsupported image file type detected', 2)
-
-        # If text file #
-        elif ext_type == 'TEXT':
-            with current_file.open('rb') as file:
-                file_string = base64.b64encode(file.read())
-
-        # For other file types #
-        else:
-            return print_err('Unsupported file extension type detected', 2)
+    # If the user wants the files deleted after storage, delete them batch by batch #
+    on_commit = delete_sources if prompt == 'y' else None
 
-        # Get formatted query to store item in database #
-        insert_query = query_store_item()
-        # Store the current iteration in database #
-        query_handler(db_conn, insert_query, f'{file_name}.{file_ext}', str(file_path),
-                      ext_type, file_string.decode())
+    # Read the files on the worker pool and commit them in bounded batches #
+    writer = ingest_files(db_conn, jobs, reencode == 'y', workers, queue_depth, batch_files,
+                          batch_bytes, level, on_commit=on_commit)
 
-        # Print success and delete stored file from Dock #
-        print(f'File => {file_name}.{file_ext} Stored')
+    # If any batch was rolled back or any name was already taken #
+    if writer.failed:
+        failed = ', '.join(current_file.name for current_file in writer.failed)
+        return print_err(f'{len(writer.failed)} files were not stored: {failed}', 2)
 
-        # If the user wants the files deleted after storage #
-        if prompt == 'y':
-            # Delete the current file #
-            current_file.unlink()
+    return print(f'\n[!] All {writer.stored_count} files in {file_path} have been stored in '
+                 f'{DB_NAME} database')
 
-    return print(f'\n[!] All files in {file_path} have been stored in {DB_NAME} '
-                 'database')
+
+def sync_files(path_regex, db_conn: sqlite3):
+    """
+    Syncs a directory with the files stored from it, storing new files, replacing changed ones and
+    skipping unchanged ones without reading them.
+
+    :param path_regex:  Compiled regex pattern to match file path.
+    :param db_conn:  The protected database connection to be interacted with.
+    :return:  Prints the sync results or error message.
+    """
+    sync_path = input('Enter the absolute path of directory to sync or '
+                      'hit enter to sync the Dock directory:\n')
+    prune = input('\nShould stored files whose source file was removed be deleted '
+                  '(y or hit enter for n)? ') or 'n'
+    print()
+
+    # If the prune option was not selected properly #
+    if prune not in ('y', 'n'):
+        return print_err('Improper input .. pick y or n', 2)
+
+    # If the user selects the Dock directory #
+    if sync_path == '':
+        file_path = dock_path
+    # If path regex fails #
+    elif not re.search(path_regex, sync_path):
+        return print_err(f'Regex failed to match path to be synced: {sync_path}', 2)
+    # If proper path was passed in #
+    else:
+        file_path = Path(sync_path)
+
+    result = sync_dir(db_conn, file_path, prune == 'y')
+
+    # Iterate through the names taken by files stored from other directories #
+    for conflict in result['conflicts']:
+        print_err(f'Name already stored from another directory: {conflict}', 0)
+
+    # Iterate through the items stored from the same file under several names #
+    for collision in result['collisions']:
+        print_err(f'File stored under several names, left untouched: {collision}', 0)
+
+    # If any batch was rolled back #
+    if result['failed']:
+        return print_err(f'{len(result["failed"])} files were not synced: '
+                         f'{", ".join(result["failed"])}', 2)
+
+    return print(f'\n[!] {file_path} synced => {result["added"]} added, {result["updated"]} '
+                 f'updated, {result["unchanged"]} unchanged, {len(result["removed"])} removed')
 
 
 def extract_file(db_conn: sqlite3):
@@ -225,12 +221,12 @@ def extract_file(db_conn: sqlite3):
 
     # If the user entered a number #
     if file_name.isdigit():
-        # Get the file name from specified row index #
+        # Get the file name from its listed id #
         file_name = get_by_index(int(file_name), db_conn)
 
-    # Get formatted query to fetch an item #
-    item_query = query_item_fetch()
-    # Execute query to list contents of single file in storage database #
+    # Get formatted query to locate an item without loading its content #
+    item_query = query_item_locate()
+    # Execute query to locate single file in storage database #
     row = query_handler(db_conn, item_query, file_name, fetch='one')
 
     # If entry in storage database was noe retrieved #
@@ -239,19 +235,14 @@ def extract_file(db_conn: sqlite3):
 
     # If the retrieved rows file extension is the same as users input #
     if row[2] == file_type:
-        # Set the file string the content column in retrieved row #
-        file_string = row[3]
-        # Decode from base64 #
-        decoded_text = base64.b64decode(file_string)
-        # Format the file to be extracted path #
-        extract_path = dock_path / file_name
-
         try:
-            with extract_path.open('ab') as out_file:
-                out_file.write(decoded_text)
+            # Format the file to be extracted path, refusing names that escape the Dock #
+            extract_path = extract_target(dock_path.resolve(), file_name)
+            # Stream the content to disk in fixed-size chunks #
+            stream_extract(db_conn, row[0], extract_path)
 
-        # If error occurs during file operation #
-        except OSError as file_err:
+        # If the name is unsafe or error occurs during file operation #
+        except (ValueError, OSError) as file_err:
             logging.error('Error occurred during file operation: %s\n\n', file_err)
             return print_err(f'Error occurred during file operation: {file_err}', 2)
 
@@ -262,35 +253,130 @@ def extract_file(db_conn: sqlite3):
     return print(f'\n$ {file_name} successfully extracted from {DB_NAME} database $')
 
 
-def list_storage(db_conn: sqlite3):
+def bulk_extract(path_regex, db_conn: sqlite3, workers=EXTRACT_WORKERS):
     """
-    Queries database for list of all files and displays as enumerated list to the user.
+    Extracts many files at once, selected by name list, glob, type or everything, to Dock or any
+    directory on a bounded pool of threads, or streams them into a single tar archive.
 
+    :param path_regex:  Compiled regex pattern to match the destination path.
     :param db_conn:  The protected database connection to be interacted with.
-    :return:  Nothing
+    :param workers:  The number of extraction threads.
+    :return:  Prints the extraction results or error message.
+    """
+    selection = input('Comma separated file names or numbers, a name glob (like *.py), TEXT or '
+                      'IMAGE, or hit enter for every file?\n')
+    dest_path = input('\nEnter the absolute path of directory or .tar/.tar.gz/.tgz archive to '
+                      'extract to or hit enter to extract to the Dock directory:\n')
+    print()
+
+    # If the user selects the Dock directory #
+    if dest_path == '':
+        dest_path = dock_path
+    # If path regex fails #
+    elif not re.search(path_regex, dest_path):
+        return print_err(f'Regex failed to match path to extract to: {dest_path}', 2)
+    # If proper path was passed in #
+    else:
+        dest_path = Path(dest_path)
+
+    # If a gzip path is not a .tar.gz archive #
+    if dest_path.suffix == '.gz' and not tar_mode(dest_path):
+        return print_err(f'Unsupported archive suffix of {dest_path.name}, use .tar, .tar.gz or '
+                         '.tgz', 2)
+
+    names, pattern, ext_type = None, None, None
+    # If a storage type was entered #
+    if selection in ('TEXT', 'IMAGE'):
+        ext_type = selection
+    # If a name glob was entered #
+    elif any(char in selection for char in '*?['):
+        pattern = selection
+    # If names or numbers were entered #
+    elif selection:
+        names = [name.strip() for name in selection.split(',') if name.strip()]
+
+    missing = []
+    items = select_items(db_conn, names, pattern, ext_type, missing)
+    try:
+        # If the files are to be streamed into an archive #
+        if tar_mode(dest_path):
+            failed = []
+            count = len(extract_tar(db_conn, items, dest_path, failed))
+        # If the files are to be extracted to a directory #
+        else:
+            results = extract_files(db_conn, items, dest_path, workers)
+            count = sum(error is None for _, error in results)
+            failed = [name for name, error in results if error]
+
+    # If error occurs during file operation #
+    except OSError as file_err:
+        logging.error('Error occurred during file operation: %s\n\n', file_err)
+        return print_err(f'Error occurred during file operation: {file_err}', 2)
+
+    # If any file could not be found or extracted #
+    if missing or failed:
+        print_err(f'{len(missing) + len(failed)} files were not extracted: '
+                  f'{", ".join(missing + failed)}', 2)
+
+    return print(f'\n$ {count} files successfully extracted from {DB_NAME} database to '
+                 f'{dest_path} $')
+
+
+def list_storage(db_conn: sqlite3, **filters):
     """
-    # Get formatted query to fetch all db contents #
-    list_query = query_select_all()
-    # Execute query to list the contents of storage database #
-    rows = query_handler(db_conn, list_query, fetch='all')
+    Displays the stored files with their ids one keyset page at a time, optionally narrowed by
+    metadata filters.
 
+    :param db_conn:  The protected database connection to be interacted with.
+    :param filters:  Keyword listing filters (see catalog.list_files).
+    :return:  Nothing
+    """
     count = 0
     print(f'\nFiles Available:\n{"-=" * 12}->')
 
-    # Iterate through fetched data with corresponding index #
-    for index, row in enumerate(rows):
+    # Iterate through the stored files page by page #
+    for row in iter_files(db_conn, PAGE_SIZE, **filters):
         # If the line count is maxed #
-        if count == 60:
+        if count == PAGE_SIZE:
             # Wait for user to continue and reset #
             input('[+] Press enter to continue .. ')
             count = 0
 
-        print(f'{index} => {row[0]}')
+        print(f'{row[0]} => {row[1]}')
         count += 1
 
     time.sleep(3)
 
 
+def storage_stats(db_conn: sqlite3):
+    """
+    Displays storage statistics including the deduplication and compression ratios and bytes saved.
+
+    :param db_conn:  The protected database connection to be interacted with.
+    :return:  Nothing
+    """
+    # Gather the file and content-addressed blob statistics #
+    stats = get_stats(db_conn)
+
+    print(f'\nStorage Stats:\n{"-=" * 12}->')
+    print(f'Files stored      => {stats["files"]}')
+    print(f'Logical bytes     => {stats["logical_bytes"]}')
+    print(f'Chunks            => {stats["chunks"]} ({stats["unique_chunks"]} unique)')
+    print(f'Unique bytes      => {stats["unique_bytes"]}')
+    print(f'Stored bytes      => {stats["stored_bytes"]}')
+    print(f'Bytes saved       => {stats["bytes_saved"]}')
+    print(f'Dedup ratio       => {stats["dedup_ratio"]}x')
+    print(f'Compression ratio => {stats["compression_ratio"]}x')
+
+    # If the queries are instrumented #
+    if QUERY_STATS.enabled:
+        print(f'\nQuery Stats:\n{"-=" * 12}->')
+        # Iterate through the query builders, slowest total time first #
+        for name, query in QUERY_STATS.dump().items():
+            print(f'{name:<28} => {query["calls"]} calls, {query["total_ms"]}ms total, '
+                  f'{query["mean_ms"]}ms mean, {query["max_ms"]}ms max')
+
+
 def main_menu(db_conn: sqlite3):
     """
     Display command options and receives input on what command to execute.
@@ -309,6 +395,9 @@ def main_menu(db_conn: sqlite3):
         re_path = re.compile(r'^(?:/[a-zA-Z\d_\"\' .,-]{1,30}){1,12}')
         cmd = quote('clear')
 
+    # The banner font is only loaded by the interactive menu #
+    from pyfiglet import Figlet
+
     # Set the program name banner #
     custom_fig = Figlet(font='larry3d', width=130)
 
@@ -325,8 +414,11 @@ def main_menu(db_conn: sqlite3):
         #==========================#
         |    l => List Contents    |
         |    o => Open File        |
+        |    b => Bulk Extract     |
         |    s => Store File       |
+        |    y => Sync Directory   |
         |    d => Delete File      |
+        |    t => Storage Stats    |
         |    e => Exit Database    |
         #--------------------------#
         ''')
@@ -339,12 +431,21 @@ def main_menu(db_conn: sqlite3):
         # If file contents are to be retrieved #
         elif prompt == 'o':
             extract_file(db_conn)
+        # If many files are to be extracted at once #
+        elif prompt == 'b':
+            bulk_extract(re_path, db_conn)
         # If file contents are to be stored #
         elif prompt == 's':
             store_file(re_path, db_conn)
+        # If a directory is to be synced with its stored files #
+        elif prompt == 'y':
+            sync_files(re_path, db_conn)
         # If the file contents are to be deleted #
         elif prompt == 'd':
             delete_file(db_conn)
+        # If the storage stats are to be displayed #
+        elif prompt == 't':
+            storage_stats(db_conn)
         # If the program is to be exited #
         elif prompt == 'e':
             sys.exit(0)
@@ -373,10 +474,12 @@ def main():
                 with DbConnectionHandler(db_path[0]) as connection:
                     # If the database did not exist on start #
                     if not exists:
-                        # Get formatted query to create database #
-                        create_query = query_db_create()
                         # Create storage database #
-                        query_handler(connection, create_query, exec_script=True)
+                        create_db(connection)
+                    # If the database exists #
+                    else:
+                        # Migrate legacy schema to the current version #
+                        migrate_db(connection)
 
                     # Pass db connection in main #
                     main_menu(connection)
@@ -418,6 +521,15 @@ if __name__ == '__main__':
     # If the database does not exist set to False, otherwise True #
     exists = False if not db_path[0].exists() else True
 
+    # If a subcommand was passed, run it non-interactively and exit with its status #
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:], db_path[0], dock_path))
+
+    # If the profile selected by the environment is not defined #
+    if profile_err := check_env_profile():
+        print_err(profile_err, None)
+        sys.exit(2)
+
     while True:
         try:
             main()